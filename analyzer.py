@@ -0,0 +1,101 @@
+# analyzer.py
+"""
+Pipeline phân tích text tiếng Việt cho retriever, dùng chung cho lúc build index và lúc query:
+
+    NFC → lower → tách âm tiết → (bỏ dấu) → bỏ stopword → (+ bigram âm tiết)
+
+- NFC: text gõ từ mobile / copy từ web hay ở dạng tổ hợp (NFD), cùng chữ nhưng khác byte.
+- Bỏ dấu: "giao hang" khớp "giao hàng" (khách gõ không dấu).
+- Bigram: từ ghép tiếng Việt là nhiều âm tiết ("giao hàng", "đổi trả") → thêm token "giao_hang"
+  để doc chứa đúng cụm được điểm cao hơn doc chỉ có từng âm tiết rời.
+- Stopword: bỏ các âm tiết xuất hiện khắp nơi ("là", "của", "thì"...) → posting list ngắn hơn.
+
+Cấu hình qua biến môi trường ANALYZER_FOLD_DIACRITICS, ANALYZER_BIGRAMS, ANALYZER_STOPWORDS.
+"""
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+ANALYZER_FOLD_DIACRITICS = os.getenv("ANALYZER_FOLD_DIACRITICS", "1") == "1"
+ANALYZER_BIGRAMS = os.getenv("ANALYZER_BIGRAMS", "1") == "1"
+ANALYZER_STOPWORDS = os.getenv("ANALYZER_STOPWORDS", "1") == "1"
+ANALYZER_QUERY_CACHE = int(os.getenv("ANALYZER_QUERY_CACHE", "2048"))
+
+BIGRAM_SEP = "_"
+
+# Âm tiết chức năng, gần như doc nào cũng có. Cố ý KHÔNG bỏ "không", "bao", "nhiêu"...
+# vì khách hay hỏi "bao lâu", "không nhận được hàng".
+VI_STOPWORDS = frozenset(
+    """
+    là và của thì mà với cho các những một này đó kia ạ à ơi nhé nha ấy
+    vì nên nếu khi để bị bởi rằng cũng đã đang sẽ rất lại vẫn còn
+    em anh chị mình bạn shop ad
+    """.split()
+)
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: "Giao hàng đúng hẹn" → "Giao hang dung hen"."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    decomposed = unicodedata.normalize("NFD", text)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return unicodedata.normalize("NFC", stripped)
+
+
+def syllable_bigrams(tokens: Sequence[str]) -> List[str]:
+    return [f"{a}{BIGRAM_SEP}{b}" for a, b in zip(tokens, tokens[1:])]
+
+
+class Analyzer:
+    """
+    Biến text → list token. Các bước bật/tắt qua tham số, có thể thêm bước tuỳ ý
+    qua `filters` (hàm nhận list token, trả list token) chạy sau bước bỏ stopword.
+    """
+
+    def __init__(
+        self,
+        fold: bool = ANALYZER_FOLD_DIACRITICS,
+        bigrams: bool = ANALYZER_BIGRAMS,
+        stopwords: Optional[Iterable[str]] = None,
+        filters: Sequence[Callable[[List[str]], List[str]]] = (),
+    ):
+        self.fold = fold
+        self.bigrams = bigrams
+        if stopwords is None:
+            stopwords = VI_STOPWORDS if ANALYZER_STOPWORDS else ()
+        # stopword cũng đi qua đúng bước chuẩn hoá như text
+        self.stopwords = frozenset(self._normalize(w) for w in stopwords)
+        self.filters = list(filters)
+
+    def _normalize(self, text: str) -> str:
+        text = unicodedata.normalize("NFC", text).lower()
+        if self.fold:
+            text = fold_diacritics(text)
+        return text
+
+    def analyze(self, text: str) -> List[str]:
+        if not text:
+            return []
+        syllables = _WORD_RE.findall(self._normalize(text))
+        if self.stopwords:
+            syllables = [s for s in syllables if s not in self.stopwords]
+        for f in self.filters:
+            syllables = f(syllables)
+        if self.bigrams:
+            return syllables + syllable_bigrams(syllables)
+        return syllables
+
+    __call__ = analyze
+
+
+DEFAULT_ANALYZER = Analyzer()
+
+
+@lru_cache(maxsize=ANALYZER_QUERY_CACHE)
+def analyze_query(query: str, analyzer: Analyzer = DEFAULT_ANALYZER) -> Tuple[str, ...]:
+    """Token của câu query (cache theo chuỗi query + analyzer, khách hay gõ lại cùng câu)."""
+    return tuple(analyzer.analyze(query))
@@ -0,0 +1,279 @@
+# catalog.py
+"""
+Snapshot catalog in-memory (NumPy) cho các tool đọc sách:
+find_books_by_filter, tool_compare_books, tool_get_book_detail.
+
+Catalog chỉ đổi ~1 lần/ngày (OPERATIONS.md), nên thay vì query + hydrate ORM mỗi lượt chat,
+bảng books được nạp 1 lần thành các mảng cột (giá, số trang, rating, tồn kho, mã thể loại).
+Lọc = mask vector hoá, top-k = argpartition trên thứ hạng đã sort sẵn.
+
+Bật bằng CATALOG_SNAPSHOT=1 (cần numpy). Snapshot tự nạp lại khi fingerprint của bảng books
+(số dòng + updated_at lớn nhất) thay đổi, kiểm tra mỗi CATALOG_REFRESH_SECONDS giây;
+bản mới được dựng xong mới thay thế bản cũ nên request đang chạy không bị ảnh hưởng.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from db import SessionLocal
+from models import Book, normalize_genre_code
+
+try:
+    import numpy as np
+except ImportError:  # numpy là dependency tuỳ chọn
+    np = None
+
+CATALOG_SNAPSHOT = os.getenv("CATALOG_SNAPSHOT", "0") == "1"
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "60"))
+
+
+def _float(v) -> float:
+    return float(v) if v is not None else float("nan")
+
+
+def catalog_fingerprint(db: Session) -> Tuple[Any, ...]:
+    """Giá trị đổi khi catalog đổi (thêm sách, cập nhật giá/tồn có bump updated_at)."""
+    count, last_update = db.query(func.count(Book.id), func.max(Book.updated_at)).one()
+    return (count, last_update)
+
+
+class CatalogSnapshot:
+    def __init__(self, books: List[Book], fingerprint: Tuple[Any, ...] = ()):
+        self.fingerprint = fingerprint
+        n = len(books)
+
+        self.ids: List[str] = [b.id for b in books]
+        self.pos_by_id: Dict[str, int] = {bid: i for i, bid in enumerate(self.ids)}
+
+        # ---- cột số (NaN = NULL, so sánh với NaN luôn False giống SQL) ----
+        self.price = np.array([_float(b.price_vnd) for b in books], dtype=np.float64)
+        self.pages = np.array([_float(b.pages) for b in books], dtype=np.float64)
+        self.rating = np.array([_float(b.rating_avg) for b in books], dtype=np.float64)
+        self.stock = np.array(
+            [b.stock if b.stock is not None else -1 for b in books], dtype=np.int64
+        )
+
+        # ---- mã thể loại → số nguyên ----
+        self.genre_ids: Dict[str, int] = {}
+        genre = np.full(n, -1, dtype=np.int32)
+        for i, b in enumerate(books):
+            code = b.genre_code or normalize_genre_code(b.genres_primary)
+            if code is None:
+                continue
+            genre[i] = self.genre_ids.setdefault(code, len(self.genre_ids))
+        self.genre = genre
+
+        # ---- thứ hạng theo ORDER BY rating_avg DESC, price_vnd ASC của bản SQL ----
+        # SQLite coi NULL nhỏ nhất: rating NULL xếp cuối, price NULL xếp đầu.
+        rating_key = np.where(np.isnan(self.rating), np.inf, -self.rating)
+        price_key = np.where(np.isnan(self.price), -np.inf, self.price)
+        order = np.lexsort((price_key, rating_key))
+        self.rank = np.empty(n, dtype=np.int64)
+        self.rank[order] = np.arange(n)
+
+        # ---- dữ liệu trả về (dựng sẵn, copy khi trả ra) ----
+        self.find_rows: List[Dict[str, Any]] = []
+        self.detail_rows: List[Dict[str, Any]] = []
+        for b in books:
+            rating = float(b.rating_avg) if b.rating_avg is not None else None
+            self.find_rows.append(
+                {
+                    "book_id": b.id,
+                    "title": b.title,
+                    "authors": b.authors,
+                    "genres": b.genres_primary,
+                    "pages": b.pages,
+                    "price_vnd": b.price_vnd,
+                    "stock": b.stock,
+                    "rating_avg": rating,
+                    "summary": b.short_summary,
+                }
+            )
+            self.detail_rows.append(
+                {
+                    "book_id": b.id,
+                    "title": b.title,
+                    "authors": b.authors,
+                    "genres_primary": b.genres_primary,
+                    "pages": b.pages,
+                    "price_vnd": b.price_vnd,
+                    "stock": b.stock,
+                    "rating_avg": rating,
+                    "short_summary": b.short_summary,
+                    "publisher": b.publisher,
+                    "year": b.year,
+                    "introduction": b.introduction,
+                }
+            )
+
+    @classmethod
+    def load(cls, db: Session) -> "CatalogSnapshot":
+        fingerprint = catalog_fingerprint(db)
+        return cls(db.query(Book).all(), fingerprint)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _top_k(self, mask, limit: int) -> List[int]:
+        cand = np.flatnonzero(mask)
+        if cand.size == 0:
+            return []
+        ranks = self.rank[cand]
+        if cand.size > limit:
+            part = np.argpartition(ranks, limit - 1)[:limit]
+            cand, ranks = cand[part], ranks[part]
+        return cand[np.argsort(ranks)].tolist()
+
+    def find(
+        self,
+        genre_code: Optional[str] = None,
+        budget_max: Optional[int] = None,
+        page_min: Optional[int] = None,
+        page_max: Optional[int] = None,
+        limit: int = 5,
+    ) -> List[Dict[str, Any]]:
+        """Cùng ngữ nghĩa với find_books_by_filter (limit đã được chuẩn hoá)."""
+        base = np.ones(len(self.ids), dtype=bool)
+        if budget_max is not None and budget_max > 0:
+            base &= self.price <= budget_max
+        if page_min is not None and page_min > 0:
+            base &= self.pages >= page_min
+        if page_max is not None and page_max > 0:
+            base &= self.pages <= page_max
+
+        if genre_code:
+            exact = self.genre_ids.get(genre_code)
+            idx = self._top_k(base & (self.genre == exact), limit) if exact is not None else []
+            if not idx:
+                partial = [gid for code, gid in self.genre_ids.items() if genre_code in code]
+                idx = self._top_k(base & np.isin(self.genre, partial), limit) if partial else []
+        else:
+            idx = self._top_k(base, limit)
+
+        return [dict(self.find_rows[i]) for i in idx]
+
+    def detail(self, book_id: str) -> Optional[Dict[str, Any]]:
+        i = self.pos_by_id.get(book_id)
+        return dict(self.detail_rows[i]) if i is not None else None
+
+    def compare(self, book_ids: List[str]) -> List[Dict[str, Any]]:
+        keys = ("book_id", "title", "authors", "genres_primary", "pages", "price_vnd", "rating_avg")
+        result = []
+        for bid in book_ids:
+            i = self.pos_by_id.get(bid)
+            if i is not None:
+                row = self.detail_rows[i]
+                result.append({k: row[k] for k in keys})
+        return result
+
+
+# ---------------- SNAPSHOT DÙNG CHUNG ----------------
+
+_snapshot: Optional[CatalogSnapshot] = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return CATALOG_SNAPSHOT and np is not None
+
+
+def refresh_catalog(force: bool = False) -> Optional[CatalogSnapshot]:
+    """
+    Nạp lại snapshot nếu fingerprint của bảng books đổi (hoặc force=True).
+    Bản mới dựng xong mới gán vào _snapshot (thay thế nguyên khối).
+    """
+    global _snapshot, _checked_at
+
+    with _lock:
+        # thread khác vừa kiểm tra xong trong lúc mình chờ lock
+        fresh = time.monotonic() - _checked_at <= CATALOG_REFRESH_SECONDS
+        if not force and _snapshot is not None and fresh:
+            return _snapshot
+
+        db = SessionLocal()
+        try:
+            fingerprint = catalog_fingerprint(db)
+            if force or _snapshot is None or _snapshot.fingerprint != fingerprint:
+                _snapshot = CatalogSnapshot(db.query(Book).all(), fingerprint)
+                print(f"✅ Catalog snapshot: {len(_snapshot)} sách")
+            _checked_at = time.monotonic()
+        finally:
+            db.close()
+    return _snapshot
+
+
+def get_catalog() -> Optional[CatalogSnapshot]:
+    """Snapshot hiện tại (None nếu không bật). Tự kiểm tra cập nhật theo chu kỳ."""
+    if not enabled():
+        return None
+    if _snapshot is None or time.monotonic() - _checked_at > CATALOG_REFRESH_SECONDS:
+        return refresh_catalog()
+    return _snapshot
+
+
+# ---------------- VERSION CATALOG (cho cache kết quả) ----------------
+
+_version: Optional[Tuple[Any, ...]] = None
+_version_checked_at = 0.0
+_version_lock = threading.Lock()
+
+
+def catalog_version() -> Optional[Tuple[Any, ...]]:
+    """
+    Version hiện tại của catalog (fingerprint bảng books), đọc lại từ DB tối đa
+    1 lần mỗi CATALOG_REFRESH_SECONDS giây. Bật snapshot thì dùng luôn fingerprint của snapshot.
+    """
+    global _version, _version_checked_at
+
+    snap = get_catalog()
+    if snap is not None:
+        return snap.fingerprint
+
+    if _version is not None and time.monotonic() - _version_checked_at <= CATALOG_REFRESH_SECONDS:
+        return _version
+    with _version_lock:
+        if _version is None or time.monotonic() - _version_checked_at > CATALOG_REFRESH_SECONDS:
+            db = SessionLocal()
+            try:
+                _version = catalog_fingerprint(db)
+            finally:
+                db.close()
+            _version_checked_at = time.monotonic()
+    return _version
+
+
+_genres: Optional[Tuple[Any, FrozenSet[str]]] = None
+
+
+def catalog_genres() -> FrozenSet[str]:
+    """Các genre_code đang có trong catalog; chỉ query lại khi catalog_version() đổi."""
+    global _genres
+
+    snap = get_catalog()
+    if snap is not None:
+        return frozenset(snap.genre_ids)
+
+    version = catalog_version()
+    cached = _genres
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    db = SessionLocal()
+    try:
+        rows = db.query(Book.genre_code, Book.genres_primary).distinct().all()
+    finally:
+        db.close()
+    codes = frozenset(filter(None, (code or normalize_genre_code(g) for code, g in rows)))
+    _genres = (version, codes)
+    return codes
+
+
+def invalidate_catalog() -> None:
+    """Buộc lần gọi kế tiếp kiểm tra lại catalog (vd: ngay sau khi cập nhật giá / tồn trong process)."""
+    global _checked_at, _version_checked_at
+    _checked_at = 0.0
+    _version_checked_at = 0.0
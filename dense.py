@@ -0,0 +1,307 @@
+# dense.py
+"""
+Retriever ngữ nghĩa (tuỳ chọn) chạy song song với BM25 trong search_docs:
+"sách giúp quản lý tiền" vẫn tìm được chunk nói về "tài chính cá nhân" dù không trùng chữ nào.
+
+- Embedding: model nhỏ chạy CPU (sentence-transformers), chunk được embed offline theo batch
+  bằng scripts/build_dense_index.py; lúc chạy chỉ encode câu query (có cache).
+- Lưu trữ: ma trận int8 (mỗi vector 1 scale) trong data/dense_index/, mở bằng np.load(mmap_mode="r").
+- ANN: IVF (k-means) — vector được sắp theo cụm, query chỉ quét DENSE_NPROBE cụm gần nhất.
+- Trộn với BM25 bằng reciprocal rank fusion (rrf_fuse), xem retriever.search_docs.
+
+Bật bằng DENSE_RETRIEVAL=1 (cần numpy + sentence-transformers và đã build data/dense_index/).
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import unicodedata
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy là dependency tuỳ chọn
+    np = None
+
+BASE_DIR = os.path.dirname(__file__)
+
+DENSE_RETRIEVAL = os.getenv("DENSE_RETRIEVAL", "0") == "1"
+DENSE_MODEL = os.getenv("DENSE_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+DENSE_INDEX_DIR = os.getenv("DENSE_INDEX_DIR", os.path.join(BASE_DIR, "data", "dense_index"))
+DENSE_NPROBE = int(os.getenv("DENSE_NPROBE", "8"))
+DENSE_QUERY_CACHE = int(os.getenv("DENSE_QUERY_CACHE", "4096"))
+# bao lâu (giây) kiểm tra lại data/dense_index/ một lần, build lại thì worker tự nạp bản mới
+DENSE_RELOAD_INTERVAL = float(os.getenv("DENSE_RELOAD_INTERVAL", "5"))
+
+# Reciprocal rank fusion: score = Σ 1 / (RRF_K + rank), lấy RRF_DEPTH kết quả đầu của mỗi retriever
+RRF_K = int(os.getenv("RRF_K", "60"))
+RRF_DEPTH = int(os.getenv("RRF_DEPTH", "20"))
+
+FORMAT_VERSION = 1
+# cách chuẩn hoá text trước khi embed, ghi vào meta để không trộn index cũ với query chuẩn hoá khác
+TEXT_NORMALIZATION = "nfc-lower-v1"
+
+
+# ---------------- ENCODER ----------------
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(DENSE_MODEL, device="cpu")
+    return _model
+
+
+def encode(texts: Sequence[str], batch_size: int = 64) -> "np.ndarray":
+    """Embed nhiều text (đã chuẩn hoá L2), trả float32 [n, dim]."""
+    vecs = _get_model().encode(
+        list(texts),
+        batch_size=batch_size,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=False,
+    )
+    return np.asarray(vecs, dtype=np.float32)
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hoá dùng chung cho chunk (lúc build) và câu query: NFC, gộp khoảng trắng, chữ thường."""
+    return " ".join(unicodedata.normalize("NFC", text or "").split()).lower()
+
+
+def encode_documents(texts: Sequence[str], batch_size: int = 64) -> "np.ndarray":
+    return encode([normalize_text(t) for t in texts], batch_size=batch_size)
+
+
+def encode_query(query: str) -> "np.ndarray":
+    return _encode_query(normalize_text(query))
+
+
+@lru_cache(maxsize=DENSE_QUERY_CACHE)
+def _encode_query(text: str) -> "np.ndarray":
+    vec = encode([text], batch_size=1)[0]
+    vec.setflags(write=False)  # dùng chung giữa các request qua cache
+    return vec
+
+
+# ---------------- QUANTIZE + IVF ----------------
+
+def quantize(vecs: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+    """float32 [n, dim] → (int8 [n, dim], scale float32 [n]); v ≈ q * scale."""
+    scale = np.abs(vecs).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.round(vecs / scale[:, None]).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def kmeans(vecs: "np.ndarray", n_clusters: int, iters: int = 10, seed: int = 0) -> "np.ndarray":
+    """k-means (cosine) đơn giản, seed cố định để build lặp lại ra cùng kết quả."""
+    rng = np.random.default_rng(seed)
+    centroids = vecs[rng.choice(len(vecs), n_clusters, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(vecs @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = vecs[assign == c]
+            if len(members):
+                center = members.mean(axis=0)
+                norm = np.linalg.norm(center)
+                centroids[c] = center / norm if norm else center
+    return centroids.astype(np.float32)
+
+
+class DenseIndex:
+    """Vector int8 sắp theo cụm IVF: cụm c nằm trong [list_offsets[c], list_offsets[c+1])."""
+
+    def __init__(
+        self,
+        vectors: "np.ndarray",
+        scales: "np.ndarray",
+        centroids: "np.ndarray",
+        list_offsets: "np.ndarray",
+        ids: List[str],
+        sources: List[str],
+        meta: Optional[Dict[str, Any]] = None,
+    ):
+        self.vectors = vectors
+        self.scales = scales
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.sources = np.array(sources, dtype=str)
+        self.meta = meta or {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        vecs: "np.ndarray",
+        ids: List[str],
+        sources: List[str],
+        n_lists: Optional[int] = None,
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> "DenseIndex":
+        n = len(vecs)
+        if n_lists is None:
+            n_lists = max(1, int(np.sqrt(n)))
+        n_lists = max(1, min(n_lists, n))
+        centroids = kmeans(vecs, n_lists)
+        assign = np.argmax(vecs @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        list_offsets = np.searchsorted(assign[order], np.arange(n_lists + 1)).astype(np.int64)
+        q, scales = quantize(vecs[order])
+        return cls(
+            q, scales, centroids, list_offsets,
+            [ids[i] for i in order], [sources[i] for i in order], meta,
+        )
+
+    def search(
+        self,
+        query_vec: "np.ndarray",
+        top_k: int,
+        source_prefix: Optional[str] = None,
+        nprobe: int = DENSE_NPROBE,
+    ) -> List[Tuple[str, float]]:
+        """[(doc_id, cosine ~)] top_k trong nprobe cụm gần query nhất."""
+        n_lists = len(self.centroids)
+        if not len(self.ids) or top_k <= 0:
+            return []
+        if nprobe >= n_lists:
+            lists = range(n_lists)
+        else:
+            lists = np.argpartition(-(self.centroids @ query_vec), nprobe - 1)[:nprobe]
+
+        cand = np.concatenate([
+            np.arange(self.list_offsets[c], self.list_offsets[c + 1]) for c in lists
+        ])
+        if source_prefix:
+            cand = cand[np.char.startswith(self.sources[cand], source_prefix)]
+        if cand.size == 0:
+            return []
+
+        sims = (self.vectors[cand].astype(np.float32) @ query_vec) * self.scales[cand]
+        if cand.size > top_k:
+            part = np.argpartition(-sims, top_k - 1)[:top_k]
+            cand, sims = cand[part], sims[part]
+        order = np.argsort(-sims)
+        return [(self.ids[cand[i]], float(sims[i])) for i in order]
+
+    # ---- lưu / mở ----
+
+    def save(self, path: str) -> None:
+        """Ghi vào thư mục tạm rồi đổi tên → bản đang được đọc không bị ghi dở."""
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, "vectors.npy"), self.vectors)
+        np.save(os.path.join(tmp, "scales.npy"), self.scales)
+        np.save(os.path.join(tmp, "centroids.npy"), self.centroids)
+        np.save(os.path.join(tmp, "list_offsets.npy"), self.list_offsets)
+        meta = dict(self.meta, format_version=FORMAT_VERSION, ids=self.ids, sources=self.sources.tolist())
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        old = path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str) -> "DenseIndex":
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"dense index format {meta.get('format_version')} không hỗ trợ")
+        ids = meta.pop("ids")
+        sources = meta.pop("sources")
+        return cls(
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "scales.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "centroids.npy")),
+            np.load(os.path.join(path, "list_offsets.npy")),
+            ids, sources, meta,
+        )
+
+
+# ---------------- FUSION ----------------
+
+def rrf_fuse(rankings: Iterable[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Reciprocal rank fusion: [(doc_id, score)] giảm dần, rank tính từ 1."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: -x[1])
+
+
+# ---------------- INDEX DÙNG CHUNG ----------------
+
+_dense: Optional[DenseIndex] = None
+_dense_file_id = None
+_dense_checked = 0.0
+_dense_failed = False
+_dense_lock = threading.Lock()
+
+
+def _meta_file_id(path: str):
+    """(inode, mtime, size) của meta.json — save() đổi tên cả thư mục nên build lại là đổi."""
+    try:
+        st = os.stat(os.path.join(path, "meta.json"))
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _load_dense(path: str) -> DenseIndex:
+    idx = DenseIndex.load(path)
+    if idx.meta.get("model") != DENSE_MODEL:
+        raise ValueError(f"index build bằng {idx.meta.get('model')}, DENSE_MODEL={DENSE_MODEL}")
+    if idx.meta.get("text_normalization") != TEXT_NORMALIZATION:
+        raise ValueError("index build với cách chuẩn hoá text cũ, chạy lại scripts/build_dense_index.py")
+    return idx
+
+
+def get_dense_index() -> Optional[DenseIndex]:
+    """
+    Index dense đã build (None nếu không bật / thiếu dependency / chưa build).
+    Cứ DENSE_RELOAD_INTERVAL giây xem meta.json có đổi không; build lại thì nạp bản mới,
+    bản mới lỗi thì giữ bản đang dùng.
+    """
+    global _dense, _dense_file_id, _dense_checked, _dense_failed
+    if not DENSE_RETRIEVAL or np is None or _dense_failed:
+        return None
+    if _dense_checked and time.monotonic() - _dense_checked < DENSE_RELOAD_INTERVAL:
+        return _dense
+    with _dense_lock:
+        if _dense_failed or (_dense_checked and time.monotonic() - _dense_checked < DENSE_RELOAD_INTERVAL):
+            return _dense
+        _dense_checked = time.monotonic()
+        file_id = _meta_file_id(DENSE_INDEX_DIR)
+        if file_id == _dense_file_id:
+            return _dense
+        _dense_file_id = file_id
+        try:
+            import sentence_transformers  # noqa: F401
+        except ImportError as e:
+            _dense_failed = True
+            print("⚠️ Tắt dense retrieval:", e)
+            return None
+        try:
+            idx = _load_dense(DENSE_INDEX_DIR)
+        except Exception as e:
+            print("⚠️ Không nạp được dense index:", e)
+            return _dense
+        _dense = idx
+        print(f"✅ Dense index: {len(idx)} vectors, {len(idx.centroids)} cụm IVF")
+    return _dense
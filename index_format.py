@@ -0,0 +1,479 @@
+# index_format.py
+"""
+Định dạng file nhị phân cho index BM25 của retriever (data/retriever_index.bin).
+
+Khác retriever_index.json (json.load toàn bộ lúc import, mỗi worker giữ 1 bản copy),
+file này được mở bằng mmap chỉ-đọc khi có query đầu tiên: các worker uvicorn dùng chung
+trang nhớ qua page cache của OS, chỉ phần được đọc tới mới nằm trong RAM.
+
+Bố cục (little-endian, mỗi section căn lề 8 byte):
+
+    [header 64 byte]    magic, format version, cờ analyzer, số doc/term/partition,
+                        số posting, avgdl, index version, crc32
+    [bảng section]      N_SECTIONS x (offset u64, length u64)
+    [các section]
+      doc_str_off   u64[4*n_docs+1]  offset vào doc_str: id, source, title, chunk_text của từng doc
+      doc_str       blob UTF-8
+      doc_len       u32[n_docs]      số token mỗi doc
+      part_off      u64[n_parts+1]   offset vào part_str (tên partition: "FAQ", "BOOK"...)
+      part_str      blob UTF-8
+      part_start    u32[n_parts+1]   doc thuộc partition p nằm trong [part_start[p], part_start[p+1])
+      term_off      u64[n_terms+1]   offset vào term_str, term sort theo byte UTF-8
+      term_str      blob UTF-8
+      post_off      u64[n_terms+1]   posting của term i nằm trong [post_off[i], post_off[i+1])
+      post_doc      u32[n_postings]  doc_idx (tăng dần trong từng term)
+      post_tf       u16[n_postings]
+      stopwords     blob UTF-8       stopword của analyzer lúc build (cách nhau bằng khoảng trắng)
+
+crc32 tính trên mọi byte sau header (bảng section + dữ liệu).
+"""
+import bisect
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from collections import Counter, defaultdict
+from operator import itemgetter
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from analyzer import Analyzer
+
+MAGIC = b"KLTNRIX\x00"
+FORMAT_VERSION = 1
+
+# magic, format_version, flags, n_docs, n_terms, n_parts, n_postings, avgdl, index_version, crc32
+_HEADER = struct.Struct("<8sIIIIIQdQI")
+HEADER_SIZE = 64
+
+SECTIONS = (
+    "doc_str_off", "doc_str", "doc_len",
+    "part_off", "part_str", "part_start",
+    "term_off", "term_str",
+    "post_off", "post_doc", "post_tf",
+    "stopwords",
+)
+_SECTION = struct.Struct("<QQ")
+_TABLE_SIZE = _SECTION.size * len(SECTIONS)
+
+FLAG_FOLD = 1
+FLAG_BIGRAMS = 2
+
+DOC_FIELDS = ("id", "source", "title", "chunk_text")
+
+
+class IndexFormatError(ValueError):
+    """File index hỏng / sai định dạng / sai phiên bản."""
+
+
+def partition_of(source: str) -> str:
+    # "FAQ:FAQ_1" → "FAQ", "BOOK:bk_0" → "BOOK"
+    return (source or "").split(":", 1)[0]
+
+
+def doc_text(d: Dict[str, Any]) -> str:
+    # Tiêu đề FAQ chính là câu hỏi khách hay gõ → index cả title lẫn chunk_text
+    return f"{d.get('title') or ''} {d.get('chunk_text') or ''}"
+
+
+def _analyzer_flags(analyzer: Analyzer) -> int:
+    return (FLAG_FOLD if analyzer.fold else 0) | (FLAG_BIGRAMS if analyzer.bigrams else 0)
+
+
+def _pad(f: BinaryIO) -> None:
+    rem = f.tell() % 8
+    if rem:
+        f.write(b"\x00" * (8 - rem))
+
+
+def _file_crc32(f: BinaryIO, start: int) -> int:
+    f.seek(start)
+    crc = 0
+    while True:
+        chunk = f.read(1 << 20)
+        if not chunk:
+            return crc
+        crc = zlib.crc32(chunk, crc)
+
+
+# ---------------- GHI FILE ----------------
+
+def write_index(
+    path: str,
+    docs: Iterable[Tuple[Dict[str, Any], int]],
+    postings: Iterable[Tuple[str, Sequence[int], Sequence[int]]],
+    analyzer: Analyzer,
+    version: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Ghi index ra `path` (ghi vào file tạm cùng thư mục rồi os.replace → atomic).
+
+    - docs:     (doc, doc_len) theo đúng thứ tự doc_idx, các doc cùng partition phải liền nhau
+    - postings: (term, doc_idxs, tfs) đã sort theo term (byte UTF-8), doc_idxs tăng dần
+    Hai iterable được đọc tuần tự 1 lần nên có thể là generator (build theo luồng).
+    Trả về thông tin header (n_docs, n_terms, version, checksum...).
+    """
+    if sys.byteorder != "little":
+        raise IndexFormatError("Chỉ hỗ trợ máy little-endian")
+    if version is None:
+        version = int(time.time())
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".retriever_index.", dir=directory)
+    try:
+        with os.fdopen(fd, "w+b") as out:
+            info = _write_sections(out, docs, postings, analyzer, version)
+            out.flush()
+            os.fsync(out.fileno())
+        os.chmod(tmp_path, 0o644)  # mkstemp tạo file 0600
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return info
+
+
+def _write_sections(out, docs, postings, analyzer, version) -> Dict[str, Any]:
+    out.write(b"\x00" * (HEADER_SIZE + _TABLE_SIZE))
+    table: Dict[str, Tuple[int, int]] = {}
+
+    def put(name: str, data: bytes) -> None:
+        _pad(out)
+        table[name] = (out.tell(), len(data))
+        out.write(data)
+
+    def put_spill(name: str, spill: BinaryIO) -> None:
+        _pad(out)
+        start = out.tell()
+        spill.seek(0)
+        while True:
+            chunk = spill.read(1 << 20)
+            if not chunk:
+                break
+            out.write(chunk)
+        table[name] = (start, out.tell() - start)
+
+    # ---- docs ----
+    doc_str_off = array("Q", [0])
+    doc_len = array("I")
+    part_names: List[str] = []
+    part_start = array("I")
+    total_len = 0
+    with tempfile.TemporaryFile() as doc_str:
+        for idx, (d, dl) in enumerate(docs):
+            part = partition_of(d.get("source") or "")
+            if not part_names or part_names[-1] != part:
+                if part in part_names:
+                    raise IndexFormatError(f"Doc của partition {part!r} không liền nhau")
+                part_names.append(part)
+                part_start.append(idx)
+            for field in DOC_FIELDS:
+                doc_str.write(str(d.get(field) or "").encode("utf-8"))
+                doc_str_off.append(doc_str.tell())
+            doc_len.append(dl)
+            total_len += dl
+        n_docs = len(doc_len)
+        part_start.append(n_docs)
+        put("doc_str_off", doc_str_off.tobytes())
+        put_spill("doc_str", doc_str)
+    put("doc_len", doc_len.tobytes())
+
+    part_off = array("Q", [0])
+    part_blob = bytearray()
+    for name in part_names:
+        part_blob += name.encode("utf-8")
+        part_off.append(len(part_blob))
+    put("part_off", part_off.tobytes())
+    put("part_str", bytes(part_blob))
+    put("part_start", part_start.tobytes())
+
+    # ---- postings ----
+    term_off = array("Q", [0])
+    post_off = array("Q", [0])
+    prev_term: Optional[bytes] = None
+    with tempfile.TemporaryFile() as term_str, \
+            tempfile.TemporaryFile() as post_doc, \
+            tempfile.TemporaryFile() as post_tf:
+        for term, doc_idxs, tfs in postings:
+            key = term.encode("utf-8")
+            if prev_term is not None and key <= prev_term:
+                raise IndexFormatError(f"Term chưa sort / bị trùng: {term!r}")
+            prev_term = key
+            term_str.write(key)
+            term_off.append(term_str.tell())
+            array("I", doc_idxs).tofile(post_doc)
+            array("H", (min(tf, 0xFFFF) for tf in tfs)).tofile(post_tf)
+            post_off.append(post_off[-1] + len(doc_idxs))
+        put("term_off", term_off.tobytes())
+        put_spill("term_str", term_str)
+        put("post_off", post_off.tobytes())
+        put_spill("post_doc", post_doc)
+        put_spill("post_tf", post_tf)
+
+    put("stopwords", " ".join(sorted(analyzer.stopwords)).encode("utf-8"))
+
+    # ---- bảng section + header ----
+    out.seek(HEADER_SIZE)
+    for name in SECTIONS:
+        out.write(_SECTION.pack(*table[name]))
+    out.flush()
+    checksum = _file_crc32(out, HEADER_SIZE)
+
+    n_terms = len(term_off) - 1
+    info = {
+        "format_version": FORMAT_VERSION,
+        "flags": _analyzer_flags(analyzer),
+        "n_docs": n_docs,
+        "n_terms": n_terms,
+        "n_parts": len(part_names),
+        "n_postings": post_off[-1],
+        "avgdl": (total_len / n_docs) if n_docs else 0.0,
+        "version": version,
+        "checksum": checksum,
+    }
+    out.seek(0)
+    out.write(_HEADER.pack(
+        MAGIC, FORMAT_VERSION, info["flags"], n_docs, n_terms, info["n_parts"],
+        info["n_postings"], info["avgdl"], version, checksum,
+    ))
+    return info
+
+
+def build_index_file(
+    path: str,
+    documents: List[Dict[str, Any]],
+    analyzer: Analyzer,
+    version: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Build index từ list doc trong RAM (corpus nhỏ, test).
+    Doc được gom theo partition (giữ thứ tự partition xuất hiện lần đầu).
+    """
+    first_seen: Dict[str, int] = {}
+    for i, d in enumerate(documents):
+        first_seen.setdefault(partition_of(d.get("source")), i)
+    order = sorted(range(len(documents)), key=lambda i: first_seen[partition_of(documents[i].get("source"))])
+
+    docs = []
+    postings: Dict[str, Tuple[array, array]] = {}
+    for new_idx, i in enumerate(order):
+        counts = Counter(analyzer.analyze(doc_text(documents[i])))
+        docs.append((documents[i], sum(counts.values())))
+        for term, tf in counts.items():
+            p = postings.setdefault(term, (array("I"), array("H")))
+            p[0].append(new_idx)
+            p[1].append(min(tf, 0xFFFF))
+
+    sorted_postings = (
+        (term, postings[term][0], postings[term][1])
+        for term in sorted(postings, key=lambda t: t.encode("utf-8"))
+    )
+    return write_index(path, docs, sorted_postings, analyzer, version=version)
+
+
+# ---------------- ĐỌC FILE (MMAP) ----------------
+
+class MmapIndex:
+    """
+    Index BM25 đọc thẳng từ file qua mmap (segment chính của retriever.LiveIndex).
+    Mở file chỉ đọc header + bảng section; tên partition và stopword (rất nhỏ) được decode sẵn,
+    còn lại (term, posting, text) chỉ được đọc khi query chạm tới.
+    """
+
+    def __init__(self, path: str, k1: float, b: float, verify: bool = False):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        if len(mm) < HEADER_SIZE + _TABLE_SIZE:
+            raise IndexFormatError(f"File index quá ngắn: {path}")
+
+        (magic, fmt, flags, n_docs, n_terms, n_parts, n_postings,
+         avgdl, version, checksum) = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise IndexFormatError(f"Không phải file index retriever: {path}")
+        if fmt != FORMAT_VERSION:
+            raise IndexFormatError(f"Format version {fmt} không hỗ trợ (cần {FORMAT_VERSION})")
+        if verify and zlib.crc32(mm[HEADER_SIZE:]) != checksum:
+            raise IndexFormatError(f"Sai checksum: {path}")
+
+        self.n_docs = n_docs
+        self.n_terms = n_terms
+        self.avgdl = avgdl
+        self.version = version
+        self.checksum = checksum
+
+        mv = memoryview(mm)
+        sec = {}
+        for i, name in enumerate(SECTIONS):
+            off, length = _SECTION.unpack_from(mm, HEADER_SIZE + i * _SECTION.size)
+            if off + length > len(mm):
+                raise IndexFormatError(f"Section {name} vượt quá cuối file")
+            sec[name] = mv[off: off + length]
+
+        self._doc_str_off = sec["doc_str_off"].cast("Q")
+        self._doc_str = sec["doc_str"]
+        self.doc_len = sec["doc_len"].cast("I")
+        self._term_off = sec["term_off"].cast("Q")
+        self._term_str = sec["term_str"]
+        self._post_off = sec["post_off"].cast("Q")
+        self._post_doc = sec["post_doc"].cast("I")
+        self._post_tf = sec["post_tf"].cast("H")
+
+        part_off = sec["part_off"].cast("Q")
+        part_str = bytes(sec["part_str"])
+        part_start = sec["part_start"].cast("I")
+        # [(tên, doc_start, doc_end)]
+        self.partitions = [
+            (part_str[part_off[p]: part_off[p + 1]].decode("utf-8"), part_start[p], part_start[p + 1])
+            for p in range(n_parts)
+        ]
+
+        # query phải đi qua đúng analyzer lúc build
+        self.analyzer = Analyzer(
+            fold=bool(flags & FLAG_FOLD),
+            bigrams=bool(flags & FLAG_BIGRAMS),
+            stopwords=bytes(sec["stopwords"]).decode("utf-8").split(),
+        )
+
+    # ---- tra term (binary search trên term đã sort) ----
+
+    def _term_bytes(self, i: int) -> bytes:
+        return bytes(self._term_str[self._term_off[i]: self._term_off[i + 1]])
+
+    def _find_term(self, term: str) -> int:
+        key = term.encode("utf-8")
+        lo, hi = 0, self.n_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_terms and self._term_bytes(lo) == key:
+            return lo
+        return -1
+
+    def postings(self, term: str):
+        """(doc_idxs, tfs) dạng memoryview trỏ thẳng vào file, hoặc None."""
+        i = self._find_term(term)
+        if i < 0:
+            return None
+        s, e = self._post_off[i], self._post_off[i + 1]
+        return self._post_doc[s:e], self._post_tf[s:e]
+
+    def df(self, term: str) -> int:
+        p = self.postings(term)
+        return len(p[0]) if p is not None else 0
+
+    # ---- doc ----
+
+    def doc(self, idx: int) -> Dict[str, Any]:
+        base = idx * len(DOC_FIELDS)
+        off = self._doc_str_off
+        return {
+            field: bytes(self._doc_str[off[base + j]: off[base + j + 1]]).decode("utf-8")
+            for j, field in enumerate(DOC_FIELDS)
+        }
+
+    def _field(self, idx: int, j: int) -> str:
+        base = idx * len(DOC_FIELDS) + j
+        off = self._doc_str_off
+        return bytes(self._doc_str[off[base]: off[base + 1]]).decode("utf-8")
+
+    def doc_id(self, idx: int) -> str:
+        return self._field(idx, 0)
+
+    def source(self, idx: int) -> str:
+        return self._field(idx, 1)
+
+    # ---- BM25 ----
+
+    def select_ranges(self, source_prefix: Optional[str]):
+        """
+        [(doc_start, doc_end, prefix_lọc_từng_doc | None)] cần chấm điểm.
+        - "FAQ:" / "FAQ" → cả partition FAQ, không cần lọc thêm
+        - "BOOK:bk_1"    → partition BOOK, lọc thêm theo source của từng doc
+        """
+        if not source_prefix:
+            return [(0, self.n_docs, None)]
+        ranges = []
+        for name, start, end in self.partitions:
+            part_prefix = name + ":"
+            if part_prefix.startswith(source_prefix):
+                ranges.append((start, end, None))
+            elif source_prefix.startswith(part_prefix):
+                ranges.append((start, end, source_prefix))
+        return ranges
+
+    def accumulate(
+        self,
+        scores: Dict[int, float],
+        doc_idxs,
+        tfs,
+        idf: float,
+        avgdl: float,
+        ranges,
+        skip=frozenset(),
+        source_ok: Optional[Dict[int, bool]] = None,
+    ) -> None:
+        """
+        Cộng điểm BM25 của 1 term (posting của file này) vào scores.
+        idf / avgdl truyền từ ngoài vào để LiveIndex chấm theo thống kê chung của các segment.
+        skip: doc_idx đã bị xoá (tombstone).
+        """
+        k1, b = self.k1, self.b
+        k1_plus_1 = k1 + 1
+        doc_len = self.doc_len
+        if source_ok is None:
+            source_ok = {}
+        for start, end, doc_prefix in ranges:
+            lo = bisect.bisect_left(doc_idxs, start)
+            hi = bisect.bisect_left(doc_idxs, end, lo)
+            for j in range(lo, hi):
+                d = doc_idxs[j]
+                if d in skip:
+                    continue
+                if doc_prefix is not None:
+                    ok = source_ok.get(d)
+                    if ok is None:
+                        ok = source_ok[d] = self.source(d).startswith(doc_prefix)
+                    if not ok:
+                        continue
+                tf = tfs[j]
+                norm = k1 * (1 - b + b * (doc_len[d] / avgdl if avgdl else 0.0))
+                scores[d] += idf * tf * k1_plus_1 / (tf + norm)
+
+    def search(
+        self,
+        tokens: Sequence[str],
+        top_k: int,
+        source_prefix: Optional[str] = None,
+    ) -> List[Tuple[int, float]]:
+        ranges = self.select_ranges(source_prefix)
+        if not ranges:
+            return []
+
+        scores: Dict[int, float] = defaultdict(float)
+        source_ok: Dict[int, bool] = {}
+        for t in set(tokens):
+            p = self.postings(t)
+            if p is None:
+                continue
+            doc_idxs, tfs = p
+            n = len(doc_idxs)
+            idf = math.log(1 + (self.n_docs - n + 0.5) / (n + 0.5))
+            self.accumulate(scores, doc_idxs, tfs, idf, self.avgdl, ranges, source_ok=source_ok)
+
+        if not scores:
+            return []
+        return heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
@@ -0,0 +1,337 @@
+# journal.py
+"""
+Ghi message theo lô (write-behind) thay cho mỗi save_message 1 lần SELECT + INSERT + UPDATE + commit.
+
+- turn_index được cấp ngay trong bộ nhớ (đọc last_turn_index từ DB 1 lần / conversation).
+- Message vào hàng đợi; thread nền gom lại và ghi 1 transaction: INSERT nhiều dòng vào messages
+  + UPDATE last_turn_index / updated_at của các conversation liên quan. Ghi khi đủ JOURNAL_BATCH_SIZE
+  message hoặc sau JOURNAL_FLUSH_INTERVAL giây.
+- get_last_messages gộp cả message còn trong hàng đợi (pending_messages).
+- App shutdown (hoặc thoát process) → flush nốt hàng đợi.
+
+Chế độ (MESSAGE_DURABILITY):
+- "sync"  : như cũ, save_message ghi trong transaction của request (mặc định).
+- "group" : save_message chờ tới khi lô chứa message đó commit xong (group commit: nhiều request
+            chung 1 commit, vẫn không mất message đã trả lời).
+- "async" : save_message trả về ngay; process chết trước lần flush kế tiếp thì mất các message đó.
+
+Lô ghi lỗi → ghi lại từng dòng, chỉ dòng lỗi bị giữ lại: "group" trả lỗi cho request đang chờ,
+"async" thử lại ở lần flush sau, quá JOURNAL_MAX_RETRIES lần (hoặc lúc tắt app) thì chuyển sang
+JOURNAL_DEAD_LETTER (jsonl) → 1 dòng hỏng (vd vi phạm FK) không chặn các message phía sau.
+
+turn_index cấp trong process → chỉ dùng "group" / "async" khi 1 process ghi messages.
+"""
+import atexit
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import bindparam, case, func, insert, update
+
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "sync")   # sync | group | async
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", "256"))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "0.05"))
+JOURNAL_WAIT_TIMEOUT = float(os.getenv("JOURNAL_WAIT_TIMEOUT", "10"))
+JOURNAL_MAX_RETRIES = int(os.getenv("JOURNAL_MAX_RETRIES", "10"))
+JOURNAL_DEAD_LETTER = os.getenv(
+    "JOURNAL_DEAD_LETTER", os.path.join(os.path.dirname(__file__), "data", "journal_dead_letter.jsonl")
+)
+
+
+class _Entry:
+    __slots__ = ("row", "done", "error", "attempts")
+
+    def __init__(self, row: Dict[str, Any]):
+        self.row = row
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.attempts = 0
+
+
+class MessageJournal:
+    def __init__(
+        self,
+        session_factory,
+        mode: str = MESSAGE_DURABILITY,
+        batch_size: int = JOURNAL_BATCH_SIZE,
+        flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+        max_retries: int = JOURNAL_MAX_RETRIES,
+        dead_letter_path: Optional[str] = JOURNAL_DEAD_LETTER,
+    ):
+        if mode not in ("sync", "group", "async"):
+            raise ValueError(f"MESSAGE_DURABILITY không hợp lệ: {mode}")
+        self.session_factory = session_factory
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+
+        self._lock = threading.Lock()
+        self._queue: "deque[_Entry]" = deque()
+        self._next_turn: Dict[int, int] = {}           # conversation_id → turn_index đã cấp gần nhất
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()             # 1 lần flush tại 1 thời điểm
+        self._thread: Optional[threading.Thread] = None
+        self.stats_counters = {
+            "appended": 0, "flushed": 0, "batches": 0, "failed_batches": 0, "failed_rows": 0, "dead_letter": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "sync"
+
+    # ---- ghi ----
+
+    def _last_turn_from_db(self, conversation_id: int) -> int:
+        from models import Conversation
+
+        db = self.session_factory()
+        try:
+            conv = db.get(Conversation, conversation_id)
+            if conv is None:
+                raise ValueError(f"Conversation {conversation_id} not found")
+            return conv.last_turn_index or 0
+        finally:
+            db.close()
+
+    def append(self, conversation_id: int, role: str, content: str) -> Dict[str, Any]:
+        """Cấp turn_index, đưa message vào hàng đợi. Trả dict message (kèm turn_index)."""
+        self.start()
+        if conversation_id not in self._next_turn:
+            last = self._last_turn_from_db(conversation_id)
+            with self._lock:
+                self._next_turn.setdefault(conversation_id, last)
+
+        with self._lock:
+            turn = self._next_turn[conversation_id] + 1
+            self._next_turn[conversation_id] = turn
+            entry = _Entry({
+                "conversation_id": conversation_id,
+                "role": role,
+                "content": content,
+                "turn_index": turn,
+                "created_at": datetime.utcnow(),
+            })
+            self._queue.append(entry)
+            self.stats_counters["appended"] += 1
+            full = len(self._queue) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+        if self.mode == "group":
+            if not entry.done.wait(JOURNAL_WAIT_TIMEOUT):
+                raise TimeoutError("Message journal: quá thời gian chờ ghi message")
+            if entry.error is not None:
+                raise entry.error
+        return dict(entry.row)
+
+    def pending_messages(self, conversation_id: int) -> List[Dict[str, Any]]:
+        """Message của conversation còn trong hàng đợi (chưa ghi DB)."""
+        with self._lock:
+            return [
+                {k: e.row[k] for k in ("role", "content", "turn_index")}
+                for e in self._queue
+                if e.row["conversation_id"] == conversation_id
+            ]
+
+    # ---- flush ----
+
+    def flush(self) -> int:
+        """Ghi toàn bộ hàng đợi hiện tại (theo lô batch_size). Trả số message đã ghi."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._queue[i] for i in range(min(len(self._queue), self.batch_size))]
+                if not batch:
+                    return written
+                failed: Dict[int, BaseException] = {}
+                try:
+                    self._write_batch([e.row for e in batch])
+                except Exception as e:
+                    self.stats_counters["failed_batches"] += 1
+                    print(f"⚠️ Message journal: ghi lô {len(batch)} message lỗi, ghi lại từng dòng:", e)
+                    failed = self._write_rows(batch)
+                retry = self._finish(batch, failed)
+                written += len(batch) - len(failed)
+                if retry:
+                    # dòng lỗi nằm lại đầu hàng đợi → thử lại ở lần flush sau, không lặp ngay
+                    return written
+
+    def _write_rows(self, batch: List[_Entry]) -> Dict[int, BaseException]:
+        """Ghi từng message 1 transaction. Trả {id(entry): lỗi} của các dòng không ghi được."""
+        failed = {}
+        for e in batch:
+            try:
+                self._write_batch([e.row])
+            except Exception as err:
+                failed[id(e)] = err
+        return failed
+
+    def _finish(self, batch: List[_Entry], failed: Dict[int, BaseException]) -> List[_Entry]:
+        """Bỏ lô khỏi hàng đợi; dòng lỗi còn lượt thử (async) được đặt lại đầu hàng đợi. Trả các dòng đó."""
+        retry, dead = [], []
+        for e in batch:
+            err = failed.get(id(e))
+            if err is None:
+                continue
+            e.attempts += 1
+            e.error = err
+            if self.mode == "async" and e.attempts < self.max_retries:
+                retry.append(e)
+            elif self.mode == "async":
+                dead.append(e)
+        with self._lock:
+            for _ in batch:
+                self._queue.popleft()
+            self._queue.extendleft(reversed(retry))
+            self.stats_counters["flushed"] += len(batch) - len(failed)
+            self.stats_counters["failed_rows"] += len(failed)
+            if len(failed) < len(batch):
+                self.stats_counters["batches"] += 1
+        if dead:
+            self._dead_letter(dead)
+        for e in batch:
+            if e not in retry:
+                e.done.set()   # group: request đang chờ nhận e.error (None nếu ghi được)
+        return retry
+
+    def _dead_letter(self, entries: List[_Entry]) -> None:
+        """Message không ghi được sau JOURNAL_MAX_RETRIES lần → file jsonl để xử lý tay, không mất hẳn."""
+        with self._lock:
+            self.stats_counters["dead_letter"] += len(entries)
+        print(f"❌ Message journal: bỏ {len(entries)} message không ghi được vào {self.dead_letter_path}")
+        if not self.dead_letter_path:
+            return
+        try:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+                for e in entries:
+                    f.write(json.dumps(
+                        {**e.row, "error": str(e.error), "attempts": e.attempts},
+                        ensure_ascii=False,
+                        default=str,
+                    ) + "\n")
+        except OSError as err:
+            print("❌ Message journal: không ghi được dead letter:", err)
+
+    def _write_batch(self, rows: List[Dict[str, Any]]) -> None:
+        import memory
+        from models import Conversation, Message
+
+        last_turn: Dict[int, Dict[str, Any]] = {}
+        for r in rows:
+            prev = last_turn.get(r["conversation_id"])
+            if prev is None or r["turn_index"] > prev["turn_index"]:
+                last_turn[r["conversation_id"]] = r
+
+        db = self.session_factory()
+        try:
+            # executemany: 1 câu INSERT cho cả lô
+            db.execute(insert(Message), rows)
+            table = Conversation.__table__
+            current = func.coalesce(table.c.last_turn_index, 0)
+            db.execute(
+                update(table)
+                .where(table.c.id == bindparam("conv_id"))
+                # dòng ghi lại sau khi lỗi có thể có turn nhỏ hơn turn đã ghi → không kéo lùi
+                .values(
+                    last_turn_index=case((current < bindparam("turn"), bindparam("turn")), else_=current),
+                    updated_at=bindparam("ts"),
+                ),
+                [
+                    {"conv_id": cid, "turn": r["turn_index"], "ts": r["created_at"]}
+                    for cid, r in last_turn.items()
+                ],
+            )
+            for r in rows:
+                memory.record_message(db, r)   # conversation memory nhận message khi commit xong
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    # ---- thread nền ----
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="message-journal", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Dừng thread nền và flush nốt hàng đợi (app shutdown)."""
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._queue:
+            written = self.flush()
+            print(f"✅ Message journal: flush {written} message lúc tắt")
+        with self._lock:
+            left, self._queue = list(self._queue), deque()
+        if left:
+            # còn dòng lỗi chờ thử lại: tắt app thì không thử nữa
+            self._dead_letter(left)
+
+    def forget(self, conversation_id: int) -> None:
+        """Bỏ turn_index đã cache (vd: conversation bị xoá / sửa ngoài app)."""
+        with self._lock:
+            self._next_turn.pop(conversation_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "queued": len(self._queue),
+                "conversations": len(self._next_turn),
+                **self.stats_counters,
+            }
+
+
+_journal: Optional[MessageJournal] = None
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> MessageJournal:
+    global _journal
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                from db import SessionLocal
+                _journal = MessageJournal(SessionLocal)
+                atexit.register(_journal.stop)
+    return _journal
+
+
+def journal_enabled() -> bool:
+    return MESSAGE_DURABILITY != "sync"
+
+
+def stop_journal() -> None:
+    if _journal is not None:
+        _journal.stop()
+
+
+def journal_stats() -> Dict[str, Any]:
+    """Cho /api/debug/metrics."""
+    if not journal_enabled():
+        return {"mode": "sync"}
+    return get_journal().stats()
@@ -1,16 +1,209 @@
 # llm_client.py
+import asyncio
+import json
 import os
-from typing import List, Dict, Any
-from openai import OpenAI
+from typing import List, Dict, Any, AsyncIterator, Optional
 
-LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://127.0.0.1:8001/v1")
-LLM_API_KEY = os.getenv("LLM_API_KEY", "dummy")  # vLLM thường không check key, nhưng vẫn cần chuỗi
+import httpx
+
+# Ví dụ: LLM_BASE_URL="http://localhost:8001/v1". Không có mặc định: thiếu cấu hình thì chỉ các lệnh gọi LLM
+# báo lỗi (không âm thầm gọi localhost), app vẫn chạy được các endpoint không cần LLM.
+LLM_BASE_URL = os.getenv("LLM_BASE_URL")
+LLM_API_KEY = os.getenv("LLM_API_KEY", "")  # để trống = không gửi header Authorization
 LLM_MODEL = os.getenv("LLM_MODEL", "qwen-sale-lora")
 
-client = OpenAI(
-    base_url=LLM_BASE_URL,
-    api_key=LLM_API_KEY,
-)
+# ---- Connection pool / keep-alive ----
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "1") == "1"
+
+# Số request đồng thời tối đa gửi tới LLM (vượt quá thì xếp hàng chờ)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+# ---- Timeout theo từng phase (giây) ----
+# decision: phase 1 của orchestrator, chỉ sinh JSON ngắn
+# final:    câu trả lời cho khách (phase 2, /api/chat_llm, stream)
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_POOL_TIMEOUT = float(os.getenv("LLM_POOL_TIMEOUT", "10"))
+LLM_PHASE_TIMEOUTS = {
+    "decision": float(os.getenv("LLM_TIMEOUT_DECISION", "60")),
+    "final": float(os.getenv("LLM_TIMEOUT_FINAL", "120")),
+}
+
+
+def _http2_enabled() -> bool:
+    """
+    HTTP/2 cần package `h2` (pip install "httpx[http2]").
+    Không có thì quay về HTTP/1.1 keep-alive.
+    """
+    if not LLM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("⚠️ Chưa cài h2, LLM client dùng HTTP/1.1 keep-alive.")
+        return False
+    return True
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout(phase: str = "final") -> httpx.Timeout:
+    read = LLM_PHASE_TIMEOUTS.get(phase, LLM_PHASE_TIMEOUTS["final"])
+    return httpx.Timeout(
+        read,
+        connect=LLM_CONNECT_TIMEOUT,
+        pool=LLM_POOL_TIMEOUT,
+    )
+
+
+def _url(path: str) -> str:
+    """URL đầy đủ, đọc LLM_BASE_URL lúc gọi; chưa cấu hình thì lỗi ngay tại lệnh gọi LLM."""
+    if not LLM_BASE_URL:
+        raise RuntimeError("LLM_BASE_URL chưa được cấu hình")
+    return LLM_BASE_URL.rstrip("/") + path
+
+
+def _headers() -> Dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    if LLM_API_KEY:
+        headers["Authorization"] = f"Bearer {LLM_API_KEY}"
+    return headers
+
+
+def _payload(
+    messages: List[Dict[str, str]],
+    temperature: float,
+    top_p: Optional[float] = None,
+    stream: bool = False,
+) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {
+        "model": LLM_MODEL,
+        "messages": messages,
+        "temperature": temperature,
+    }
+    if top_p is not None:
+        payload["top_p"] = top_p
+    if stream:
+        payload["stream"] = True
+    return payload
+
+
+class LLMClient:
+    """
+    Client LLM dùng chung cho cả app (1 instance / process):
+    - 1 httpx.AsyncClient với connection pool + keep-alive (+ HTTP/2 nếu có h2),
+      tạo khi app startup, đóng khi shutdown → không phải bắt tay TCP/TLS mỗi lượt chat.
+    - Semaphore giới hạn số request đồng thời tới LLM.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sem = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+    async def start(self) -> None:
+        if self._client is None:
+            if not LLM_BASE_URL:
+                print("⚠️ LLM_BASE_URL chưa được cấu hình: các endpoint gọi LLM sẽ trả lỗi.")
+            self._client = httpx.AsyncClient(
+                headers=_headers(),
+                limits=_limits(),
+                timeout=_timeout(),
+                http2=_http2_enabled(),
+            )
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        # Phòng trường hợp gọi ngoài vòng đời app (script, test)
+        if self._client is None:
+            await self.start()
+        return self._client
+
+    async def chat(
+        self,
+        messages: List[Dict[str, str]],
+        phase: str = "final",
+        temperature: float = 0.4,
+        top_p: Optional[float] = 0.9,
+    ) -> str:
+        client = await self._get_client()
+        async with self._sem:
+            resp = await client.post(
+                _url("/chat/completions"),
+                json=_payload(messages, temperature, top_p),
+                timeout=_timeout(phase),
+            )
+            resp.raise_for_status()
+            data = resp.json()
+        return data["choices"][0]["message"]["content"]
+
+    async def chat_stream(
+        self,
+        messages: List[Dict[str, str]],
+        phase: str = "final",
+        temperature: float = 0.4,
+        top_p: Optional[float] = 0.9,
+    ) -> AsyncIterator[str]:
+        """
+        Gọi với stream=True, yield từng đoạn text (delta).
+        Backend trả về dạng SSE: mỗi dòng "data: {...}", kết thúc bằng "data: [DONE]".
+        """
+        client = await self._get_client()
+        async with self._sem:
+            async with client.stream(
+                "POST",
+                _url("/chat/completions"),
+                json=_payload(messages, temperature, top_p, stream=True),
+                timeout=_timeout(phase),
+            ) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    line = line.strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
+
+
+# Instance dùng chung, main.py start/close theo lifespan của FastAPI
+llm = LLMClient()
+
+# Client đồng bộ (cho script / notebook), cùng cấu hình pool với bản async
+_sync_client: Optional[httpx.Client] = None
+
+
+def _get_sync_client() -> httpx.Client:
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = httpx.Client(
+            headers=_headers(),
+            limits=_limits(),
+            timeout=_timeout(),
+            http2=_http2_enabled(),
+        )
+    return _sync_client
 
 
 def call_llm_chat(messages: List[Dict[str, str]], temperature: float = 0.2) -> str:
@@ -18,9 +211,9 @@ def call_llm_chat(messages: List[Dict[str, str]], temperature: float = 0.2) -> s
     Gọi LLM (Qwen finetune) kiểu chat completion đơn giản.
     messages: [{role: "system"/"user"/"assistant", content: "..."}]
     """
-    resp = client.chat.completions.create(
-        model=LLM_MODEL,
-        messages=messages,
-        temperature=temperature,
+    resp = _get_sync_client().post(
+        _url("/chat/completions"),
+        json=_payload(messages, temperature),
     )
-    return resp.choices[0].message.content
+    resp.raise_for_status()
+    return resp.json()["choices"][0]["message"]["content"]
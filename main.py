@@ -1,15 +1,19 @@
 # main.py
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Callable
+from contextlib import asynccontextmanager
 import os
 import re
 import json
+import asyncio
 
-import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from sqlalchemy.orm import Session
 
+import catalog
 from sql_tools import (
     find_books_by_filter,
     start_or_get_conversation,
@@ -21,23 +25,53 @@ from sql_tools import (
     tool_get_user_profile,
     tool_add_user_fact,
 )
-from retriever import search_docs  # RAG
+from retriever import search_docs, get_index, start_background_merge, stop_background_merge  # RAG
+from llm_client import llm
+from db import get_db, run_db, db_executor, db_executor_stats
+from query_cache import cache_stats
+from response_cache import RESPONSE_CACHE, response_cache, cacheable_turn
+from router import PRE_ROUTER, pre_router, detect_genre, parse_budget
+from tool_render import render_tool_result, fit_messages
+from memory import with_summary, summary_for, memory_stats, start_summarizer, stop_summarizer
+from journal import journal_stats, stop_journal
 
 # ==========================================
 # APP & CONFIG
 # ==========================================
-app = FastAPI(title="KLTN Sales Chatbot API", version="0.1.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # LLM client (connection pool) sống cùng vòng đời app
+    await llm.start()
+    # merge delta của retriever index vào segment chính theo chu kỳ
+    start_background_merge()
+    # tóm tắt các lượt cũ của conversation dài vào last_summary
+    start_summarizer(lambda messages: llm.chat(messages, phase="final", temperature=0.2))
+    yield
+    await stop_summarizer()
+    stop_background_merge()
+    await llm.aclose()
+    db_executor.shutdown(wait=True)
+    # ghi nốt message còn trong journal (MESSAGE_DURABILITY=group/async)
+    stop_journal()
+
+
+app = FastAPI(title="KLTN Sales Chatbot API", version="0.1.0", lifespan=lifespan)
 
 # Serve static (chat-widget.css, chat-widget.js, demo.html nếu cần)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 SHOP_ID_DEFAULT = "shop_books_1"
 
+# Token cho các endpoint /api/admin/* (header X-Admin-Token). Để trống = không kiểm tra (dev).
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Orchestrator: số vòng gọi tool tối đa / lượt, số tool tối đa trong 1 vòng
+ORCHESTRATOR_MAX_STEPS = int(os.getenv("ORCHESTRATOR_MAX_STEPS", "3"))
+ORCHESTRATOR_MAX_TOOL_CALLS = int(os.getenv("ORCHESTRATOR_MAX_TOOL_CALLS", "4"))
+
 # ---- Config LLM (OpenAI-compatible) ----
-# Ví dụ: LLM_BASE_URL="http://localhost:8001/v1"
-LLM_BASE_URL = os.getenv("LLM_BASE_URL")
-LLM_API_KEY = os.getenv("LLM_API_KEY", "")
-LLM_MODEL = os.getenv("LLM_MODEL", "qwen-sale-lora")
+# LLM_BASE_URL / LLM_API_KEY / LLM_MODEL + pool, timeout: xem llm_client.py
 
 SYSTEM_SALE = (
     "Bạn là chatbot tư vấn bán sách chuyên nghiệp, nói tiếng Việt thân thiện, "
@@ -61,7 +95,17 @@ Nếu CẦN dữ liệu thật (sách, FAQ, profile...), bạn PHẢI trả về
   "params": { ... }
 }
 
+Nếu cần nhiều dữ liệu độc lập cùng lúc (vd: chi tiết nhiều cuốn, FAQ + profile), trả về:
+{
+  "tool_calls": [
+    {"tool": "<tên_tool>", "params": { ... }},
+    {"tool": "<tên_tool>", "params": { ... }}
+  ]
+}
+
 Không được thêm bất kỳ text nào bên ngoài JSON.
+Sau khi có kết quả tool (message role=tool), bạn có thể gọi tiếp tool khác nếu còn thiếu dữ liệu,
+hoặc trả lời khách luôn bằng tiếng Việt, kèm citation đúng chuẩn (vd: [CL002.price_vnd], [FAQ_1]).
 
 Nếu KHÔNG cần gọi tool (vd: trả lời chit-chat, giải thích chung chung),
 hãy trả lời trực tiếp bằng tiếng Việt, không dùng JSON.
@@ -98,6 +142,7 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     reply: str
     used_books: Optional[List[Dict[str, Any]]] = None
+    citations: Optional[List[str]] = None   # id FAQ đã dùng (nếu có)
 
 
 # --- RAG debug models ---
@@ -115,6 +160,23 @@ class SearchDocsResponseItem(BaseModel):
     score: float
 
 
+# --- Admin retriever index ---
+class IndexDoc(BaseModel):
+    id: str                  # vd: "BK_bk_50_1"
+    source: str              # vd: "BOOK:bk_50"
+    title: str = ""
+    chunk_text: str
+
+
+class IndexAddRequest(BaseModel):
+    docs: List[IndexDoc]
+
+
+class IndexDeleteRequest(BaseModel):
+    ids: List[str] = []      # id chunk
+    sources: List[str] = []  # xoá mọi chunk của 1 nguồn, vd "BOOK:bk_50"
+
+
 # ==========================================
 # HEALTHCHECK
 # ==========================================
@@ -123,11 +185,26 @@ def health():
     return {"status": "ok"}
 
 
+# ==========================================
+# METRICS
+# ==========================================
+@app.get("/api/debug/metrics")
+def api_metrics():
+    return {
+        "db_executor": db_executor_stats(),
+        "query_cache": cache_stats(),
+        "response_cache": response_cache.stats(),
+        "router": pre_router.stats(),
+        "memory": memory_stats(),
+        "message_journal": journal_stats(),
+    }
+
+
 # ==========================================
 # DEBUG: FIND BOOKS DIRECTLY
 # ==========================================
 @app.post("/api/debug/find_books")
-def api_find_books(body: FindBooksRequest):
+def api_find_books(body: FindBooksRequest, db: Session = Depends(get_db)):
     books = find_books_by_filter(
         shop_id=SHOP_ID_DEFAULT,
         genre=body.genre,
@@ -135,6 +212,7 @@ def api_find_books(body: FindBooksRequest):
         page_min=body.page_min,
         page_max=body.page_max,
         limit=body.limit,
+        db=db,
     )
     return {"items": books}
 
@@ -146,80 +224,73 @@ def api_find_books(body: FindBooksRequest):
 def api_search_docs(body: SearchDocsRequest):
     """
     Debug RAG: tìm doc (FAQ + BOOK chunks) theo từ khóa / câu hỏi.
-    Có thể filter theo source_prefix (vd: chỉ FAQ hoặc chỉ BOOK).
+    Có thể filter theo source_prefix (vd: chỉ FAQ hoặc chỉ BOOK),
+    retriever chỉ chấm điểm trong partition đó nên luôn đủ top_k nếu có.
     """
-    # Lấy nhiều hơn rồi lọc theo source_prefix
-    raw_results = search_docs(body.query, top_k=body.top_k * 3)
-
-    results = raw_results
-    if body.source_prefix:
-        results = [
-            r for r in raw_results
-            if r["source"].startswith(body.source_prefix)
-        ]
-
-    # chỉ trả top_k cuối cùng
-    results = results[: body.top_k]
-    return results
+    return search_docs(body.query, top_k=body.top_k, source_prefix=body.source_prefix)
 
 
 # ==========================================
-# UTILS: parse đơn giản genre, budget
+# ADMIN: CẬP NHẬT RETRIEVER INDEX LÚC ĐANG CHẠY
 # ==========================================
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=401, detail="Sai admin token")
 
-def _simple_parse_budget(text: str) -> Optional[int]:
-    """
-    Rút ra số tiền đơn giản, hỗ trợ cả '200k', '150.000', 'dưới 300000'.
-    Lấy SỐ LỚN NHẤT theo kiểu int (không phải string).
-    """
-    t = text.lower().replace("k", "000")
-    t = t.replace(".", "")
-    nums = re.findall(r"\d+", t)
-    if not nums:
-        return None
-    values = [int(n) for n in nums]
-    return max(values)
-
-
-def _simple_detect_genre(text: str) -> Optional[str]:
-    t = text.lower()
-
-    # --- ưu tiên detect chủ đề tài chính trước ---
-    if (
-        "tài chính" in t
-        or "quản lý tài chính" in t
-        or "tài chính cá nhân" in t
-        or "quản lý tiền" in t
-        or "quản lý tiền bạc" in t
-        or "đầu tư" in t
-        or "investment" in t
-        or "finance" in t
-    ):
-        # tuỳ bạn, có thể chọn "Self-help" cũng được
-        return "Nonfiction"
-
-    if "classic" in t or "kinh điển" in t or "văn học kinh điển" in t:
-        return "Classic"
-    if "fiction" in t or "tiểu thuyết" in t or "truyện chữ" in t or "truyện dài" in t:
-        return "Fiction"
-    if "self-help" in t or "kỹ năng sống" in t or "phát triển bản thân" in t:
-        return "Self-help"
-    if "nonfiction" in t or "phi hư cấu" in t:
-        return "Nonfiction"
-    if "trinh thám" in t:
-        return "Mystery"
-
-    return None
+
+@app.get("/api/admin/retriever", dependencies=[Depends(require_admin)])
+def api_retriever_stats():
+    return get_index().stats()
+
+
+@app.post("/api/admin/retriever/docs", dependencies=[Depends(require_admin)])
+def api_retriever_add(body: IndexAddRequest):
+    """
+    Thêm chunk mới (vd: sau quy trình "thêm sách mới" trong OPERATIONS.md).
+    Search thấy ngay; chunk trùng id với chunk đang có sẽ thay thế chunk cũ.
+    """
+    index = get_index()
+    added = index.add_docs([d.model_dump() for d in body.docs])
+    return {"added": added, **index.stats()}
+
+
+@app.post("/api/admin/retriever/delete", dependencies=[Depends(require_admin)])
+def api_retriever_delete(body: IndexDeleteRequest):
+    index = get_index()
+    deleted = index.delete_docs(ids=body.ids, sources=body.sources)
+    return {"deleted": deleted, **index.stats()}
+
+
+@app.post("/api/admin/retriever/merge", dependencies=[Depends(require_admin)])
+def api_retriever_merge():
+    """Gộp delta + tombstone vào file index chính ngay (không chờ merge nền)."""
+    index = get_index()
+    info = index.merge()
+    return {"merged": info is not None, **index.stats()}
+
+
+@app.post("/api/admin/catalog/invalidate", dependencies=[Depends(require_admin)])
+def api_catalog_invalidate():
+    """
+    Kiểm tra lại catalog ngay (vd: sau scripts/sync_price_stock.py), không chờ CATALOG_REFRESH_SECONDS.
+    Cache find_books và catalog snapshot nạp lại khi version đổi.
+    """
+    catalog.invalidate_catalog()
+    return {"catalog_version": [str(v) for v in catalog.catalog_version() or ()]}
 
 
 # ==========================================
 # RULE-BASED CHAT – /api/chat & /api/chat_rule
 # ==========================================
 
-def _rule_based_reply(shop_id: str, user_msg: str) -> (str, List[Dict[str, Any]]):
+def _rule_based_reply(
+    shop_id: str,
+    user_msg: str,
+    db: Optional[Session] = None,
+) -> (str, List[Dict[str, Any]]):
     # 1) đoán genre + budget
-    genre = _simple_detect_genre(user_msg)
-    budget_max = _simple_parse_budget(user_msg)
+    genre = detect_genre(user_msg)
+    budget_max = parse_budget(user_msg)
     if budget_max is None:
         budget_max = 200_000  # default
 
@@ -234,6 +305,7 @@ def _rule_based_reply(shop_id: str, user_msg: str) -> (str, List[Dict[str, Any]]
         page_min=page_min,
         page_max=page_max,
         limit=3,
+        db=db,
     )
 
     # 3) soạn câu trả lời
@@ -268,7 +340,7 @@ def _rule_based_reply(shop_id: str, user_msg: str) -> (str, List[Dict[str, Any]]
 
 @app.post("/api/chat", response_model=ChatResponse)
 @app.post("/api/chat_rule", response_model=ChatResponse)
-def api_chat_rule(body: ChatRequest):
+def api_chat_rule(body: ChatRequest, db: Session = Depends(get_db)):
     """
     Bản chat rule-based (không cần LLM):
     - Lưu message user vào DB.
@@ -287,16 +359,17 @@ def api_chat_rule(body: ChatRequest):
         shop_id=shop_id,
         user_id=user_id,
         session_id=session_id,
+        db=db,
     )
 
     # 2) lưu message user
-    save_message(conversation_id=conv.id, role="user", content=user_msg)
+    save_message(conversation_id=conv.id, role="user", content=user_msg, db=db)
 
     # 3) sinh reply rule-based
-    reply_text, used_books = _rule_based_reply(shop_id=shop_id, user_msg=user_msg)
+    reply_text, used_books = _rule_based_reply(shop_id=shop_id, user_msg=user_msg, db=db)
 
     # 4) lưu reply
-    save_message(conversation_id=conv.id, role="assistant", content=reply_text)
+    save_message(conversation_id=conv.id, role="assistant", content=reply_text, db=db)
 
     return ChatResponse(reply=reply_text, used_books=used_books)
 
@@ -305,75 +378,128 @@ def api_chat_rule(body: ChatRequest):
 # LLM CALL CHUNG
 # ==========================================
 
-async def call_llm(messages: List[Dict[str, str]]) -> str:
+async def call_llm(messages: List[Dict[str, str]], phase: str = "final") -> str:
     """
-    Gọi LLM OpenAI-compatible (vLLM / OpenAI / LM Studio ...).
-    Cần đặt biến môi trường:
+    Gọi LLM OpenAI-compatible (vLLM / OpenAI / LM Studio ...) qua client dùng chung.
+    phase: "decision" (phase 1 orchestrator) hoặc "final" → chọn timeout tương ứng.
+    Cấu hình qua biến môi trường, xem llm_client.py:
       - LLM_BASE_URL (vd: http://localhost:8001/v1)
       - LLM_API_KEY  (nếu không cần auth thì để "")
       - LLM_MODEL    (vd: qwen-sale-lora)
     """
-    if not LLM_BASE_URL:
-        raise RuntimeError("LLM_BASE_URL chưa được cấu hình")
+    return await llm.chat(messages, phase=phase)
 
-    headers = {"Content-Type": "application/json"}
-    if LLM_API_KEY:
-        headers["Authorization"] = f"Bearer {LLM_API_KEY}"
 
-    payload = {
-        "model": LLM_MODEL,
-        "messages": messages,
-        "temperature": 0.4,
-        "top_p": 0.9,
-    }
+async def call_llm_stream(messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+    """
+    Giống call_llm nhưng yield từng đoạn text (delta) ngay khi vLLM sinh ra,
+    thay vì chờ cả câu trả lời.
+    """
+    async for delta in llm.chat_stream(messages, phase="final"):
+        yield delta
 
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        resp = await client.post(
-            f"{LLM_BASE_URL}/chat/completions",
-            headers=headers,
-            json=payload,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
+
+def _sse(event: Dict[str, Any]) -> str:
+    """
+    Đóng gói 1 event thành format server-sent events.
+    Các loại event: "delta" (1 đoạn text), "tool" (tool vừa chạy),
+    "done" (reply đầy đủ + used_books + citations), "error".
+    """
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def _sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # tắt buffer nếu chạy sau nginx
+        },
+    )
+
+
+def _save_reply_and_commit(db: Session, conversation_id: int, content: str) -> None:
+    """
+    Lưu reply cuối của bản stream và commit luôn session của request:
+    tuỳ phiên bản FastAPI, dependency get_db có thể đã đóng trước khi stream chạy xong.
+    """
+    save_message(conversation_id=conversation_id, role="assistant", content=content, db=db)
+    db.commit()
+
+
+async def _stream_final_reply(
+    db: Session,
+    conversation_id: int,
+    messages: List[Dict[str, str]],
+    used_books: List[Dict[str, Any]],
+    on_reply: Optional[Callable[[str], None]] = None,
+    citations: Optional[List[str]] = None,
+) -> AsyncIterator[str]:
+    """
+    Stream câu trả lời final từ LLM về client, ghép lại đầy đủ
+    rồi mới save_message khi stream kết thúc (on_reply: gọi kèm reply đầy đủ sau khi lưu).
+    Event "done" mang used_books + citations giống response của bản không stream.
+    """
+    parts: List[str] = []
+    try:
+        async for delta in call_llm_stream(messages):
+            parts.append(delta)
+            yield _sse({"type": "delta", "content": delta})
+    except Exception as e:
+        print("❌ LLM stream error:", e)
+        yield _sse({"type": "error", "detail": "LLM backend error"})
+        return
+
+    reply_text = "".join(parts).strip()
+    await run_db(_save_reply_and_commit, db, conversation_id, reply_text)
+    if on_reply is not None:
+        on_reply(reply_text)
+    yield _sse({"type": "done", "reply": reply_text, "used_books": used_books, "citations": citations})
 
 # ==========================================
 # CHAT LLM THẲNG – /api/chat_llm
 # ==========================================
 
-@app.post("/api/chat_llm", response_model=ChatResponse)
-async def api_chat_llm(body: ChatRequest):
+def _prepare_chat_llm(body: ChatRequest, db: Session):
     """
-    Bản chat dùng LLM thật (không fake):
-    - Lưu message user vào DB.
-    - Lấy history 5-6 lượt gần nhất.
-    - Gọi LLM (đã fine-tune) để tư vấn trực tiếp.
-    - Lưu reply vào DB.
-    (Hiện tại chưa gắn tool-calling; khi cần, bạn có thể mở rộng.)
+    Phần chung của /api/chat_llm và /api/chat_llm_stream:
+    lưu message user + dựng messages gửi LLM từ history.
     """
-    shop_id = body.shop_id
-    user_id = body.user_id
-    session_id = body.session_id
-    user_msg = body.message
-
     # 1) conversation
     conv = start_or_get_conversation(
-        shop_id=shop_id,
-        user_id=user_id,
-        session_id=session_id,
+        shop_id=body.shop_id,
+        user_id=body.user_id,
+        session_id=body.session_id,
+        db=db,
     )
 
     # 2) lưu message user
-    save_message(conversation_id=conv.id, role="user", content=user_msg)
+    save_message(conversation_id=conv.id, role="user", content=body.message, db=db)
 
     # 3) lấy history để gửi cho LLM
-    history = get_last_messages(conversation_id=conv.id, limit=6)
+    history = get_last_messages(conversation_id=conv.id, limit=6, db=db)
 
-    messages: List[Dict[str, str]] = [{"role": "system", "content": SYSTEM_SALE}]
+    messages: List[Dict[str, str]] = [{"role": "system", "content": with_summary(SYSTEM_SALE, conv.id)}]
     for h in history:
         role = "user" if h["role"] == "user" else "assistant"
         messages.append({"role": role, "content": h["content"]})
 
+    return conv, messages
+
+
+@app.post("/api/chat_llm", response_model=ChatResponse)
+async def api_chat_llm(body: ChatRequest, db: Session = Depends(get_db)):
+    """
+    Bản chat dùng LLM thật (không fake):
+    - Lưu message user vào DB.
+    - Lấy history 5-6 lượt gần nhất.
+    - Gọi LLM (đã fine-tune) để tư vấn trực tiếp.
+    - Lưu reply vào DB.
+    (Hiện tại chưa gắn tool-calling; khi cần, bạn có thể mở rộng.)
+    """
+    conv, messages = await run_db(_prepare_chat_llm, body, db)
+
     # 4) gọi LLM
     try:
         reply_text = await call_llm(messages)
@@ -384,11 +510,22 @@ async def api_chat_llm(body: ChatRequest):
     used_books: List[Dict[str, Any]] = []  # sẽ gắn tool-calling sau
 
     # 5) lưu reply
-    save_message(conversation_id=conv.id, role="assistant", content=reply_text)
+    await run_db(save_message, conversation_id=conv.id, role="assistant", content=reply_text, db=db)
 
     return ChatResponse(reply=reply_text, used_books=used_books)
 
 
+@app.post("/api/chat_llm_stream")
+async def api_chat_llm_stream(body: ChatRequest, db: Session = Depends(get_db)):
+    """
+    Như /api/chat_llm nhưng trả về text/event-stream:
+    token được đẩy về widget ngay khi LLM sinh ra, reply đầy đủ
+    được lưu DB khi stream kết thúc.
+    """
+    conv, messages = await run_db(_prepare_chat_llm, body, db)
+    return _sse_response(_stream_final_reply(db, conv.id, messages, []))
+
+
 # ==========================================
 # ORCHESTRATOR: TOOL-CALLING – /api/chat_orchestrator
 # ==========================================
@@ -404,7 +541,90 @@ def _clean_json_block(s: str) -> str:
     return s.strip()
 
 
-def _run_tool_for_orchestrator(shop_id: str, user_id: str, tool_spec: Dict[str, Any]) -> Dict[str, Any]:
+def _parse_tool_calls(raw: str) -> List[Dict[str, Any]]:
+    """
+    Output LLM phase 1 → list tool_spec ({"tool", "params"}).
+    Nhận 1 object {"tool": ...}, {"tool_calls": [...]} hoặc list; không phải JSON tool → [].
+    """
+    try:
+        obj = json.loads(_clean_json_block(raw))
+    except Exception:
+        return []
+    if isinstance(obj, dict):
+        calls = obj.get("tool_calls") if "tool_calls" in obj else [obj]
+    else:
+        calls = obj
+    if not isinstance(calls, list):
+        return []
+    return [c for c in calls if isinstance(c, dict) and c.get("tool")][:ORCHESTRATOR_MAX_TOOL_CALLS]
+
+
+# tool chỉ đọc → chạy song song được, mỗi tool 1 session riêng
+READ_ONLY_TOOLS = {"find_books", "search_docs", "get_book_detail", "compare_books", "get_user_profile"}
+
+
+async def _run_tool_calls(
+    shop_id: str,
+    user_id: str,
+    tool_specs: List[Dict[str, Any]],
+    db: Session,
+    parallel: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Chạy 1 vòng tool, trả payload theo đúng thứ tự tool_specs.
+    - Nhiều tool, toàn tool đọc → asyncio.gather trên db_executor, mỗi tool tự mở session (db=None)
+      vì Session của request không dùng chung giữa các thread được.
+    - Còn lại (1 tool, có tool ghi, hoặc parallel=False) → chạy lần lượt trên session của request.
+    Tool lỗi không làm hỏng cả lượt: payload có "error" để LLM biết.
+    """
+    async def run_one(spec: Dict[str, Any], session: Optional[Session]) -> Dict[str, Any]:
+        try:
+            return await run_db(
+                _run_tool_for_orchestrator,
+                shop_id=shop_id,
+                user_id=user_id,
+                tool_spec=spec,
+                db=session,
+            )
+        except Exception as e:
+            print(f"❌ Tool error ({spec.get('tool')}):", e)
+            return {"tool": spec.get("tool"), "params": spec.get("params") or {}, "result": None, "error": str(e)}
+
+    fan_out = (
+        parallel
+        and len(tool_specs) > 1
+        and all((spec.get("tool") or "").strip() in READ_ONLY_TOOLS for spec in tool_specs)
+    )
+    if fan_out:
+        return list(await asyncio.gather(*(run_one(spec, None) for spec in tool_specs)))
+    return [await run_one(spec, db) for spec in tool_specs]
+
+
+def _books_from_payloads(payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """used_books của cả lượt (gộp các tool sách, bỏ trùng book_id)."""
+    books: List[Dict[str, Any]] = []
+    seen = set()
+    for payload in payloads:
+        name, result = payload["tool"], payload["result"]
+        if name in ("find_books", "compare_books") and isinstance(result, list):
+            items = result
+        elif name == "get_book_detail" and isinstance(result, dict):
+            items = [result]
+        else:
+            continue
+        for b in items:
+            if b.get("book_id") not in seen:
+                seen.add(b.get("book_id"))
+                books.append(b)
+    return books
+
+
+def _run_tool_for_orchestrator(
+    shop_id: str,
+    user_id: str,
+    tool_spec: Dict[str, Any],
+    db: Optional[Session] = None,
+) -> Dict[str, Any]:
     """
     Nhận tool_spec dạng {"tool": "...", "params": {...}}
     → Gọi đúng hàm Python backend và trả:
@@ -426,6 +646,7 @@ def _run_tool_for_orchestrator(shop_id: str, user_id: str, tool_spec: Dict[str,
             page_min=params.get("page_min"),
             page_max=params.get("page_max"),
             limit=params.get("limit", 3),
+            db=db,
         )
 
     elif name == "search_docs":
@@ -436,11 +657,11 @@ def _run_tool_for_orchestrator(shop_id: str, user_id: str, tool_spec: Dict[str,
 
     elif name == "get_book_detail":
         book_id = params.get("book_id")
-        result = tool_get_book_detail(book_id)
+        result = tool_get_book_detail(book_id, db=db)
 
     elif name == "compare_books":
         book_ids = params.get("book_ids") or []
-        result = tool_compare_books(book_ids)
+        result = tool_compare_books(book_ids, db=db)
 
     elif name == "add_user_fact":
         result = tool_add_user_fact(
@@ -449,10 +670,11 @@ def _run_tool_for_orchestrator(shop_id: str, user_id: str, tool_spec: Dict[str,
             fact_type=params.get("fact_type", ""),
             fact_value=params.get("fact_value", ""),
             confidence=params.get("confidence", 1.0),
+            db=db,
         )
 
     elif name == "get_user_profile":
-        result = tool_get_user_profile(shop_id=shop_id, user_id=user_id)
+        result = tool_get_user_profile(shop_id=shop_id, user_id=user_id, db=db)
 
     else:
         raise ValueError(f"Unknown tool: {name}")
@@ -460,101 +682,199 @@ def _run_tool_for_orchestrator(shop_id: str, user_id: str, tool_spec: Dict[str,
     return {"tool": name, "params": params, "result": result}
 
 
-@app.post("/api/chat_orchestrator", response_model=ChatResponse)
-async def api_chat_orchestrator(body: ChatRequest):
+async def _llm_decide_tool(conversation_id: int, db: Session, n_tool_msgs: int = 0):
     """
-    Flow:
-    - Lưu message user
-    - Gọi LLM phase 1: quyết định dùng tool hay trả lời luôn
-    - Nếu có tool: chạy tool, lưu message role='tool', gọi LLM phase 2 để trả lời final
+    LLM phase 1: đọc history, trả (list tool_spec, raw).
+    List rỗng nghĩa là LLM trả lời luôn, raw chính là câu trả lời.
+    n_tool_msgs > 0: đang ở vòng sau, history có kèm n_tool_msgs kết quả tool của lượt này.
     """
-    shop_id = body.shop_id
-    user_id = body.user_id
-    session_id = body.session_id
-    user_msg = body.message
-
-    # 1) conversation + lưu user message
-    conv = start_or_get_conversation(
-        shop_id=shop_id,
-        user_id=user_id,
-        session_id=session_id,
-        title_hint="Chat tư vấn sách (orchestrator)",
-    )
-    save_message(conversation_id=conv.id, role="user", content=user_msg)
-
-    # 2) lấy history để LLM hiểu ngữ cảnh
-    history = get_last_messages(conversation_id=conv.id, limit=8)
+    # lấy history để LLM hiểu ngữ cảnh
+    history = await run_db(get_last_messages, conversation_id=conversation_id, limit=8 + n_tool_msgs, db=db)
     messages_decision: List[Dict[str, str]] = [
         {
             "role": "system",
-            "content": SYSTEM_SALE + "\n\n" + SYSTEM_TOOL_CALL,
+            "content": with_summary(SYSTEM_SALE + "\n\n" + SYSTEM_TOOL_CALL, conversation_id),
         }
     ]
-    for h in history:
-        role = h["role"]
-        if role not in ("user", "assistant"):
-            # role 'tool' sẽ chỉ xuất hiện ở phase 2, nên ở đây bỏ qua hoặc map đơn giản
-            role = "user" if role == "user" else "assistant"
-        messages_decision.append({"role": role, "content": h["content"]})
-
-    # 3) Gọi LLM phase 1: quyết định tool
+    messages_decision += [{"role": h["role"], "content": h["content"]} for h in history]
+    # cắt theo role gốc để fit_messages nhận ra kết quả tool của các lượt trước
+    messages_decision = fit_messages(messages_decision)
+    for m in messages_decision:
+        if m["role"] == "tool" and n_tool_msgs:
+            # vòng sau: giữ role tool như phase 2 để LLM đọc được kết quả
+            pass
+        elif m["role"] not in ("system", "user", "assistant"):
+            # vòng đầu: role 'tool' của lượt trước chỉ là ngữ cảnh, map đơn giản
+            m["role"] = "assistant"
+
+    # Gọi LLM phase 1: quyết định tool
     try:
-        raw = await call_llm(messages_decision)
+        raw = await call_llm(messages_decision, phase="decision")
     except Exception as e:
         print("❌ LLM error (phase 1):", e)
         raise HTTPException(status_code=500, detail="LLM backend error (phase 1)")
 
     raw = raw.strip()
-    tool_spec = None
-    used_books: List[Dict[str, Any]] = []
+    # Thử parse JSON để xem có tool hay không
+    return _parse_tool_calls(raw), raw
 
-    # 4) Thử parse JSON để xem có tool hay không
-    try:
-        cleaned = _clean_json_block(raw)
-        obj = json.loads(cleaned)
-        if isinstance(obj, dict) and "tool" in obj:
-            tool_spec = obj
-    except Exception:
-        tool_spec = None
 
-    # 5) Nếu KHÔNG có tool → raw chính là câu trả lời final
-    if not tool_spec:
-        reply_text = raw
-        save_message(conversation_id=conv.id, role="assistant", content=reply_text)
-        return ChatResponse(reply=reply_text, used_books=used_books)
+def _tool_call_key(tool_spec: Dict[str, Any]) -> tuple:
+    params = json.dumps(tool_spec.get("params") or {}, sort_keys=True, ensure_ascii=False, default=str)
+    return (tool_spec.get("tool"), params)
 
-    # 6) Có tool → chạy backend
-    try:
-        tool_payload = _run_tool_for_orchestrator(
-            shop_id=shop_id,
-            user_id=user_id,
-            tool_spec=tool_spec,
-        )
-    except Exception as e:
-        print("❌ Tool error:", e)
-        raise HTTPException(status_code=500, detail=f"Tool error: {e}")
-
-    # Lưu message role="tool" (để LLM phase 2 đọc lại)
-    tool_msg_json = json.dumps(tool_payload, ensure_ascii=False)
-    save_message(conversation_id=conv.id, role="tool", content=tool_msg_json)
-
-    # Xác định used_books (nếu có)
-    name = tool_payload["tool"]
-    result = tool_payload["result"]
-    if name in ("find_books", "compare_books") and isinstance(result, list):
-        used_books = result
-    elif name == "get_book_detail" and isinstance(result, dict):
-        used_books = [result]
-
-    # 7) Phase 2: nhờ LLM soạn câu trả lời final dựa trên kết quả TOOL
-    history2 = get_last_messages(conversation_id=conv.id, limit=10)
+
+async def _orchestrator_decide(body: ChatRequest, db: Session) -> Dict[str, Any]:
+    """
+    Phần chung của /api/chat_orchestrator và /api/chat_orchestrator_stream:
+    lưu message user, chọn tool (pre-router hoặc LLM phase 1), chạy các vòng tool (nếu có).
+    Trả về dict:
+    {
+      "conv": Conversation,
+      "reply": str | None,              # có giá trị nếu LLM trả lời luôn, không cần tool
+      "tool": str | None,               # tên tool đã chạy (nhiều tool: cách nhau bởi dấu phẩy)
+      "messages_final": list | None,    # prompt cho phase 2
+      "used_books": list,
+      "citations": list | None,         # id FAQ (lượt FAQ lưu được / lấy từ response cache)
+      "cacheable": bool,                # lưu câu trả lời vào response cache được không
+      "cache_version": ...,             # version retriever index lúc bắt đầu lượt
+      "route": str,                     # "cache" | "llm" | tên router đã chọn tool ("rules", "classifier"...)
+      "steps": int                      # số vòng gọi tool
+    }
+    """
+    shop_id = body.shop_id
+    user_id = body.user_id
+    session_id = body.session_id
+    user_msg = body.message
+
+    # 1) conversation + lưu user message
+    conv = await run_db(
+        start_or_get_conversation,
+        shop_id=shop_id,
+        user_id=user_id,
+        session_id=session_id,
+        title_hint="Chat tư vấn sách (orchestrator)",
+        db=db,
+    )
+    await run_db(save_message, conversation_id=conv.id, role="user", content=user_msg, db=db)
+
+    # 1b) Câu hỏi FAQ đã có câu trả lời trong response cache → bỏ qua cả 2 lần gọi LLM
+    cache_version = get_index().version if RESPONSE_CACHE else None
+    if RESPONSE_CACHE:
+        cached = response_cache.lookup(shop_id, user_msg, version=cache_version)
+        if cached is not None:
+            pre_router.record("cache")
+            return {
+                "conv": conv,
+                "reply": cached["reply"],
+                "tool": None,
+                "messages_final": None,
+                "used_books": cached["used_books"],
+                "citations": cached["citations"],
+                "cacheable": False,
+                "cache_version": cache_version,
+                "route": "cache",
+                "steps": 0,
+            }
+
+    # Chỉ lượt đầu của conversation (chưa có history, chưa có tóm tắt) mới được lưu response cache:
+    # prompt các lượt sau chứa history riêng của khách → câu trả lời có thể mang thông tin cá nhân
+    fresh_turn = False
+    if RESPONSE_CACHE:
+        history = await run_db(get_last_messages, conversation_id=conv.id, limit=2, db=db)
+        fresh_turn = len(history) == 1 and summary_for(conv.id) is None
+
+    # 2) Pre-router: câu đoán chắc được tool (rule / classifier) → bỏ qua LLM phase 1
+    routed = pre_router.route(user_msg) if PRE_ROUTER else None
+    if routed is not None:
+        route = routed["path"]
+        tool_calls, raw = [routed["tool_spec"]], None
+    else:
+        route = "llm"
+        tool_calls, raw = await _llm_decide_tool(conv.id, db)
+    pre_router.record(route)
+
+    # 3) Nếu KHÔNG có tool → raw chính là câu trả lời final
+    if not tool_calls:
+        return {
+            "conv": conv,
+            "reply": raw,
+            "tool": None,
+            "messages_final": None,
+            "used_books": [],
+            "citations": None,
+            "cacheable": False,
+            "cache_version": cache_version,
+            "route": route,
+            "steps": 0,
+        }
+
+    # 4) Vòng gọi tool: chạy tool (song song nếu được) → LLM đọc kết quả, gọi tiếp hoặc trả lời,
+    #    tối đa ORCHESTRATOR_MAX_STEPS vòng. Tool do pre-router chọn chỉ chạy 1 vòng.
+    payloads: List[Dict[str, Any]] = []
+    wrote = False   # đã có tool ghi trong lượt → các vòng sau chạy lần lượt trên session của request
+    reply = None
+    steps = 0
+    seen_calls: set = set()
+    while tool_calls:
+        # LLM gọi lại đúng tool + params đã chạy trong lượt → bỏ; vòng nào toàn gọi lặp thì dừng, sang phase 2
+        new_calls = []
+        for call in tool_calls:
+            key = _tool_call_key(call)
+            if key not in seen_calls:
+                seen_calls.add(key)
+                new_calls.append(call)
+        if not new_calls:
+            break
+        tool_calls = new_calls
+        steps += 1
+        step_payloads = await _run_tool_calls(shop_id, user_id, tool_calls, db, parallel=not wrote)
+        wrote = wrote or any(p["tool"] not in READ_ONLY_TOOLS for p in step_payloads)
+        # Lưu message role="tool" (để LLM vòng sau / phase 2 đọc lại), dạng gọn theo ngân sách token
+        for payload in step_payloads:
+            await run_db(
+                save_message, conversation_id=conv.id, role="tool", content=render_tool_result(payload), db=db
+            )
+        payloads.extend(step_payloads)
+
+        if route != "llm" or steps >= ORCHESTRATOR_MAX_STEPS:
+            break
+        tool_calls, raw = await _llm_decide_tool(conv.id, db, n_tool_msgs=len(payloads))
+        if not tool_calls:
+            reply = raw
+
+    names = ",".join(dict.fromkeys(p["tool"] for p in payloads))
+    used_books = _books_from_payloads(payloads)
+    # chỉ lượt toàn search_docs FAQ mới lưu response cache được
+    citations = cacheable_turn(payloads) if RESPONSE_CACHE else None
+
+    # LLM đã trả lời sau khi đọc kết quả tool → không cần phase 2
+    if reply is not None:
+        return {
+            "conv": conv,
+            "reply": reply,
+            "tool": names,
+            "messages_final": None,
+            "used_books": used_books,
+            "citations": citations,
+            "cacheable": fresh_turn and citations is not None,
+            "cache_version": cache_version,
+            "route": route,
+            "steps": steps,
+        }
+
+    # 5) Dựng prompt phase 2: LLM soạn câu trả lời final dựa trên kết quả TOOL
+    history2 = await run_db(get_last_messages, conversation_id=conv.id, limit=9 + len(payloads), db=db)
     messages_final: List[Dict[str, str]] = [
         {
             "role": "system",
-            "content": SYSTEM_SALE
-            + "\n\nBạn vừa gọi một TOOL. Các message role=tool bên dưới chứa JSON kết quả. "
-              "Hãy dùng dữ liệu đó để trả lời khách bằng tiếng Việt thân thiện, kèm citation "
-              "đúng chuẩn (vd: [CL002.price_vnd], [FAQ_1]).",
+            "content": with_summary(
+                SYSTEM_SALE
+                + "\n\nBạn vừa gọi TOOL. Các message role=tool bên dưới chứa kết quả (dạng bảng). "
+                  "Hãy dùng dữ liệu đó để trả lời khách bằng tiếng Việt thân thiện, kèm citation "
+                  "đúng chuẩn (vd: [CL002.price_vnd], [FAQ_1]).",
+                conv.id,
+            ),
         }
     ]
     for h in history2:
@@ -562,14 +882,99 @@ async def api_chat_orchestrator(body: ChatRequest):
         if role not in ("user", "assistant", "tool"):
             role = "user" if role == "user" else "assistant"
         messages_final.append({"role": role, "content": h["content"]})
+    messages_final = fit_messages(messages_final)
+
+    return {
+        "conv": conv,
+        "reply": None,
+        "tool": names,
+        "messages_final": messages_final,
+        "used_books": used_books,
+        "citations": citations,
+        "cacheable": fresh_turn and citations is not None,
+        "cache_version": cache_version,
+        "route": route,
+        "steps": steps,
+    }
+
+
+def _remember_reply(body: ChatRequest, decision: Dict[str, Any], reply: str) -> None:
+    """Lưu câu trả lời phase 2 của lượt FAQ vào response cache (nếu lượt đó lưu được)."""
+    if not decision["cacheable"] or decision["tool"] is None:
+        return
+    response_cache.store(
+        body.shop_id,
+        body.message,
+        reply,
+        used_books=decision["used_books"],
+        citations=decision["citations"],
+        version=decision["cache_version"],
+    )
+
+
+@app.post("/api/chat_orchestrator", response_model=ChatResponse)
+async def api_chat_orchestrator(body: ChatRequest, db: Session = Depends(get_db)):
+    """
+    Flow:
+    - Lưu message user
+    - Gọi LLM phase 1 (hoặc pre-router): quyết định dùng tool hay trả lời luôn
+    - Nếu có tool: chạy tool (nhiều tool độc lập chạy song song), lưu message role='tool',
+      LLM đọc kết quả rồi gọi tiếp tool hoặc trả lời (tối đa ORCHESTRATOR_MAX_STEPS vòng)
+    - Hết vòng mà chưa có câu trả lời (hoặc tool do pre-router chọn) → LLM phase 2 trả lời final
+    """
+    decision = await _orchestrator_decide(body, db)
+    conv = decision["conv"]
+    used_books = decision["used_books"]
+
+    if decision["reply"] is not None:
+        reply_text = decision["reply"]
+        await run_db(save_message, conversation_id=conv.id, role="assistant", content=reply_text, db=db)
+        _remember_reply(body, decision, reply_text)
+        return ChatResponse(reply=reply_text, used_books=used_books, citations=decision["citations"])
 
     try:
-        final_reply = await call_llm(messages_final)
+        final_reply = await call_llm(decision["messages_final"])
     except Exception as e:
         print("❌ LLM error (phase 2):", e)
         raise HTTPException(status_code=500, detail="LLM backend error (phase 2)")
 
     final_reply = final_reply.strip()
-    save_message(conversation_id=conv.id, role="assistant", content=final_reply)
+    await run_db(save_message, conversation_id=conv.id, role="assistant", content=final_reply, db=db)
+    _remember_reply(body, decision, final_reply)
 
-    return ChatResponse(reply=final_reply, used_books=used_books)
+    return ChatResponse(reply=final_reply, used_books=used_books, citations=decision["citations"])
+
+
+@app.post("/api/chat_orchestrator_stream")
+async def api_chat_orchestrator_stream(body: ChatRequest, db: Session = Depends(get_db)):
+    """
+    Như /api/chat_orchestrator nhưng trả về text/event-stream.
+    Phase 1 (quyết định tool) và các vòng tool vẫn chạy đủ vì cần parse JSON,
+    còn phase 2 được stream từng token về widget.
+    """
+    decision = await _orchestrator_decide(body, db)
+    conv = decision["conv"]
+    used_books = decision["used_books"]
+
+    async def events() -> AsyncIterator[str]:
+        if decision["tool"] is not None:
+            yield _sse({"type": "tool", "tool": decision["tool"], "route": decision["route"], "used_books": used_books})
+
+        # LLM trả lời luôn ở phase 1 (hoặc sau khi đọc kết quả tool) → gửi 1 delta duy nhất rồi kết thúc
+        if decision["reply"] is not None:
+            reply_text = decision["reply"]
+            await run_db(_save_reply_and_commit, db, conv.id, reply_text)
+            _remember_reply(body, decision, reply_text)
+            yield _sse({"type": "delta", "content": reply_text})
+            yield _sse({
+                "type": "done", "reply": reply_text, "used_books": used_books, "citations": decision["citations"],
+            })
+            return
+
+        remember = lambda reply: _remember_reply(body, decision, reply)  # noqa: E731
+        async for ev in _stream_final_reply(
+            db, conv.id, decision["messages_final"], used_books, remember, citations=decision["citations"]
+        ):
+            yield ev
+
+    return _sse_response(events())
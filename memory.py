@@ -0,0 +1,378 @@
+# memory.py
+"""
+Bộ nhớ hội thoại trong process: history gần nhất + tóm tắt cuộc trò chuyện.
+
+- Mỗi conversation có 1 ring buffer CONV_MEMORY_SIZE message gần nhất. save_message ghi xuyên
+  vào đây (sau khi commit thành công), get_last_messages đọc từ đây thay vì query bảng messages.
+  Conversation chưa có trong bộ nhớ (mới restart, bị LRU đẩy ra) → load 1 lần từ DB.
+- Summarizer chạy nền: khi có >= SUMMARY_MIN_NEW message nằm ngoài SUMMARY_TAIL message cuối mà
+  chưa được tóm tắt, gọi LLM gộp chúng vào Conversation.last_summary.
+- Prompt = system + tóm tắt + SUMMARY_TAIL message cuối → độ dài prompt không tăng theo độ dài chat.
+
+Backend: "local" (dict trong process, mặc định) hoặc "redis" (CONV_MEMORY_BACKEND=redis + REDIS_URL,
+cần package redis; nhiều worker dùng chung). Không kết nối được Redis thì quay về local.
+Store local không thấy message do worker khác ghi → mỗi lần đọc get_last_messages so turn cuối trong
+bộ nhớ với conversations.last_turn_index (1 SELECT theo khoá chính), lệch thì load lại từ DB.
+
+Tắt bằng CONV_MEMORY=0 (đọc thẳng DB như cũ, không tóm tắt).
+"""
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+CONV_MEMORY = os.getenv("CONV_MEMORY", "1") == "1"
+CONV_MEMORY_BACKEND = os.getenv("CONV_MEMORY_BACKEND", "local")
+CONV_MEMORY_SIZE = int(os.getenv("CONV_MEMORY_SIZE", "40"))          # message / conversation
+CONV_MEMORY_MAX_CONVS = int(os.getenv("CONV_MEMORY_MAX_CONVS", "5000"))
+CONV_MEMORY_TTL = int(os.getenv("CONV_MEMORY_TTL", "86400"))         # giây, chỉ dùng cho redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+CONV_SUMMARY = os.getenv("CONV_SUMMARY", "1") == "1"
+SUMMARY_TAIL = int(os.getenv("SUMMARY_TAIL", "8"))                   # message cuối luôn giữ nguyên văn
+SUMMARY_MIN_NEW = int(os.getenv("SUMMARY_MIN_NEW", "12"))
+SUMMARY_INTERVAL = float(os.getenv("SUMMARY_INTERVAL", "30"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+SYSTEM_SUMMARY = (
+    "Bạn tóm tắt cuộc trò chuyện giữa khách và chatbot bán sách. Viết tiếng Việt, tối đa 5 câu, "
+    "chỉ giữ thông tin cần cho các lượt sau: nhu cầu, thể loại, ngân sách, sở thích / điều cần tránh "
+    "của khách, các sách (kèm mã) đã gợi ý hoặc khách quan tâm, câu hỏi còn dang dở."
+)
+
+
+# ---------------- STORE ----------------
+
+class LocalMemoryStore:
+    """Ring buffer theo conversation trong process, LRU theo số conversation."""
+
+    shared = False   # chỉ thấy message ghi trong process này
+
+    def __init__(self, size: int = CONV_MEMORY_SIZE, max_convs: int = CONV_MEMORY_MAX_CONVS):
+        self.size = size
+        self.max_convs = max_convs
+        self._convs: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._dirty: set = set()
+        self._lock = threading.Lock()
+
+    def is_loaded(self, cid: int) -> bool:
+        with self._lock:
+            return cid in self._convs
+
+    def load(self, cid: int, msgs: List[Dict[str, Any]], summary: Optional[str], summary_upto: int) -> None:
+        with self._lock:
+            self._convs[cid] = {
+                "msgs": deque(msgs[-self.size:], maxlen=self.size),
+                "summary": summary,
+                "summary_upto": summary_upto,
+            }
+            self._convs.move_to_end(cid)
+            while len(self._convs) > self.max_convs:
+                old, _ = self._convs.popitem(last=False)
+                self._dirty.discard(old)
+
+    def append(self, cid: int, msg: Dict[str, Any]) -> None:
+        """Chỉ ghi vào conversation đã load (chưa load → lần đọc sau tự load từ DB, đã có message này)."""
+        with self._lock:
+            conv = self._convs.get(cid)
+            if conv is None:
+                return
+            msgs = conv["msgs"]
+            if msgs and msgs[-1]["turn_index"] >= msg["turn_index"]:
+                # 2 request cùng conversation commit lệch thứ tự → chèn lại cho đúng turn_index
+                items = [m for m in msgs if m["turn_index"] != msg["turn_index"]] + [msg]
+                items.sort(key=lambda m: m["turn_index"])
+                msgs.clear()
+                msgs.extend(items[-self.size:])
+            else:
+                msgs.append(msg)
+            self._convs.move_to_end(cid)
+            self._dirty.add(cid)
+
+    def tail(self, cid: int, n: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            conv = self._convs.get(cid)
+            if conv is None or n <= 0:
+                return []
+            self._convs.move_to_end(cid)
+            return [dict(m) for m in list(conv["msgs"])[-n:]]
+
+    def get_summary(self, cid: int) -> Tuple[Optional[str], int]:
+        with self._lock:
+            conv = self._convs.get(cid)
+            return (conv["summary"], conv["summary_upto"]) if conv else (None, 0)
+
+    def set_summary(self, cid: int, summary: str, summary_upto: int) -> None:
+        with self._lock:
+            conv = self._convs.get(cid)
+            if conv is not None:
+                conv["summary"], conv["summary_upto"] = summary, summary_upto
+
+    def pop_dirty(self) -> List[int]:
+        with self._lock:
+            dirty, self._dirty = list(self._dirty), set()
+            return dirty
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "local",
+                "conversations": len(self._convs),
+                "messages": sum(len(c["msgs"]) for c in self._convs.values()),
+                "dirty": len(self._dirty),
+            }
+
+
+class RedisMemoryStore:
+    """Cùng interface với LocalMemoryStore, dữ liệu nằm trên Redis (dùng chung giữa các worker)."""
+
+    PREFIX = "kltn:conv:"
+    shared = True
+
+    def __init__(self, client, size: int = CONV_MEMORY_SIZE, ttl: int = CONV_MEMORY_TTL):
+        self.r = client
+        self.size = size
+        self.ttl = ttl
+
+    def _k(self, cid: int, part: str) -> str:
+        return f"{self.PREFIX}{cid}:{part}"
+
+    def is_loaded(self, cid: int) -> bool:
+        return bool(self.r.exists(self._k(cid, "meta")))
+
+    def load(self, cid: int, msgs: List[Dict[str, Any]], summary: Optional[str], summary_upto: int) -> None:
+        pipe = self.r.pipeline()
+        pipe.delete(self._k(cid, "msgs"))
+        if msgs:
+            pipe.rpush(self._k(cid, "msgs"), *[json.dumps(m, ensure_ascii=False) for m in msgs[-self.size:]])
+        pipe.hset(self._k(cid, "meta"), mapping={"summary": summary or "", "summary_upto": summary_upto})
+        pipe.expire(self._k(cid, "msgs"), self.ttl)
+        pipe.expire(self._k(cid, "meta"), self.ttl)
+        pipe.execute()
+
+    def append(self, cid: int, msg: Dict[str, Any]) -> None:
+        if not self.is_loaded(cid):
+            return
+        pipe = self.r.pipeline()
+        pipe.rpush(self._k(cid, "msgs"), json.dumps(msg, ensure_ascii=False))
+        pipe.ltrim(self._k(cid, "msgs"), -self.size, -1)
+        pipe.expire(self._k(cid, "msgs"), self.ttl)
+        pipe.expire(self._k(cid, "meta"), self.ttl)
+        pipe.sadd(self.PREFIX + "dirty", cid)
+        pipe.execute()
+
+    def tail(self, cid: int, n: int) -> List[Dict[str, Any]]:
+        if n <= 0:
+            return []
+        msgs = [json.loads(m) for m in self.r.lrange(self._k(cid, "msgs"), -n, -1)]
+        return sorted(msgs, key=lambda m: m["turn_index"])
+
+    def get_summary(self, cid: int) -> Tuple[Optional[str], int]:
+        meta = self.r.hgetall(self._k(cid, "meta"))
+        if not meta:
+            return None, 0
+        summary = meta.get(b"summary", b"").decode("utf-8")
+        return summary or None, int(meta.get(b"summary_upto", 0))
+
+    def set_summary(self, cid: int, summary: str, summary_upto: int) -> None:
+        if self.is_loaded(cid):
+            self.r.hset(self._k(cid, "meta"), mapping={"summary": summary, "summary_upto": summary_upto})
+
+    def pop_dirty(self) -> List[int]:
+        pipe = self.r.pipeline()
+        pipe.smembers(self.PREFIX + "dirty")
+        pipe.delete(self.PREFIX + "dirty")
+        members, _ = pipe.execute()
+        return [int(m) for m in members]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "dirty": self.r.scard(self.PREFIX + "dirty")}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _make_store():
+    if CONV_MEMORY_BACKEND == "redis":
+        try:
+            import redis
+            client = redis.Redis.from_url(REDIS_URL)
+            client.ping()
+            print(f"✅ Conversation memory: Redis {REDIS_URL}")
+            return RedisMemoryStore(client)
+        except Exception as e:
+            print("⚠️ Không dùng được Redis cho conversation memory, dùng bộ nhớ local:", e)
+    return LocalMemoryStore()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = _make_store()
+    return _store
+
+
+def set_store(store) -> None:
+    """Thay store (test, hoặc app tự dựng store riêng)."""
+    global _store
+    _store = store
+
+
+# ---------------- GHI XUYÊN SAU COMMIT ----------------
+# save_message chỉ add vào session; message được đưa vào bộ nhớ khi session commit thành công
+# (rollback thì bỏ) → bộ nhớ không bao giờ chứa message không có trong DB.
+
+_PENDING_KEY = "memory_pending"
+
+
+def record_message(db: Session, msg: Dict[str, Any]) -> None:
+    """msg: {"conversation_id", "role", "content", "turn_index"}."""
+    if CONV_MEMORY:
+        db.info.setdefault(_PENDING_KEY, []).append(msg)
+
+
+def pending_messages(db: Optional[Session], cid: int) -> List[Dict[str, Any]]:
+    """Message đã save_message trong session này nhưng chưa commit."""
+    if db is None:
+        return []
+    return [
+        {k: m[k] for k in ("role", "content", "turn_index")}
+        for m in db.info.get(_PENDING_KEY, ())
+        if m["conversation_id"] == cid
+    ]
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_pending(session: Session) -> None:
+    pending = session.info.pop(_PENDING_KEY, None)
+    if not pending:
+        return
+    store = get_store()
+    for m in pending:
+        try:
+            store.append(m["conversation_id"], {k: m[k] for k in ("role", "content", "turn_index")})
+        except Exception as e:
+            print("⚠️ Conversation memory: ghi message lỗi:", e)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+# ---------------- PROMPT ----------------
+
+def summary_for(cid: int) -> Optional[str]:
+    if not CONV_MEMORY:
+        return None
+    summary, _ = get_store().get_summary(cid)
+    return summary
+
+
+def with_summary(system_prompt: str, cid: int) -> str:
+    """Ghép tóm tắt cuộc trò chuyện (nếu có) vào system prompt."""
+    summary = summary_for(cid)
+    if not summary:
+        return system_prompt
+    return system_prompt + "\n\nTóm tắt các lượt trước của cuộc trò chuyện:\n" + summary
+
+
+# ---------------- SUMMARIZER NỀN ----------------
+
+def _summary_input(summary: Optional[str], msgs: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    lines = [
+        f"{'Khách' if m['role'] == 'user' else 'Chatbot'}: {m['content']}"
+        for m in msgs
+        if m["role"] in ("user", "assistant")
+    ]
+    content = ""
+    if summary:
+        content += "Tóm tắt trước đó:\n" + summary + "\n\n"
+    content += "Đoạn hội thoại tiếp theo:\n" + "\n".join(lines)
+    return [{"role": "system", "content": SYSTEM_SUMMARY}, {"role": "user", "content": content}]
+
+
+def _save_summary(cid: int, summary: str) -> None:
+    from db import session_scope
+    from models import Conversation
+
+    with session_scope() as db:
+        db.query(Conversation).filter_by(id=cid).update({"last_summary": summary})
+
+
+async def summarize_conversation(cid: int, llm_chat) -> bool:
+    """
+    Gộp các message cũ (ngoài SUMMARY_TAIL message cuối) chưa tóm tắt vào last_summary.
+    llm_chat: async (messages) -> str. Trả True nếu đã cập nhật tóm tắt.
+    """
+    from db import run_db
+    from tool_render import truncate_tokens
+
+    store = get_store()
+    summary, upto = store.get_summary(cid)
+    msgs = store.tail(cid, CONV_MEMORY_SIZE)
+    older = [m for m in msgs[:-SUMMARY_TAIL] if m["turn_index"] > upto] if SUMMARY_TAIL else msgs
+    if len(older) < SUMMARY_MIN_NEW:
+        return False
+
+    new_summary = (await llm_chat(_summary_input(summary, older))).strip()
+    if not new_summary:
+        return False
+    new_summary = truncate_tokens(new_summary, SUMMARY_MAX_TOKENS)
+    await run_db(_save_summary, cid, new_summary)
+    store.set_summary(cid, new_summary, older[-1]["turn_index"])
+    return True
+
+
+_summarizer_task: Optional[asyncio.Task] = None
+_summary_stats = {"runs": 0, "summarized": 0, "failed": 0}
+
+
+async def _summarizer_loop(llm_chat) -> None:
+    while True:
+        await asyncio.sleep(SUMMARY_INTERVAL)
+        _summary_stats["runs"] += 1
+        for cid in get_store().pop_dirty():
+            try:
+                if await summarize_conversation(cid, llm_chat):
+                    _summary_stats["summarized"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _summary_stats["failed"] += 1
+                print(f"⚠️ Tóm tắt conversation {cid} lỗi:", e)
+
+
+def start_summarizer(llm_chat) -> None:
+    """Gọi trong lifespan (cần event loop đang chạy)."""
+    global _summarizer_task
+    if not (CONV_MEMORY and CONV_SUMMARY) or _summarizer_task is not None:
+        return
+    _summarizer_task = asyncio.get_running_loop().create_task(_summarizer_loop(llm_chat))
+
+
+async def stop_summarizer() -> None:
+    global _summarizer_task
+    if _summarizer_task is None:
+        return
+    _summarizer_task.cancel()
+    try:
+        await _summarizer_task
+    except asyncio.CancelledError:
+        pass
+    _summarizer_task = None
+
+
+def memory_stats() -> Dict[str, Any]:
+    """Cho /api/debug/metrics."""
+    if not CONV_MEMORY:
+        return {"enabled": False}
+    return {"enabled": True, **get_store().stats(), "summarizer": dict(_summary_stats)}
@@ -1,4 +1,5 @@
 # models.py
+import re
 from datetime import datetime
 from decimal import Decimal
 
@@ -11,17 +12,31 @@ from sqlalchemy import (
     Numeric,
     UniqueConstraint,
     ForeignKey,
+    Index,
 )
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.orm import declarative_base, relationship, validates
 
 Base = declarative_base()
 
+
+def normalize_genre_code(name):
+    """
+    Mã thể loại dùng để lọc chính xác: 'Self-help' / 'self help' / ' SELF_HELP ' → 'self-help'.
+    """
+    if name is None:
+        return None
+    code = re.sub(r"[\s_]+", "-", str(name).strip().lower())
+    return code or None
+
+
 class Book(Base):
     __tablename__ = "books"
     id = Column(String(32), primary_key=True, index=True)
     title = Column(Text, nullable=False)
     authors = Column(Text)
     genres_primary = Column(String(64))
+    # bản chuẩn hoá của genres_primary, tự cập nhật khi gán genres_primary
+    genre_code = Column(String(64))
     pages = Column(Integer)
     year = Column(Integer)
     publisher = Column(Text)
@@ -34,6 +49,27 @@ class Book(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
 
+    @validates("genres_primary")
+    def _sync_genre_code(self, key, value):
+        self.genre_code = normalize_genre_code(value)
+        return value
+
+
+# find_books_by_filter: lọc genre_code (=) rồi ORDER BY rating_avg DESC, price_vnd ASC LIMIT n
+# → đi thẳng theo thứ tự index, không phải sort cả bảng.
+Index(
+    "ix_books_genre_rating_price",
+    Book.genre_code,
+    Book.rating_avg.desc(),
+    Book.price_vnd,
+)
+# Trường hợp không lọc thể loại
+Index(
+    "ix_books_rating_price",
+    Book.rating_avg.desc(),
+    Book.price_vnd,
+)
+
 class UserProfile(Base):
     __tablename__ = "user_profiles"
     id = Column(Integer, primary_key=True, index=True)
@@ -85,6 +121,11 @@ class Conversation(Base):
 
     messages = relationship("Message", back_populates="conversation")
 
+    __table_args__ = (
+        # start_or_get_conversation tra theo (shop_id, session_id); 1 session = 1 conversation
+        UniqueConstraint("shop_id", "session_id", name="uq_conv_shop_session"),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -101,6 +142,11 @@ class Message(Base):
 
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        # get_last_messages: WHERE conversation_id = ? ORDER BY turn_index DESC LIMIT n
+        Index("ix_messages_conv_turn", "conversation_id", "turn_index"),
+    )
+
 class FAQ(Base):
     __tablename__ = "faqs"
     id = Column(String(32), primary_key=True, index=True)
@@ -0,0 +1,121 @@
+# query_cache.py
+"""
+Cache kết quả cho các tool đọc được gọi lặp lại liên tục:
+search_docs ("bao lâu nhận được hàng", "phí ship"...) và find_books_by_filter (cùng thể loại / ngân sách).
+
+- LRU có giới hạn số phần tử + TTL.
+- Mỗi entry lưu kèm "version" của dữ liệu nguồn (catalog / retriever index). Lúc đọc, version
+  hiện tại khác version lúc ghi → coi như miss, tính lại. Không cần xoá cache khi dữ liệu đổi.
+- Đếm hit / miss / stale / eviction cho /api/debug/metrics.
+
+Tắt bằng QUERY_CACHE=0.
+"""
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+QUERY_CACHE = os.getenv("QUERY_CACHE", "1") == "1"
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+
+_MISSING = object()
+
+
+class QueryCache:
+    def __init__(self, name: str, maxsize: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key → (version, hết hạn lúc, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, version: Any = None) -> Any:
+        """Trả value (bản copy) hoặc _MISSING."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return _MISSING
+            entry_version, expires_at, value = entry
+            if entry_version != version or expires_at < now:
+                del self._data[key]
+                self.stale += 1
+                self.misses += 1
+                return _MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+        # caller có thể sửa kết quả (thêm field, cắt list...) → không trả object trong cache
+        return copy.deepcopy(value)
+
+    def put(self, key: Hashable, value: Any, version: Any = None) -> None:
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (version, time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(
+        self,
+        key: Hashable,
+        version_fn: Callable[[], Any],
+        compute: Callable[[], Any],
+    ) -> Any:
+        """version_fn chỉ được gọi khi cache bật (lấy version có thể tốn 1 query)."""
+        if not QUERY_CACHE:
+            return compute()
+        version = version_fn()
+        value = self.get(key, version)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value, version)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+_registry: Dict[str, QueryCache] = {}
+
+
+def get_cache(name: str) -> QueryCache:
+    cache = _registry.get(name)
+    if cache is None:
+        cache = _registry.setdefault(name, QueryCache(name))
+    return cache
+
+
+def clear_all() -> None:
+    for cache in _registry.values():
+        cache.clear()
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Cho /api/debug/metrics."""
+    return {
+        "enabled": QUERY_CACHE,
+        **{name: cache.stats() for name, cache in _registry.items()},
+    }
@@ -0,0 +1,221 @@
+# response_cache.py
+"""
+Cache câu trả lời cuối của orchestrator cho câu hỏi kiểu FAQ ("bao lâu nhận được hàng", "phí ship"...).
+
+Câu FAQ trả lời giống nhau cho mọi khách, nhưng mỗi lượt vẫn tốn 2 lần gọi LLM (quyết định tool +
+soạn câu trả lời). Cache này trả lại luôn câu trả lời (kèm citation) của lần trước khi:
+- câu hỏi gần trùng: trùng sau khi chuẩn hoá (bỏ dấu, bỏ stopword, bỏ dấu câu), hoặc
+  embedding giống >= RESPONSE_CACHE_SIMILARITY (RESPONSE_CACHE_SEMANTIC=1, dùng encoder của dense.py)
+- cùng shop_id (mỗi shop 1 vùng cache riêng)
+- retriever index chưa đổi version (FAQ chưa bị sửa)
+
+Chỉ lưu lượt mà tool duy nhất là search_docs và toàn bộ kết quả là FAQ, và là lượt đầu của
+conversation (prompt chưa có history / tóm tắt riêng của khách). Bỏ qua (không đọc, không ghi)
+khi câu hỏi phụ thuộc ngữ cảnh hội thoại ("cuốn đó", "vậy còn"...) hoặc thông tin cá nhân ("mình thích",
+"đơn của tôi"...).
+
+Bật bằng RESPONSE_CACHE=1.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from analyzer import Analyzer, fold_diacritics
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_PER_SHOP = int(os.getenv("RESPONSE_CACHE_MAX_PER_SHOP", "256"))
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "0") == "1"
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+
+# Dấu hiệu câu hỏi dựa vào ngữ cảnh trước đó / thông tin riêng của khách (so khớp trên text đã bỏ dấu)
+_CONTEXT_MARKERS = [
+    "cuon do", "cuon nay", "quyen do", "quyen nay", "cai do", "cai nay", "sach do", "sach nay",
+    "vay con", "the con", "con cuon", "nhu tren", "o tren", "luc nay", "vua roi", "lan truoc",
+    "cuon thu", "quyen thu",
+]
+_PERSONAL_MARKERS = [
+    "toi thich", "minh thich", "em thich", "so thich", "gu cua", "cua toi", "cua minh", "cua em",
+    "don hang cua", "ma don", "don cua", "tai khoan",
+]
+_MARKER_RE = re.compile(
+    r"\b(" + "|".join(re.escape(m) for m in _CONTEXT_MARKERS + _PERSONAL_MARKERS) + r")\b"
+)
+
+# Chuẩn hoá câu hỏi làm key: bỏ dấu + stopword, không bigram
+_analyzer = Analyzer(fold=True, bigrams=False)
+
+
+def normalize_question(text: str) -> str:
+    return " ".join(_analyzer.analyze(text))
+
+
+def is_stateless(message: str) -> bool:
+    """False nếu câu hỏi có vẻ dựa vào lượt trước hoặc thông tin riêng của khách."""
+    folded = fold_diacritics((message or "").lower())
+    if _MARKER_RE.search(folded):
+        return False
+    return len(normalize_question(message).split()) >= 2
+
+
+_semantic_ok = True
+
+
+def _encode(text: str):
+    """Embedding câu hỏi qua encoder của dense.py; None nếu không dùng được."""
+    global _semantic_ok
+    if not (RESPONSE_CACHE_SEMANTIC and _semantic_ok):
+        return None
+    try:
+        import dense
+        if dense.np is None:
+            raise ImportError("numpy")
+        return dense.encode_query(text)
+    except Exception as e:
+        _semantic_ok = False
+        print("⚠️ Response cache chỉ so khớp text (không có encoder):", e)
+        return None
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        ttl: float = RESPONSE_CACHE_TTL,
+        max_per_shop: int = RESPONSE_CACHE_MAX_PER_SHOP,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+    ):
+        self.ttl = ttl
+        self.max_per_shop = max_per_shop
+        self.similarity = similarity
+        # shop_id → OrderedDict(key chuẩn hoá → entry)
+        self._shops: Dict[str, "OrderedDict[str, Dict[str, Any]]"] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stored = 0
+
+    def lookup(self, shop_id: str, message: str, version: Any = None) -> Optional[Dict[str, Any]]:
+        """Trả {"reply", "used_books", "citations"} nếu có câu trả lời dùng lại được."""
+        if not is_stateless(message):
+            with self._lock:
+                self.bypassed += 1
+            return None
+
+        key = normalize_question(message)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._shops.get(shop_id)
+            entry = entries.get(key) if entries else None
+            if entry is not None and self._valid(entry, version, now):
+                entries.move_to_end(key)
+                self.hits += 1
+                return self._result(entry)
+            candidates = [
+                (k, e) for k, e in (entries or {}).items()
+                if e.get("vec") is not None and self._valid(e, version, now)
+            ]
+
+        vec = _encode(message) if candidates else None
+        if vec is not None:
+            best_key, best_sim = None, self.similarity
+            for k, e in candidates:
+                sim = float(e["vec"] @ vec)
+                if sim >= best_sim:
+                    best_key, best_sim = k, sim
+            if best_key is not None:
+                with self._lock:
+                    entry = self._shops.get(shop_id, {}).get(best_key)
+                    if entry is not None:
+                        self.hits += 1
+                        self.semantic_hits += 1
+                        return self._result(entry)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(
+        self,
+        shop_id: str,
+        message: str,
+        reply: str,
+        used_books: Optional[List[Dict[str, Any]]] = None,
+        citations: Optional[List[str]] = None,
+        version: Any = None,
+    ) -> bool:
+        if not reply or not is_stateless(message):
+            return False
+        key = normalize_question(message)
+        entry = {
+            "reply": reply,
+            "used_books": list(used_books or []),
+            "citations": list(citations or []),
+            "version": version,
+            "expires_at": time.monotonic() + self.ttl,
+            "vec": _encode(message),
+        }
+        with self._lock:
+            entries = self._shops.setdefault(shop_id, OrderedDict())
+            entries[key] = entry
+            entries.move_to_end(key)
+            while len(entries) > self.max_per_shop:
+                entries.popitem(last=False)
+            self.stored += 1
+        return True
+
+    @staticmethod
+    def _valid(entry: Dict[str, Any], version: Any, now: float) -> bool:
+        return entry["version"] == version and entry["expires_at"] >= now
+
+    @staticmethod
+    def _result(entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "reply": entry["reply"],
+            "used_books": [dict(b) for b in entry["used_books"]],
+            "citations": list(entry["citations"]),
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._shops.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": RESPONSE_CACHE,
+                "shops": len(self._shops),
+                "size": sum(len(e) for e in self._shops.values()),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "stored": self.stored,
+            }
+
+
+response_cache = ResponseCache()
+
+
+def cacheable_turn(tool_payloads: List[Dict[str, Any]]) -> Optional[List[str]]:
+    """
+    Lượt chỉ gọi search_docs và mọi kết quả đều là FAQ → trả list citation (id FAQ), ngược lại None.
+    """
+    if not tool_payloads:
+        return None
+    citations: List[str] = []
+    for payload in tool_payloads:
+        if payload.get("tool") != "search_docs":
+            return None
+        result = payload.get("result")
+        if not isinstance(result, list) or not result:
+            return None
+        for doc in result:
+            if not str(doc.get("source", "")).startswith("FAQ:"):
+                return None
+            citations.append(doc["id"])
+    return list(dict.fromkeys(citations))
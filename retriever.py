@@ -1,75 +1,544 @@
 # retriever.py
+import bisect
+import heapq
 import json
+import math
 import os
-import re
-from collections import defaultdict
-from typing import List, Dict, Any, Tuple
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from operator import itemgetter
+from typing import List, Dict, Any, Optional, Tuple
+
+import dense
+from analyzer import DEFAULT_ANALYZER, Analyzer, analyze_query
+from index_format import MmapIndex, build_index_file, doc_text
+from query_cache import get_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock → chỉ chạy 1 worker
+    fcntl = None
 
 BASE_DIR = os.path.dirname(__file__)
 RETRIEVER_PATH = os.path.join(BASE_DIR, "data", "retriever_index.json")
+# Index nhị phân (mmap). Nếu chưa có file này thì quay về build từ retriever_index.json.
+RETRIEVER_BIN_PATH = os.getenv(
+    "RETRIEVER_BIN_PATH", os.path.join(BASE_DIR, "data", "retriever_index.bin")
+)
+# Thêm / xoá doc lúc runtime được ghi vào đây, replay khi mở index, xoá trắng sau mỗi lần merge
+RETRIEVER_DELTA_LOG = os.getenv(
+    "RETRIEVER_DELTA_LOG", os.path.join(BASE_DIR, "data", "retriever_delta.jsonl")
+)
+# Merge nền: mỗi RETRIEVER_MERGE_INTERVAL giây, nếu delta + tombstone >= RETRIEVER_MERGE_MIN_CHANGES
+RETRIEVER_MERGE_INTERVAL = float(os.getenv("RETRIEVER_MERGE_INTERVAL", "300"))
+RETRIEVER_MERGE_MIN_CHANGES = int(os.getenv("RETRIEVER_MERGE_MIN_CHANGES", "1"))
+# Mỗi worker kiểm tra thay đổi của worker khác (.bin mới, log dài thêm) tối đa 1 lần / N giây
+RETRIEVER_SYNC_INTERVAL = float(os.getenv("RETRIEVER_SYNC_INTERVAL", "1"))
+# Kiểm tra crc32 toàn file khi mở (đọc hết file → tắt mặc định để worker khởi động nhanh)
+RETRIEVER_VERIFY_CHECKSUM = os.getenv("RETRIEVER_VERIFY_CHECKSUM", "0") == "1"
+
+# Tham số BM25 chuẩn
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+
+# ----------------- INDEX SỐNG: SEGMENT CHÍNH + DELTA + TOMBSTONE -----------------
+
+class DeltaSegment:
+    """
+    Segment nhỏ trong RAM chứa doc thêm lúc runtime (chỉ append).
+    docs được append SAU posting → search chụp n_docs lúc bắt đầu là thấy đủ posting của các doc đó.
+    """
+
+    def __init__(self):
+        self.docs: List[Dict[str, Any]] = []
+        self.sources: List[str] = []
+        self.doc_len = array("I")
+        self.postings: Dict[str, Tuple[array, array]] = {}
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.docs)
 
-# ----------------- LOAD INDEX -----------------
+    def add(self, doc: Dict[str, Any], analyzer: Analyzer) -> int:
+        idx = len(self.docs)
+        counts = Counter(analyzer.analyze(doc_text(doc)))
+        for term, tf in counts.items():
+            p = self.postings.get(term)
+            if p is None:
+                p = self.postings[term] = (array("I"), array("H"))
+            p[0].append(idx)
+            p[1].append(min(tf, 0xFFFF))
+        self.doc_len.append(sum(counts.values()))
+        self.sources.append(doc.get("source") or "")
+        self.docs.append(doc)
+        return idx
 
-with open(RETRIEVER_PATH, "r", encoding="utf-8") as f:
-    _raw = json.load(f)
 
-DOCUMENTS = _raw["documents"]          # list[{id, source, title, chunk_text, tokens}]
-TERM_INDEX = _raw["term_index"]        # {token: [doc_id, ...]}
+@contextmanager
+def _file_lock(path: str, exclusive: bool):
+    """flock trên file lock dùng chung giữa các process (mỗi lần mở 1 fd riêng → khoá được cả giữa các thread)."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
-# Tạo map id -> doc để tra nhanh
-DOC_BY_ID = {d["id"]: d for d in DOCUMENTS}
-N_DOCS = len(DOCUMENTS)
 
+def _file_id(path: str) -> Tuple[int, int, int]:
+    """Đổi khi file bị thay (os.replace lúc merge → inode mới)."""
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
-def _tokenize(text: str) -> List[str]:
-    text = text.lower()
-    return re.findall(r"\w+", text)
 
+class _State:
+    """Trạng thái index tại 1 thời điểm; search đọc 1 _State duy nhất, ghi thì thay cả object."""
+    __slots__ = ("main", "delta", "deleted", "main_ids")
 
-def search_docs(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+    def __init__(self, main: MmapIndex, delta: DeltaSegment, deleted: frozenset):
+        self.main = main
+        self.delta = delta
+        self.deleted = deleted          # doc_idx toàn cục (main: [0, n_main), delta: n_main + i)
+        self.main_ids: Optional[Dict[str, List[int]]] = None
+
+
+class LiveIndex:
     """
-    Retriever rất đơn giản:
-    - tokenize query
-    - lấy các doc_id chứa những từ đó từ TERM_INDEX
-    - score = tổng (idf(term)) với idf = log(N / (1 + df))
-    - trả về top_k doc có score cao nhất
+    Index cho phép thêm / xoá doc lúc đang chạy, không cần build lại + restart:
+    - segment chính: file mmap (MmapIndex)
+    - delta: doc mới thêm (DeltaSegment), tombstone: doc bị xoá / bị thay thế
+    - merge(): ghi segment chính mới = chính + delta - tombstone, rồi đổi sang file mới
+    Điểm BM25 tính theo thống kê chung (số doc, df, avgdl) của cả 2 segment.
+    Các thay đổi được ghi vào delta log (jsonl) để sống qua restart cho tới lần merge kế tiếp.
+
+    Nhiều worker uvicorn dùng chung file .bin và delta log:
+    - thêm / xoá: ghi log dưới file lock (<bin>.lock), worker khác đọc tiếp log từ offset đã đọc (sync)
+    - merge: giữ lock độc quyền suốt lúc đọc nốt log → ghi .bin mới → xoá trắng log
+    - worker thấy .bin đổi (inode / mtime) thì mở lại file mới và đọc log từ đầu
     """
-    import math
 
-    tokens = _tokenize(query)
-    if not tokens:
-        return []
+    def __init__(self, main: MmapIndex, log_path: Optional[str] = None):
+        self.analyzer = main.analyzer
+        self.k1 = main.k1
+        self.b = main.b
+        self.log_path = log_path
+        self.lock_path = main.path + ".lock"
+        self.generation = 0
+        self.merges = 0
+        self.last_merge_at: Optional[float] = None
+        self._state = _State(main, DeltaSegment(), frozenset())
+        self._main_id = _file_id(main.path)
+        self._log_offset = 0
+        self._synced_at = time.monotonic()
+        self._write_lock = threading.RLock()
+        if log_path and os.path.exists(log_path):
+            self.sync()
+
+    # ---- thông tin ----
+
+    @property
+    def version(self) -> Tuple[int, int]:
+        """(version file index, số lần thay đổi kể từ lúc mở) → đổi mỗi khi kết quả search có thể đổi."""
+        return (self._state.main.version, self.generation)
+
+    @property
+    def n_docs(self) -> int:
+        st = self._state
+        return st.main.n_docs + st.delta.n_docs - len(st.deleted)
+
+    def stats(self) -> Dict[str, Any]:
+        st = self._state
+        return {
+            "main_version": st.main.version,
+            "main_docs": st.main.n_docs,
+            "delta_docs": st.delta.n_docs,
+            "tombstones": len(st.deleted),
+            "live_docs": self.n_docs,
+            "generation": self.generation,
+            "merges": self.merges,
+            "last_merge_at": self.last_merge_at,
+            "log_offset": self._log_offset,
+        }
+
+    # ---- search ----
+
+    def search_hits(
+        self,
+        tokens,
+        top_k: int,
+        source_prefix: Optional[str] = None,
+    ) -> List[Tuple[Dict[str, Any], float]]:
+        """Trả [(doc, score)] top_k, doc lấy cùng 1 trạng thái với lúc chấm điểm."""
+        st = self._state
+        main, delta, deleted = st.main, st.delta, st.deleted
+        n_main, n_delta = main.n_docs, delta.n_docs
+        total = n_main + n_delta
+        if not total:
+            return []
+
+        avgdl = (main.avgdl * n_main + sum(delta.doc_len[:n_delta])) / total
+        n_live = total - len(deleted)
+        ranges = main.select_ranges(source_prefix)
+        k1_plus_1 = self.k1 + 1
+        scores: Dict[int, float] = defaultdict(float)
+        source_ok: Dict[int, bool] = {}
+
+        for t in set(tokens):
+            mp = main.postings(t)
+            dp = delta.postings.get(t)
+            dp_n = bisect.bisect_left(dp[0], n_delta) if dp is not None else 0
+            df = (len(mp[0]) if mp is not None else 0) + dp_n
+            if not df:
+                continue
+            idf = math.log(1 + (n_live - df + 0.5) / (df + 0.5))
+
+            if mp is not None and ranges:
+                main.accumulate(scores, mp[0], mp[1], idf, avgdl, ranges, skip=deleted, source_ok=source_ok)
+            for j in range(dp_n):
+                local = dp[0][j]
+                d = n_main + local
+                if d in deleted:
+                    continue
+                if source_prefix and not delta.sources[local].startswith(source_prefix):
+                    continue
+                tf = dp[1][j]
+                norm = self.k1 * (1 - self.b + self.b * (delta.doc_len[local] / avgdl if avgdl else 0.0))
+                scores[d] += idf * tf * k1_plus_1 / (tf + norm)
+
+        if not scores:
+            return []
+        top = heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+        return [
+            (main.doc(d) if d < n_main else delta.docs[d - n_main], sc)
+            for d, sc in top
+        ]
+
+    def docs_by_ids(self, ids) -> Dict[str, Dict[str, Any]]:
+        """{id: doc} của các doc còn sống (vd: để lấy text cho kết quả từ dense retriever)."""
+        st = self._state
+        n_main = st.main.n_docs
+        result = {}
+        for d in self._find_live(st, ids=ids):
+            doc = st.main.doc(d) if d < n_main else st.delta.docs[d - n_main]
+            result[doc["id"]] = doc
+        return result
+
+    # ---- thêm / xoá ----
+
+    def _find_live(self, st: _State, ids=(), sources=()) -> set:
+        """doc_idx toàn cục (chưa bị xoá) có id thuộc `ids` hoặc source thuộc `sources`."""
+        ids, sources = set(ids), set(sources)
+        found = set()
+        main, n_main = st.main, st.main.n_docs
+        if ids:
+            if st.main_ids is None:
+                main_ids: Dict[str, List[int]] = defaultdict(list)
+                for i in range(n_main):
+                    main_ids[main.doc_id(i)].append(i)
+                st.main_ids = dict(main_ids)
+            for doc_id in ids:
+                found.update(st.main_ids.get(doc_id, ()))
+        if sources:
+            found.update(i for i in range(n_main) if main.source(i) in sources)
+        for j, d in enumerate(st.delta.docs):
+            if d.get("id") in ids or st.delta.sources[j] in sources:
+                found.add(n_main + j)
+        return found - st.deleted
+
+    def add_docs(self, docs: List[Dict[str, Any]]) -> int:
+        """Thêm doc (id, source, title, chunk_text). Doc trùng id với doc đang có → thay thế."""
+        docs = [
+            {k: str(d.get(k) or "") for k in ("id", "source", "title", "chunk_text")}
+            for d in docs
+            if d.get("id")
+        ]
+        if not docs:
+            return 0
+        self._write({"op": "add", "docs": docs})
+        return len(docs)
+
+    def delete_docs(self, ids=(), sources=()) -> int:
+        """Xoá theo id chunk (vd "BK_bk_1_1") hoặc theo source (vd "BOOK:bk_1" = mọi chunk của sách)."""
+        ids, sources = list(ids or ()), list(sources or ())
+        if not (ids or sources):
+            return 0
+        return self._write({"op": "delete", "ids": ids, "sources": sources})
+
+    def _write(self, entry: Dict[str, Any]) -> int:
+        # đọc nốt thay đổi của worker khác trước, rồi ghi log + áp dụng → mọi worker áp dụng cùng 1 thứ tự
+        with self._write_lock, _file_lock(self.lock_path, exclusive=True):
+            self._sync_locked()
+            changed = self._apply(entry)
+            self._append_log(entry)
+            if changed:
+                self.generation += 1
+        return changed
+
+    def _apply(self, entry: Dict[str, Any]) -> int:
+        """Áp dụng 1 thao tác của log vào trạng thái hiện tại. Trả số doc thêm / xoá."""
+        st = self._state
+        if entry.get("op") == "add":
+            docs = entry.get("docs") or []
+            replaced = self._find_live(st, ids=[d["id"] for d in docs])
+            for d in docs:
+                st.delta.add(d, self.analyzer)
+            dead, n = replaced, len(docs)
+        elif entry.get("op") == "delete":
+            dead = self._find_live(st, ids=entry.get("ids") or (), sources=entry.get("sources") or ())
+            n = len(dead)
+        else:
+            return 0
+        if n:
+            new_state = _State(st.main, st.delta, st.deleted | dead)
+            new_state.main_ids = st.main_ids
+            self._state = new_state
+        return n
+
+    # ---- đồng bộ giữa các worker ----
+
+    def maybe_sync(self) -> None:
+        """Gọi mỗi lần lấy index; tối đa 1 lần / RETRIEVER_SYNC_INTERVAL giây, chỉ stat file nếu không đổi."""
+        now = time.monotonic()
+        if now - self._synced_at < RETRIEVER_SYNC_INTERVAL:
+            return
+        self._synced_at = now
+        if _file_id(self._state.main.path) == self._main_id and self._log_size() == self._log_offset:
+            return
+        self.sync()
+
+    def sync(self) -> None:
+        """Mở lại .bin nếu worker khác đã merge, đọc tiếp delta log từ offset đã đọc."""
+        with self._write_lock, _file_lock(self.lock_path, exclusive=False):
+            self._sync_locked()
+
+    def _sync_locked(self) -> None:
+        changed = False
+        path = self._state.main.path
+        file_id = _file_id(path)
+        # .bin mới (merge) hoặc log bị xoá trắng ngoài merge → dựng lại từ file chính + log
+        if file_id != self._main_id or self._log_size() < self._log_offset:
+            main = MmapIndex(path, self.k1, self.b)
+            self._state = _State(main, DeltaSegment(), frozenset())
+            self._main_id = file_id
+            self._log_offset = 0
+            changed = True
+
+        n = 0
+        for entry in self._read_log():
+            self._apply(entry)
+            n += 1
+        if n or changed:
+            self.generation += 1
+        if changed:
+            print(f"✅ Mở lại retriever index: version {self._state.main.version}")
 
-    scores = defaultdict(float)
+    # ---- merge ----
 
-    for t in set(tokens):
-        doc_ids = TERM_INDEX.get(t)
-        if not doc_ids:
+    def merge(self, force: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Gộp delta + tombstone vào segment chính (ghi file mới, atomic) rồi đổi sang file mới.
+        Search vẫn chạy trên trạng thái cũ trong lúc merge; thêm/xoá (mọi worker) thì chờ merge xong.
+        Worker khác đã merge trước thì sync xong không còn gì để gộp → None.
+        """
+        with self._write_lock, _file_lock(self.lock_path, exclusive=True):
+            self._sync_locked()
+            st = self._state
+            if not force and not st.delta.n_docs and not st.deleted:
+                return None
+            main, n_main = st.main, st.main.n_docs
+            docs = [main.doc(i) for i in range(n_main) if i not in st.deleted]
+            docs += [d for j, d in enumerate(st.delta.docs) if n_main + j not in st.deleted]
+
+            version = max(int(time.time()), main.version + 1)
+            info = build_index_file(main.path, docs, self.analyzer, version=version)
+            new_main = MmapIndex(main.path, self.k1, self.b)
+            if self.log_path and os.path.exists(self.log_path):
+                open(self.log_path, "w").close()
+
+            self._state = _State(new_main, DeltaSegment(), frozenset())
+            self._main_id = _file_id(main.path)
+            self._log_offset = 0
+            self.generation += 1
+            self.merges += 1
+            self.last_merge_at = time.time()
+        print(f"✅ Merge retriever index: {info['n_docs']} docs, version {info['version']}")
+        return info
+
+    # ---- delta log ----
+
+    def _log_size(self) -> int:
+        if not self.log_path:
+            return 0
+        try:
+            return os.path.getsize(self.log_path)
+        except OSError:
+            return 0
+
+    def _append_log(self, entry: Dict[str, Any]) -> None:
+        """Gọi khi đang giữ lock độc quyền và đã đọc hết log (offset = cuối file)."""
+        if not self.log_path:
+            return
+        with open(self.log_path, "ab") as f:
+            f.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+            self._log_offset = f.tell()
+
+    def _read_log(self) -> List[Dict[str, Any]]:
+        """Các thao tác từ offset đã đọc tới dòng hoàn chỉnh cuối cùng; dời offset tới đó."""
+        if not self.log_path or self._log_size() <= self._log_offset:
+            return []
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1   # bỏ dòng ghi dở (crash giữa chừng)
+        self._log_offset += end
+        entries = []
+        for line in data[:end].splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+
+# ----------------- LOAD INDEX (LAZY) -----------------
+# Không load gì lúc import: index được mở ở lần search đầu tiên.
+
+_index: Optional[LiveIndex] = None
+_index_lock = threading.Lock()
+
+
+def _load_index() -> LiveIndex:
+    if not os.path.exists(RETRIEVER_BIN_PATH):
+        # nhiều worker cùng khởi động: chỉ 1 worker build, các worker còn lại chờ rồi mở file đó
+        with _file_lock(RETRIEVER_BIN_PATH + ".lock", exclusive=True):
+            if not os.path.exists(RETRIEVER_BIN_PATH):
+                print(f"⚠️ Không thấy {RETRIEVER_BIN_PATH}, build từ {RETRIEVER_PATH}")
+                with open(RETRIEVER_PATH, "r", encoding="utf-8") as f:
+                    documents = json.load(f)["documents"]   # list[{id, source, title, chunk_text, tokens}]
+                build_index_file(RETRIEVER_BIN_PATH, documents, DEFAULT_ANALYZER)
+
+    main = MmapIndex(RETRIEVER_BIN_PATH, BM25_K1, BM25_B, verify=RETRIEVER_VERIFY_CHECKSUM)
+    print(f"✅ Retriever index (mmap): {main.n_docs} docs, {main.n_terms} terms, version {main.version}")
+    return LiveIndex(main, log_path=RETRIEVER_DELTA_LOG or None)
+
+
+def get_index() -> LiveIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _load_index()
+    else:
+        _index.maybe_sync()
+    return _index
+
+
+# ----------------- MERGE NỀN -----------------
+
+_merge_stop = threading.Event()
+_merge_thread: Optional[threading.Thread] = None
+
+
+def _merge_loop() -> None:
+    while not _merge_stop.wait(RETRIEVER_MERGE_INTERVAL):
+        # chưa ai search thì chưa mở index, không có gì để merge
+        if _index is None:
             continue
-        df = len(doc_ids)
-        idf = math.log((N_DOCS + 1) / (df + 1)) + 1.0  # idf đơn giản
+        _index.maybe_sync()
+        st = _index._state
+        if st.delta.n_docs + len(st.deleted) < RETRIEVER_MERGE_MIN_CHANGES:
+            continue
+        try:
+            _index.merge()
+        except Exception as e:
+            print("❌ Lỗi merge retriever index:", e)
+
+
+def start_background_merge() -> None:
+    """Gọi khi app startup. RETRIEVER_MERGE_INTERVAL=0 → tắt merge nền (chỉ merge qua endpoint admin)."""
+    global _merge_thread
+    if RETRIEVER_MERGE_INTERVAL <= 0 or _merge_thread is not None:
+        return
+    _merge_stop.clear()
+    _merge_thread = threading.Thread(target=_merge_loop, name="retriever-merge", daemon=True)
+    _merge_thread.start()
+
+
+def stop_background_merge() -> None:
+    global _merge_thread
+    if _merge_thread is None:
+        return
+    _merge_stop.set()
+    _merge_thread.join(timeout=5)
+    _merge_thread = None
 
-        for doc_id in doc_ids:
-            scores[doc_id] += idf
 
-    if not scores:
+def _hit(d: Dict[str, Any], score: float) -> Dict[str, Any]:
+    return {
+        "id": d["id"],
+        "source": d["source"],
+        "title": d["title"],
+        "chunk_text": d["chunk_text"],
+        "score": score,
+    }
+
+
+def search_docs(
+    query: str,
+    top_k: int = 5,
+    source_prefix: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Retriever BM25:
+    - tách token query qua analyzer (NFC, bỏ dấu, stopword, bigram), có cache
+    - cộng điểm BM25 của các term trên postings (có tf + độ dài doc)
+    - source_prefix (vd "FAQ:", "BOOK:") → chỉ chấm trong partition đó
+    - trả về top_k doc có score cao nhất
+    Bật DENSE_RETRIEVAL=1 → trộn thêm kết quả embedding bằng RRF, score lúc đó là điểm RRF.
+    Kết quả được cache theo (query đã chuẩn hoá, top_k, source_prefix), hết hiệu lực khi index đổi version.
+    """
+    if top_k <= 0:
         return []
+    index = get_index()
+    dense_index = dense.get_dense_index()
 
-    # sort theo score giảm dần
-    ranked: List[Tuple[str, float]] = sorted(
-        scores.items(), key=lambda x: x[1], reverse=True
+    key = (" ".join(unicodedata.normalize("NFC", query).lower().split()), top_k, source_prefix or None)
+    return get_cache("search_docs").get_or_compute(
+        key,
+        lambda: (index.version, dense_index.meta.get("built_at") if dense_index is not None else None),
+        lambda: _search_docs(index, dense_index, query, top_k, source_prefix),
     )
 
-    top_docs = []
-    for doc_id, sc in ranked[:top_k]:
-        d = DOC_BY_ID[doc_id]
-        top_docs.append(
-            {
-                "id": d["id"],
-                "source": d["source"],
-                "title": d["title"],
-                "chunk_text": d["chunk_text"],
-                "score": sc,
-            }
-        )
-    return top_docs
+
+def _search_docs(index, dense_index, query, top_k, source_prefix) -> List[Dict[str, Any]]:
+    tokens = analyze_query(query, index.analyzer)
+
+    if dense_index is not None:
+        return _search_hybrid(index, dense_index, query, tokens, top_k, source_prefix)
+
+    if not tokens:
+        return []
+    return [_hit(d, sc) for d, sc in index.search_hits(tokens, top_k, source_prefix=source_prefix)]
+
+
+def _search_hybrid(index, dense_index, query, tokens, top_k, source_prefix) -> List[Dict[str, Any]]:
+    depth = max(top_k, dense.RRF_DEPTH)
+    lexical = index.search_hits(tokens, depth, source_prefix=source_prefix) if tokens else []
+    semantic = dense_index.search(dense.encode_query(query), depth, source_prefix=source_prefix)
+
+    docs = {d["id"]: d for d, _ in lexical}
+    fused = dense.rrf_fuse([[d["id"] for d, _ in lexical], [doc_id for doc_id, _ in semantic]])
+    # doc chỉ có ở dense: lấy text từ index (doc đã bị xoá khỏi index thì bỏ qua)
+    missing = [doc_id for doc_id, _ in fused if doc_id not in docs]
+    if missing:
+        docs.update(index.docs_by_ids(missing))
+
+    return [_hit(docs[doc_id], sc) for doc_id, sc in fused if doc_id in docs][:top_k]
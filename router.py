@@ -0,0 +1,316 @@
+# router.py
+"""
+Pre-router cho orchestrator: đoán tool ngay từ câu hỏi, bỏ qua LLM phase 1.
+
+Phase 1 tốn nguyên 1 lần gọi LLM chỉ để sinh {"tool": ..., "params": ...}, trong khi các câu
+phổ biến ("tìm sách kinh điển dưới 200k", "phí ship bao nhiêu") đã đoán được bằng rule.
+Pre-router chạy lần lượt các router đã đăng ký (rule, rồi classifier cục bộ nếu có), lấy kết quả
+có độ tin cậy cao nhất; >= ROUTER_MIN_CONFIDENCE thì dùng luôn tool_spec đó, ngược lại để LLM quyết định.
+find_books với thể loại không có trong catalog (catalog.catalog_genres) cũng để LLM quyết định.
+
+Mỗi router là hàm (message) -> {"tool_spec": {...}, "confidence": float} | None,
+đăng ký thêm bằng register_router(name, fn).
+
+Classifier (tuỳ chọn): Naive Bayes trên token của analyzer, học từ ROUTER_EXAMPLES_PATH
+(JSONL: {"text": "...", "tool": "find_books" | "search_docs" | "llm"}). Classifier chỉ chọn tool,
+params vẫn lấy bằng rule.
+
+Tắt bằng PRE_ROUTER=0.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from analyzer import Analyzer, fold_diacritics
+from catalog import catalog_genres
+from models import normalize_genre_code
+from response_cache import is_stateless
+
+BASE_DIR = os.path.dirname(__file__)
+
+PRE_ROUTER = os.getenv("PRE_ROUTER", "1") == "1"
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.85"))
+ROUTER_EXAMPLES_PATH = os.getenv(
+    "ROUTER_EXAMPLES_PATH", os.path.join(BASE_DIR, "data", "router_examples.jsonl")
+)
+
+FIND_BOOKS_LIMIT = 3
+FAQ_TOP_K = 3
+
+
+# ---------------- PARSE GENRE / BUDGET ----------------
+
+def parse_budget(text: str) -> Optional[int]:
+    """
+    Rút ra số tiền đơn giản, hỗ trợ cả '200k', '150.000', 'dưới 300000'.
+    Lấy SỐ LỚN NHẤT theo kiểu int (không phải string).
+    """
+    t = text.lower().replace("k", "000")
+    t = t.replace(".", "")
+    nums = re.findall(r"\d+", t)
+    if not nums:
+        return None
+    values = [int(n) for n in nums]
+    return max(values)
+
+
+# từ khoá → thể loại (tên như books.genres_primary, so với catalog qua normalize_genre_code).
+# Thứ tự là độ ưu tiên: "nonfiction" phải đứng trước "fiction".
+GENRE_KEYWORDS = [
+    ("Finance", ("tài chính", "quản lý tiền", "đầu tư", "investment", "finance")),
+    ("Classic", ("classic", "kinh điển")),
+    ("Self-help", ("self-help", "kỹ năng sống", "phát triển bản thân")),
+    ("Nonfiction", ("nonfiction", "phi hư cấu")),
+    ("Fiction", ("fiction", "tiểu thuyết", "truyện chữ", "truyện dài")),
+    ("Mystery", ("trinh thám",)),
+]
+
+
+def detect_genre(text: str) -> Optional[str]:
+    t = text.lower()
+    for genre, keywords in GENRE_KEYWORDS:
+        if any(k in t for k in keywords):
+            return genre
+    return None
+
+
+# Số tiền có đơn vị rõ ràng ("200k", "150.000đ", "1 triệu") — parse_budget nhận cả số trang, năm...
+_MONEY_RE = re.compile(
+    r"(\d+(?:[.,]\d{3})*|\d+(?:[.,]\d+)?)\s*(k|nghin|ngan|tr|trieu|d|vnd|dong)\b"
+)
+_MONEY_UNITS = {"k": 1_000, "nghin": 1_000, "ngan": 1_000, "tr": 1_000_000, "trieu": 1_000_000}
+
+
+def parse_money(text: str) -> Optional[int]:
+    """Số tiền lớn nhất có đơn vị trong câu (VND), None nếu không có."""
+    folded = fold_diacritics(text.lower())
+    values = []
+    for num, unit in _MONEY_RE.findall(folded):
+        mult = _MONEY_UNITS.get(unit)
+        if mult is None:  # "150.000đ": dấu chấm là phân cách hàng nghìn
+            values.append(int(re.sub(r"[.,]", "", num)))
+        else:
+            values.append(int(float(num.replace(",", ".")) * mult))
+    return max(values) if values else None
+
+
+# ---------------- ROUTER THEO RULE ----------------
+
+# so khớp trên text đã bỏ dấu
+_BOOK_SEARCH_RE = re.compile(r"\b(tim|goi y|de xuat|co sach|co cuon|co quyen|mua|kiem|recommend|sach nao|cuon nao)\b")
+_BUDGET_CUE_RE = re.compile(r"\b(duoi|tam|khoang|gia|toi da|khong qua|re|max)\b|<")
+_FAQ_RE = re.compile(
+    r"\b(phi ship|phi van chuyen|giao hang|ship|van chuyen|doi tra|tra hang|hoan tien|bao hanh"
+    r"|thanh toan|cod|chuyen khoan|bao lau|nhan duoc hang|freeship|mien phi van chuyen|chinh sach)\b"
+)
+# câu cần LLM tự chọn tool khác (so sánh, chi tiết 1 cuốn, ghi nhớ sở thích...)
+_LLM_ONLY_RE = re.compile(r"\b(so sanh|chi tiet|noi dung|tom tat|review|danh gia|nen doc cuon)\b")
+
+
+def rule_router(message: str) -> Optional[Dict[str, Any]]:
+    folded = fold_diacritics((message or "").lower())
+    if _LLM_ONLY_RE.search(folded):
+        return None
+
+    genre = detect_genre(message)
+    budget = parse_money(message)
+    wants_books = bool(_BOOK_SEARCH_RE.search(folded)) or "sach" in folded.split()
+
+    if wants_books and (genre or budget):
+        if genre and budget:
+            confidence = 0.95
+        elif genre:
+            confidence = 0.9
+        else:
+            # chỉ có giá: cần thêm từ khoá giá ("dưới", "tầm"...) mới chắc là lọc theo ngân sách
+            confidence = 0.85 if _BUDGET_CUE_RE.search(folded) else 0.6
+        return {
+            "tool_spec": {
+                "tool": "find_books",
+                "params": {"genre": genre, "budget_max": budget, "limit": FIND_BOOKS_LIMIT},
+            },
+            "confidence": confidence,
+        }
+
+    if _FAQ_RE.search(folded) and not genre:
+        return {
+            "tool_spec": {
+                "tool": "search_docs",
+                "params": {"query": message, "top_k": FAQ_TOP_K, "source_prefix": "FAQ"},
+            },
+            "confidence": 0.9,
+        }
+    return None
+
+
+# ---------------- CLASSIFIER CỤC BỘ (tuỳ chọn) ----------------
+
+class NaiveBayesIntent:
+    """Multinomial Naive Bayes (add-one smoothing) trên token của analyzer (bỏ dấu, không bigram)."""
+
+    def __init__(self, analyzer: Optional[Analyzer] = None):
+        self.analyzer = analyzer or Analyzer(fold=True, bigrams=False)
+        self.labels: List[str] = []
+        self._log_prior: Dict[str, float] = {}
+        self._log_lik: Dict[str, Dict[str, float]] = {}
+        self._log_unk: Dict[str, float] = {}
+
+    def fit(self, examples: Iterable[Tuple[str, str]]) -> "NaiveBayesIntent":
+        label_docs: Counter = Counter()
+        term_counts: Dict[str, Counter] = defaultdict(Counter)
+        vocab = set()
+        for text, label in examples:
+            tokens = self.analyzer.analyze(text)
+            label_docs[label] += 1
+            term_counts[label].update(tokens)
+            vocab.update(tokens)
+
+        n_docs = sum(label_docs.values())
+        self.labels = sorted(label_docs)
+        for label in self.labels:
+            total = sum(term_counts[label].values()) + len(vocab) + 1
+            self._log_prior[label] = math.log(label_docs[label] / n_docs)
+            self._log_lik[label] = {t: math.log((c + 1) / total) for t, c in term_counts[label].items()}
+            self._log_unk[label] = math.log(1 / total)
+        return self
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """(label, xác suất hậu nghiệm) — (None, 0.0) nếu chưa học gì."""
+        if not self.labels:
+            return None, 0.0
+        tokens = self.analyzer.analyze(text)
+        scores = {}
+        for label in self.labels:
+            lik, unk = self._log_lik[label], self._log_unk[label]
+            scores[label] = self._log_prior[label] + sum(lik.get(t, unk) for t in tokens)
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        norm = sum(math.exp(s - top) for s in scores.values())
+        return best, 1.0 / norm
+
+    @classmethod
+    def from_jsonl(cls, path: str) -> "NaiveBayesIntent":
+        examples = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    row = json.loads(line)
+                    examples.append((row["text"], row["tool"]))
+        return cls().fit(examples)
+
+
+def classifier_router(classifier: NaiveBayesIntent) -> Callable[[str], Optional[Dict[str, Any]]]:
+    """Router từ classifier: classifier chọn tool, params lấy bằng rule."""
+
+    def route(message: str) -> Optional[Dict[str, Any]]:
+        label, prob = classifier.predict(message)
+        if label == "find_books":
+            params = {
+                "genre": detect_genre(message),
+                "budget_max": parse_money(message),
+                "limit": FIND_BOOKS_LIMIT,
+            }
+            if not (params["genre"] or params["budget_max"]):
+                return None
+        elif label == "search_docs":
+            params = {"query": message, "top_k": FAQ_TOP_K, "source_prefix": "FAQ"}
+        else:
+            return None
+        return {"tool_spec": {"tool": label, "params": params}, "confidence": prob}
+
+    return route
+
+
+# ---------------- PRE-ROUTER ----------------
+
+class PreRouter:
+    def __init__(
+        self,
+        min_confidence: float = ROUTER_MIN_CONFIDENCE,
+        genre_codes: Optional[Callable[[], Iterable[str]]] = None,
+    ):
+        self.min_confidence = min_confidence
+        # () -> các genre_code đang có trong catalog; None = không kiểm tra
+        self.genre_codes = genre_codes
+        self.routers: List[Tuple[str, Callable[[str], Optional[Dict[str, Any]]]]] = []
+        self._lock = threading.Lock()
+        self.counts: Counter = Counter()  # path → số lượt ("rules", "classifier", "llm", "cache"...)
+
+    def register(self, name: str, fn: Callable[[str], Optional[Dict[str, Any]]]) -> None:
+        self.routers.append((name, fn))
+
+    def route(self, message: str) -> Optional[Dict[str, Any]]:
+        """
+        {"tool_spec", "confidence", "path"} nếu có router đủ tin cậy, ngược lại None (→ LLM phase 1).
+        Câu dựa vào ngữ cảnh / thông tin cá nhân luôn để LLM quyết định.
+        """
+        if not is_stateless(message):
+            return None
+        best = None
+        for name, fn in self.routers:
+            try:
+                res = fn(message)
+            except Exception as e:
+                print(f"⚠️ Router {name} lỗi:", e)
+                continue
+            if res and (best is None or res["confidence"] > best["confidence"]):
+                best = dict(res, path=name)
+        if best is None or best["confidence"] < self.min_confidence:
+            return None
+        if not self._genre_in_catalog(best["tool_spec"]):
+            return None
+        return best
+
+    def _genre_in_catalog(self, tool_spec: Dict[str, Any]) -> bool:
+        """find_books với thể loại catalog không có → để LLM quyết định thay vì trả sách sai thể loại."""
+        genre = (tool_spec.get("params") or {}).get("genre")
+        if tool_spec.get("tool") != "find_books" or not genre or self.genre_codes is None:
+            return True
+        try:
+            return normalize_genre_code(genre) in self.genre_codes()
+        except Exception as e:
+            print("⚠️ Không đọc được thể loại của catalog:", e)
+            return False
+
+    def record(self, path: str) -> None:
+        with self._lock:
+            self.counts[path] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = sum(self.counts.values())
+            fast = total - self.counts["llm"]
+            return {
+                "enabled": PRE_ROUTER,
+                "routers": [name for name, _ in self.routers],
+                "paths": dict(self.counts),
+                "llm_skipped_rate": round(fast / total, 4) if total else None,
+            }
+
+
+pre_router = PreRouter(genre_codes=catalog_genres)
+pre_router.register("rules", rule_router)
+
+
+def register_router(name: str, fn: Callable[[str], Optional[Dict[str, Any]]]) -> None:
+    pre_router.register(name, fn)
+
+
+def _load_classifier() -> None:
+    if not os.path.exists(ROUTER_EXAMPLES_PATH):
+        return
+    try:
+        clf = NaiveBayesIntent.from_jsonl(ROUTER_EXAMPLES_PATH)
+        register_router("classifier", classifier_router(clf))
+        print(f"✅ Router classifier: {len(clf.labels)} nhãn từ {ROUTER_EXAMPLES_PATH}")
+    except Exception as e:
+        print("⚠️ Không load được router classifier:", e)
+
+
+if PRE_ROUTER:
+    _load_classifier()
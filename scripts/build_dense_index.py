@@ -0,0 +1,69 @@
+# scripts/build_dense_index.py
+"""
+Embed toàn bộ chunk trong retriever index (data/retriever_index.bin) theo batch,
+lượng tử hoá int8 + dựng IVF, ghi ra data/dense_index/ cho dense.py.
+
+    DENSE_MODEL=... python scripts/build_dense_index.py [--batch-size 64] [--lists 0]
+
+Chạy lại sau mỗi lần build / merge retriever index (chunk thêm lúc runtime chỉ có ở BM25
+cho tới khi embed lại).
+"""
+import argparse
+import os
+import sys
+import time
+
+# ---- chỉnh sys.path để import được dense, retriever ----
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+import dense
+from index_format import MmapIndex, doc_text
+from retriever import BM25_B, BM25_K1, RETRIEVER_BIN_PATH
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build dense index (embedding + IVF) cho retriever")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--lists", type=int, default=0, help="số cụm IVF (0 = sqrt(số chunk))")
+    parser.add_argument("--out", default=dense.DENSE_INDEX_DIR)
+    args = parser.parse_args(argv)
+
+    if dense.np is None:
+        print("❌ Cần numpy: pip install numpy sentence-transformers")
+        sys.exit(1)
+    if not os.path.exists(RETRIEVER_BIN_PATH):
+        print(f"❌ Không tìm thấy {RETRIEVER_BIN_PATH}, chạy scripts/generate_retriever_index.py trước")
+        sys.exit(1)
+
+    index = MmapIndex(RETRIEVER_BIN_PATH, BM25_K1, BM25_B)
+    docs = [index.doc(i) for i in range(index.n_docs)]
+    print(f"Embed {len(docs)} chunk bằng {dense.DENSE_MODEL} ...")
+
+    started = time.perf_counter()
+    vecs = dense.encode_documents([doc_text(d) for d in docs], batch_size=args.batch_size)
+    embedded = time.perf_counter()
+
+    dense_index = dense.DenseIndex.build(
+        vecs,
+        [d["id"] for d in docs],
+        [d["source"] for d in docs],
+        n_lists=args.lists or None,
+        meta={
+            "model": dense.DENSE_MODEL,
+            "dim": int(vecs.shape[1]),
+            "text_normalization": dense.TEXT_NORMALIZATION,
+            "retriever_version": index.version,
+            "built_at": int(time.time()),
+        },
+    )
+    dense_index.save(args.out)
+    print(
+        f"✅ Đã ghi {args.out}: {len(dense_index)} vectors x {vecs.shape[1]} chiều (int8), "
+        f"{len(dense_index.centroids)} cụm IVF; embed {embedded - started:.1f}s, "
+        f"tổng {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
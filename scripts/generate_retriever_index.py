@@ -0,0 +1,199 @@
+# scripts/generate_retriever_index.py
+"""
+Build index retriever (data/retriever_index.bin) từ các file chunk CSV
+(cột: id, source, title, chunk_text).
+
+    python scripts/generate_retriever_index.py
+    python scripts/generate_retriever_index.py data/doc_trunks_faq.csv data/doc_trunks_books.csv \
+        --workers 4 --version 20250101
+
+Các bước (bộ nhớ bị chặn, không giữ cả corpus trong RAM):
+1. Đọc CSV theo luồng, ghi từng doc ra file tạm theo partition (FAQ, BOOK...) để doc
+   cùng partition nằm liền nhau trong index.
+2. Tách token (có thể song song nhiều process), gom posting (term, doc_idx, tf) vào buffer;
+   đầy buffer thì sort rồi đổ ra 1 "run" trên đĩa.
+3. Merge các run (heapq.merge) → posting đã sort theo term → ghi file index
+   (ghi file tạm rồi os.replace, header có version + crc32).
+
+Cùng input + cùng --version (hoặc SOURCE_DATE_EPOCH) → file ra giống hệt từng byte.
+"""
+import argparse
+import csv
+import heapq
+import json
+import os
+import sys
+import tempfile
+import time
+from array import array
+from collections import Counter
+from itertools import groupby
+from multiprocessing import Pool
+from typing import Dict, Iterator, List, Tuple
+
+# ---- chỉnh sys.path để import được analyzer, index_format ----
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from analyzer import DEFAULT_ANALYZER
+from index_format import DOC_FIELDS, MmapIndex, doc_text, partition_of, write_index
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+DEFAULT_INPUTS = [
+    os.path.join(DATA_DIR, "doc_trunks_faq.csv"),
+    os.path.join(DATA_DIR, "doc_trunks_books.csv"),
+]
+DEFAULT_OUT = os.path.join(DATA_DIR, "retriever_index.bin")
+
+
+# ---------------- BƯỚC 1: CSV → file tạm theo partition ----------------
+
+def iter_csv_docs(paths: List[str]) -> Iterator[Dict[str, str]]:
+    for path in paths:
+        # utf-8-sig: file export từ Excel/Sheets có BOM
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            for row in csv.DictReader(f):
+                if not (row.get("id") and row.get("chunk_text")):
+                    continue
+                yield {k: (row.get(k) or "").strip() for k in DOC_FIELDS}
+
+
+def spill_by_partition(paths: List[str], tmp_dir: str) -> List[Tuple[str, str, int]]:
+    """Trả [(partition, file_jsonl, số doc)] theo thứ tự partition xuất hiện lần đầu."""
+    spills: Dict[str, Tuple[str, object]] = {}
+    counts: Dict[str, int] = {}
+    try:
+        for d in iter_csv_docs(paths):
+            part = partition_of(d["source"])
+            if part not in spills:
+                path = os.path.join(tmp_dir, f"docs_{len(spills)}.jsonl")
+                spills[part] = (path, open(path, "w", encoding="utf-8"))
+                counts[part] = 0
+            spills[part][1].write(json.dumps(d, ensure_ascii=False) + "\n")
+            counts[part] += 1
+    finally:
+        for _, f in spills.values():
+            f.close()
+    return [(part, path, counts[part]) for part, (path, _) in spills.items()]
+
+
+def iter_spilled_docs(spills) -> Iterator[Dict[str, str]]:
+    for _, path, _ in spills:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+# ---------------- BƯỚC 2: token → run đã sort ----------------
+
+def _count_terms(d: Dict[str, str]) -> List[Tuple[str, int]]:
+    # chạy trong worker process → trả list (pickle được) thay vì Counter
+    return list(Counter(DEFAULT_ANALYZER.analyze(doc_text(d))).items())
+
+
+def _write_run(buffer: List[Tuple[str, int, int]], tmp_dir: str, n: int) -> str:
+    # str so sánh theo code point = thứ tự byte UTF-8 mà index_format yêu cầu
+    buffer.sort()
+    path = os.path.join(tmp_dir, f"run_{n}.tsv")
+    with open(path, "w", encoding="utf-8") as f:
+        for term, doc_idx, tf in buffer:
+            f.write(f"{term}\t{doc_idx}\t{tf}\n")
+    return path
+
+
+def build_runs(spills, tmp_dir: str, workers: int, run_size: int) -> Tuple[array, List[str]]:
+    doc_len = array("I")
+    runs: List[str] = []
+    buffer: List[Tuple[str, int, int]] = []
+
+    docs = iter_spilled_docs(spills)
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        counted = pool.imap(_count_terms, docs, chunksize=64) if pool else map(_count_terms, docs)
+        for doc_idx, counts in enumerate(counted):
+            doc_len.append(sum(tf for _, tf in counts))
+            buffer.extend((term, doc_idx, tf) for term, tf in counts)
+            if len(buffer) >= run_size:
+                runs.append(_write_run(buffer, tmp_dir, len(runs)))
+                buffer = []
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if buffer or not runs:
+        runs.append(_write_run(buffer, tmp_dir, len(runs)))
+    return doc_len, runs
+
+
+# ---------------- BƯỚC 3: merge run → posting ----------------
+
+def _iter_run(path: str) -> Iterator[Tuple[str, int, int]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            term, doc_idx, tf = line.rstrip("\n").split("\t")
+            yield term, int(doc_idx), int(tf)
+
+
+def merge_runs(runs: List[str]) -> Iterator[Tuple[str, array, array]]:
+    merged = heapq.merge(*(_iter_run(p) for p in runs))
+    for term, group in groupby(merged, key=lambda x: x[0]):
+        doc_idxs, tfs = array("I"), array("H")
+        for _, doc_idx, tf in group:
+            doc_idxs.append(doc_idx)
+            tfs.append(min(tf, 0xFFFF))
+        yield term, doc_idxs, tfs
+
+
+def build(
+    inputs: List[str],
+    out: str,
+    workers: int = 1,
+    run_size: int = 2_000_000,
+    version: int = None,
+    tmp_dir: str = None,
+) -> Dict[str, object]:
+    for path in inputs:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+    with tempfile.TemporaryDirectory(prefix="retriever_build_", dir=tmp_dir) as work:
+        spills = spill_by_partition(inputs, work)
+        doc_len, runs = build_runs(spills, work, workers, run_size)
+        docs = zip(iter_spilled_docs(spills), doc_len)
+        return write_index(out, docs, merge_runs(runs), DEFAULT_ANALYZER, version=version)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build retriever_index.bin từ các file chunk CSV")
+    parser.add_argument("inputs", nargs="*", default=DEFAULT_INPUTS, help="file CSV (id,source,title,chunk_text)")
+    parser.add_argument("--out", default=DEFAULT_OUT)
+    parser.add_argument("--workers", type=int, default=1, help="số process tách token")
+    parser.add_argument("--run-size", type=int, default=2_000_000, help="số posting tối đa trong RAM trước khi đổ ra đĩa")
+    parser.add_argument("--version", type=int, default=None, help="version index (mặc định SOURCE_DATE_EPOCH hoặc thời điểm build)")
+    parser.add_argument("--tmp-dir", default=None)
+    args = parser.parse_args(argv)
+
+    version = args.version
+    if version is None:
+        version = int(os.getenv("SOURCE_DATE_EPOCH") or time.time())
+
+    started = time.perf_counter()
+    try:
+        info = build(args.inputs, args.out, args.workers, args.run_size, version, args.tmp_dir)
+    except FileNotFoundError as e:
+        print(f"❌ Không tìm thấy file: {e}")
+        sys.exit(1)
+
+    # mở lại file vừa ghi, kiểm tra checksum
+    MmapIndex(args.out, 1.2, 0.75, verify=True)
+    elapsed = time.perf_counter() - started
+    print(
+        f"✅ Đã ghi {args.out}: {info['n_docs']} docs, {info['n_terms']} terms, "
+        f"{info['n_postings']} postings, version {info['version']}, "
+        f"crc32 {info['checksum']:08x} ({elapsed:.2f}s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
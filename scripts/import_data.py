@@ -1,19 +1,34 @@
 # scripts/import_data.py
+import argparse
 import os
 import sys
 import csv
-from decimal import Decimal
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
 
 # ---- chỉnh sys.path để import được db, models ----
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 sys.path.append(BASE_DIR)
 
+from sqlalchemy import or_
+
 from db import SessionLocal
-from models import Book, UserProfile, UserFact, FAQ
+from models import Book, UserProfile, UserFact, FAQ, normalize_genre_code
 
 
 DATA_DIR = os.path.join(BASE_DIR, "data")  # nơi bạn để CSV của Huy
 
+# Số dòng CSV đọc + ghi mỗi lô (import bulk)
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+
+
+def to_text(v):
+    """Ô text trống → None (NULL), không lưu chuỗi rỗng."""
+    v = (v or "").strip()
+    return v or None
+
 
 def to_int(v):
     if v is None:
@@ -22,7 +37,14 @@ def to_int(v):
     return int(v) if v else None
 
 
-def import_books(csv_path: str | None = None):
+def import_books(csv_path: str | None = None, bulk: bool = True):
+    """Import catalog sách. bulk=False: cách cũ, merge từng dòng."""
+    if bulk:
+        return import_books_bulk(csv_path)
+    return import_books_rowwise(csv_path)
+
+
+def import_books_rowwise(csv_path: str | None = None):
     if csv_path is None:
         csv_path = os.path.join(DATA_DIR, "book_master_template.csv")
 
@@ -50,13 +72,13 @@ def import_books(csv_path: str | None = None):
 
                 # 3. Map dữ liệu văn bản
                 book.title = row.get("title", "").strip()
-                book.authors = row.get("authors", "").strip()
-                book.genres_primary = row.get("genres_primary", "").strip()
-                book.publisher = row.get("publisher", "").strip()
-                book.short_summary = row.get("short_summary", "").strip()
+                book.authors = to_text(row.get("authors"))
+                book.genres_primary = to_text(row.get("genres_primary"))
+                book.publisher = to_text(row.get("publisher"))
+                book.short_summary = to_text(row.get("short_summary"))
                 
                 # Các cột mới (nếu bạn đã thêm vào models.py)
-                book.introduction = row.get("introduction", "").strip()
+                book.introduction = to_text(row.get("introduction"))
                 book.age_rating = to_int(row.get("age_rating"))
 
                 # 4. Map dữ liệu số
@@ -91,6 +113,164 @@ def import_books(csv_path: str | None = None):
         db.close()
 
 
+# ---------------- IMPORT BOOKS BULK ----------------
+# Đọc CSV theo lô IMPORT_CHUNK_SIZE dòng, kiểm tra theo cột cho cả lô, rồi ghi cả lô bằng 1 lệnh
+# INSERT ... ON CONFLICT (id) DO UPDATE (executemany). Tất cả các lô chung 1 transaction:
+# lỗi giữa chừng thì rollback, catalog không bao giờ nửa cũ nửa mới.
+
+BOOK_TEXT_COLUMNS = ["title", "authors", "genres_primary", "publisher", "short_summary", "introduction"]
+# cột số: (cột trong model, cột trong CSV)
+BOOK_INT_COLUMNS = [
+    ("age_rating", "age_rating"),
+    ("pages", "pages"),
+    ("year", "year"),
+    ("price_vnd", "price_vnd"),
+    ("stock", "stocks"),   # CSV là 'stocks', model là 'stock'
+]
+NON_NEGATIVE = {"pages", "price_vnd", "stock", "age_rating"}
+
+
+def _parse_int_column(values):
+    """List str → (list int|None, list index dòng lỗi)."""
+    out, bad = [], []
+    for i, v in enumerate(values):
+        v = (v or "").strip()
+        if not v:
+            out.append(None)
+            continue
+        try:
+            out.append(int(v))
+        except ValueError:
+            out.append(None)
+            bad.append(i)
+    return out, bad
+
+
+def _parse_rating(v):
+    v = (v or "").strip()
+    if not v:
+        return None
+    try:
+        return Decimal(v)
+    except InvalidOperation:
+        return None   # như import cũ: rating hỏng → bỏ trống
+
+
+def validate_book_chunk(rows, now=None):
+    """
+    Kiểm tra + chuyển kiểu cả lô theo từng cột.
+    Trả (records, errors): records là dict theo cột của bảng books, errors là list (id, lý do).
+    Trong 1 lô, id trùng thì dòng sau thắng (ON CONFLICT không cho sửa 1 dòng 2 lần trong 1 câu).
+    """
+    now = now or datetime.utcnow()
+    ids = [(r.get("id") or r.get("book_id") or "").strip() for r in rows]
+    columns = {c: [to_text(r.get(c)) for r in rows] for c in BOOK_TEXT_COLUMNS}
+
+    reasons = {}
+    for i, book_id in enumerate(ids):
+        if not book_id:
+            reasons[i] = "thiếu id"
+        elif not columns["title"][i]:
+            reasons[i] = "thiếu title"
+
+    for col, csv_col in BOOK_INT_COLUMNS:
+        values, bad = _parse_int_column([r.get(csv_col) for r in rows])
+        columns[col] = values
+        for i in bad:
+            reasons.setdefault(i, f"{csv_col} không phải số")
+        if col in NON_NEGATIVE:
+            for i, v in enumerate(values):
+                if v is not None and v < 0:
+                    reasons.setdefault(i, f"{csv_col} âm")
+
+    columns["rating_avg"] = [_parse_rating(r.get("rating_avg")) for r in rows]
+    # core insert không chạy @validates của model → tự tính genre_code
+    columns["genre_code"] = [normalize_genre_code(g) for g in columns["genres_primary"]]
+
+    records = {}
+    for i, book_id in enumerate(ids):
+        if i in reasons:
+            continue
+        rec = {c: values[i] for c, values in columns.items()}
+        rec.update(id=book_id, created_at=now, updated_at=now)
+        records[book_id] = rec
+    errors = [(ids[i] or f"dòng {i + 1}", reason) for i, reason in sorted(reasons.items())]
+    return list(records.values()), errors
+
+
+def _upsert_books_stmt(dialect: str):
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        return None
+    books = Book.__table__
+    stmt = dialect_insert(books)
+    # created_at giữ nguyên khi sách đã có. Chỉ update sách có cột nào đó thật sự khác:
+    # nạp lại file không đổi thì updated_at giữ nguyên → fingerprint catalog (catalog.py) không đổi
+    compared = [c.name for c in books.columns if c.name not in ("id", "created_at", "updated_at")]
+    update_cols = {name: stmt.excluded[name] for name in compared + ["updated_at"]}
+    changed = or_(*(books.c[name].is_distinct_from(stmt.excluded[name]) for name in compared))
+    return stmt.on_conflict_do_update(index_elements=["id"], set_=update_cols, where=changed)
+
+
+def _read_chunks(reader, chunk_size):
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_books_bulk(
+    csv_path: str | None = None,
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+    session_factory=SessionLocal,
+):
+    """Import catalog theo lô. Trả dict thống kê (rows, errors, seconds, rows_per_sec) hoặc None nếu lỗi."""
+    if csv_path is None:
+        csv_path = os.path.join(DATA_DIR, "book_master_template.csv")
+
+    if not os.path.exists(csv_path):
+        print(f"❌ Không tìm thấy file: {csv_path}")
+        return None
+
+    db = session_factory()
+    stmt = _upsert_books_stmt(db.get_bind().dialect.name)
+    if stmt is None:
+        db.close()
+        print("⚠️ DB không hỗ trợ ON CONFLICT, import từng dòng")
+        import_books_rowwise(csv_path)
+        return None
+
+    started = time.perf_counter()
+    count = 0
+    errors = []
+    try:
+        with open(csv_path, newline="", encoding="utf-8-sig") as f:
+            for chunk in _read_chunks(csv.DictReader(f), chunk_size):
+                records, chunk_errors = validate_book_chunk(chunk)
+                errors.extend(chunk_errors)
+                if records:
+                    db.execute(stmt, records)
+                    count += len(records)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Lỗi khi import books (bulk), đã rollback: {e}")
+        return None
+    finally:
+        db.close()
+
+    seconds = time.perf_counter() - started
+    rate = count / seconds if seconds > 0 else float(count)
+    print(f"✅ Import books (bulk) xong từ {csv_path}: {count} dòng trong {seconds:.2f}s ({rate:,.0f} dòng/s).")
+    if errors:
+        print(f"⚠️ Bỏ qua {len(errors)} dòng lỗi, vd: {errors[:5]}")
+    return {"rows": count, "errors": errors, "seconds": seconds, "rows_per_sec": rate}
+
+
 def import_user_profiles(csv_path: str | None = None, shop_id: str = "shop_books_1"):
     """
     Import đúng file user_profiles_examples.csv của Huy.
@@ -200,7 +380,15 @@ def import_faqs(csv_path: str | None = None):
         db.close()
         
 if __name__ == "__main__":
-    import_books()
+    parser = argparse.ArgumentParser(description="Import dữ liệu CSV trong data/ vào DB")
+    parser.add_argument("--rowwise", action="store_true", help="import books từng dòng (cách cũ)")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.rowwise:
+        import_books_rowwise()
+    else:
+        import_books_bulk(chunk_size=args.chunk_size)
     import_user_profiles()
     import_user_facts()
     import_faqs()
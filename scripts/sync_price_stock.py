@@ -0,0 +1,190 @@
+# scripts/sync_price_stock.py
+"""
+Cập nhật giá & tồn kho hằng ngày theo OPERATIONS.md (mục 3).
+
+    python scripts/sync_price_stock.py data/price_stock.csv [--out-dir data] [--notify-url URL]
+
+- price_stock.csv gồm cột book_id, price_vnd, stock; dòng lỗi (price_vnd <= 0, stock < 0,
+  không phải số, trùng book_id trong file) → "fail".
+- Dòng hợp lệ được nạp vào bảng tạm, rồi 1 câu UPDATE ... FROM duy nhất cập nhật price_vnd, stock,
+  updated_at — chỉ cho sách có giá / tồn thật sự đổi, các cột nội dung không bị chạm.
+- book_id không có trong bảng books → missing_books.log.
+- Kết quả → update_result.json {"success": [...], "fail": [...]}.
+
+Sách đổi giá / tồn có updated_at mới → fingerprint catalog đổi (catalog.catalog_version), cache
+find_books và catalog snapshot của server tự nạp lại sau tối đa CATALOG_REFRESH_SECONDS giây.
+--notify-url (vd http://localhost:8000/api/admin/catalog/invalidate) báo server kiểm tra lại ngay.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+import urllib.request
+from datetime import datetime
+
+# ---- chỉnh sys.path để import được db, models ----
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, insert, or_, select, update
+
+from db import SessionLocal
+from models import Book
+
+DATA_DIR = os.path.join(BASE_DIR, "data")
+REQUIRED_COLUMNS = ("book_id", "price_vnd", "stock")
+
+
+def _parse_int(v):
+    v = (v or "").strip()
+    if not v:
+        return None
+    try:
+        return int(v)
+    except ValueError:
+        return None
+
+
+def validate_rows(rows):
+    """Trả (valid, fail): valid là list {book_id, price_vnd, stock}, fail là list {book_id, reason}."""
+    valid, fail, seen = [], [], set()
+    for i, row in enumerate(rows, start=2):  # dòng 1 là header
+        book_id = (row.get("book_id") or "").strip()
+        price = _parse_int(row.get("price_vnd"))
+        stock = _parse_int(row.get("stock"))
+        if not book_id:
+            reason = f"dòng {i}: thiếu book_id"
+        elif price is None or price <= 0:
+            reason = f"price_vnd không hợp lệ: {row.get('price_vnd')!r}"
+        elif stock is None or stock < 0:
+            reason = f"stock không hợp lệ: {row.get('stock')!r}"
+        elif book_id in seen:
+            reason = "trùng book_id trong file"
+        else:
+            seen.add(book_id)
+            valid.append({"book_id": book_id, "price_vnd": price, "stock": stock})
+            continue
+        fail.append({"book_id": book_id, "reason": reason})
+    return valid, fail
+
+
+def _delta_table():
+    return Table(
+        "price_stock_delta",
+        MetaData(),
+        Column("book_id", String(32), primary_key=True),
+        Column("price_vnd", Integer, nullable=False),
+        Column("stock", Integer, nullable=False),
+        prefixes=["TEMPORARY"],
+    )
+
+
+def apply_delta(valid, session_factory=SessionLocal):
+    """
+    Nạp delta vào bảng tạm và cập nhật books trong 1 transaction.
+    Trả (success, missing, updated): success là các dòng tìm thấy sách, missing là book_id không có,
+    updated là số sách thật sự đổi giá / tồn.
+    """
+    books = Book.__table__
+    delta = _delta_table()
+    now = datetime.utcnow()
+
+    db = session_factory()
+    try:
+        conn = db.connection()
+        delta.create(conn)
+        try:
+            if valid:
+                conn.execute(insert(delta), valid)
+
+            missing = conn.execute(
+                select(delta.c.book_id)
+                .outerjoin(books, books.c.id == delta.c.book_id)
+                .where(books.c.id.is_(None))
+                .order_by(delta.c.book_id)
+            ).scalars().all()
+
+            # 1 câu UPDATE cho cả file, chỉ dòng có giá hoặc tồn khác
+            updated = conn.execute(
+                update(books)
+                .where(books.c.id == delta.c.book_id)
+                .where(or_(
+                    books.c.price_vnd.is_distinct_from(delta.c.price_vnd),
+                    books.c.stock.is_distinct_from(delta.c.stock),
+                ))
+                .values(price_vnd=delta.c.price_vnd, stock=delta.c.stock, updated_at=now)
+            ).rowcount
+        finally:
+            delta.drop(conn)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    missing_set = set(missing)
+    success = [r for r in valid if r["book_id"] not in missing_set]
+    return success, missing, updated
+
+
+def notify_server(url: str) -> None:
+    """Gọi endpoint admin để server kiểm tra lại catalog ngay (không chờ CATALOG_REFRESH_SECONDS)."""
+    req = urllib.request.Request(url, method="POST", headers={"X-Admin-Token": os.getenv("ADMIN_TOKEN", "")})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            print(f"✅ Đã báo server làm mới catalog: HTTP {resp.status}")
+    except Exception as e:
+        print("⚠️ Không báo được server (cache tự làm mới sau CATALOG_REFRESH_SECONDS):", e)
+
+
+def sync_price_stock(csv_path, out_dir=DATA_DIR, session_factory=SessionLocal, notify_url=None):
+    """Chạy cả quy trình. Trả dict kết quả (như update_result.json) hoặc None nếu file lỗi."""
+    if not os.path.exists(csv_path):
+        print(f"❌ Không tìm thấy file: {csv_path}")
+        return None
+
+    started = time.perf_counter()
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        missing_cols = [c for c in REQUIRED_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing_cols:
+            print(f"❌ {csv_path} thiếu cột: {', '.join(missing_cols)}")
+            return None
+        valid, fail = validate_rows(reader)
+
+    try:
+        success, missing, updated = apply_delta(valid, session_factory)
+    except Exception as e:
+        print(f"❌ Lỗi khi cập nhật giá / tồn, đã rollback: {e}")
+        return None
+    fail += [{"book_id": b, "reason": "không tìm thấy book_id"} for b in missing]
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "missing_books.log"), "w", encoding="utf-8") as f:
+        f.writelines(f"{b}\n" for b in missing)
+    result = {"success": success, "fail": fail}
+    with open(os.path.join(out_dir, "update_result.json"), "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    seconds = time.perf_counter() - started
+    print(
+        f"✅ Cập nhật giá / tồn xong trong {seconds:.2f}s: {len(success)} sách khớp "
+        f"({updated} thay đổi), {len(fail)} lỗi ({len(missing)} không tìm thấy)."
+    )
+    if updated and notify_url:
+        notify_server(notify_url)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cập nhật giá & tồn kho từ price_stock.csv")
+    parser.add_argument("csv_path", nargs="?", default=os.path.join(DATA_DIR, "price_stock.csv"))
+    parser.add_argument("--out-dir", default=DATA_DIR, help="nơi ghi missing_books.log, update_result.json")
+    parser.add_argument("--notify-url", default=os.getenv("CATALOG_NOTIFY_URL", ""))
+    args = parser.parse_args()
+
+    if sync_price_stock(args.csv_path, args.out_dir, notify_url=args.notify_url) is None:
+        sys.exit(1)
@@ -1,8 +1,173 @@
 # upgrade_db.py
+import os
+import sys
+
+# Thêm thư mục gốc vào sys.path để import được các module
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from sqlalchemy import Index, UniqueConstraint, bindparam, delete, func, inspect, select, text, update
+
 from db import engine
-from models import Base
+from models import Base, Book, Conversation, Message, normalize_genre_code
+
+
+def _find_duplicates(table, columns) -> int:
+    """Đếm số nhóm giá trị bị trùng trên các cột (unique index sẽ fail nếu có)."""
+    cols = [table.c[c] for c in columns]
+    q = (
+        select(*cols)
+        .group_by(*cols)
+        .having(func.count() > 1)
+    )
+    with engine.connect() as conn:
+        return len(conn.execute(q).fetchall())
+
+
+def upgrade_columns(existing_tables) -> None:
+    """
+    create_all cũng KHÔNG thêm cột mới vào bảng đã tồn tại → ALTER TABLE ADD COLUMN
+    cho các cột khai báo trong models.py mà DB cũ chưa có.
+    """
+    insp = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        have = {c["name"] for c in insp.get_columns(table.name)}
+        for col in table.columns:
+            if col.name in have:
+                continue
+            col_type = col.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}"))
+            print(f"✅ {table.name}: thêm cột {col.name} {col_type}")
+
+
+def backfill_genre_codes() -> None:
+    """Điền books.genre_code cho dữ liệu import trước khi có cột này."""
+    with engine.begin() as conn:
+        genres = conn.execute(
+            select(Book.genres_primary)
+            .where(Book.genres_primary.is_not(None), Book.genre_code.is_(None))
+            .distinct()
+        ).scalars().all()
+        for g in genres:
+            conn.execute(
+                update(Book)
+                .where(Book.genres_primary == g, Book.genre_code.is_(None))
+                .values(genre_code=normalize_genre_code(g))
+            )
+    if genres:
+        print(f"✅ books: điền genre_code cho {len(genres)} thể loại")
+
+
+def merge_duplicate_conversations() -> None:
+    """
+    DB cũ có thể có nhiều conversation cùng (shop_id, session_id) (request chạy song song trước khi có
+    uq_conv_shop_session). Gộp về conversation cũ nhất: chuyển message sang, đánh lại turn_index theo
+    thời gian, xoá bản thừa → tạo được unique index mà start_or_get_conversation (ON CONFLICT) cần.
+    """
+    convs, msgs = Conversation.__table__, Message.__table__
+    merged = 0
+    with engine.begin() as conn:
+        groups = conn.execute(
+            select(convs.c.shop_id, convs.c.session_id)
+            .group_by(convs.c.shop_id, convs.c.session_id)
+            .having(func.count() > 1)
+        ).fetchall()
+        for shop_id, session_id in groups:
+            rows = conn.execute(
+                select(convs.c.id, convs.c.user_id, convs.c.title, convs.c.updated_at)
+                .where(convs.c.shop_id == shop_id, convs.c.session_id == session_id)
+                .order_by(convs.c.created_at, convs.c.id)
+            ).fetchall()
+            keep, extra = rows[0].id, [r.id for r in rows[1:]]
+
+            messages = conn.execute(
+                select(msgs.c.id)
+                .where(msgs.c.conversation_id.in_([r.id for r in rows]))
+                .order_by(msgs.c.created_at, msgs.c.conversation_id, msgs.c.turn_index, msgs.c.id)
+            ).scalars().all()
+            if messages:
+                conn.execute(
+                    update(msgs)
+                    .where(msgs.c.id == bindparam("_id"))
+                    .values(conversation_id=keep, turn_index=bindparam("_turn")),
+                    [{"_id": mid, "_turn": turn} for turn, mid in enumerate(messages, start=1)],
+                )
+            # tóm tắt cũ chỉ phủ 1 trong các bản → bỏ, summarizer tóm tắt lại từ message đã gộp
+            conn.execute(
+                update(convs)
+                .where(convs.c.id == keep)
+                .values(
+                    user_id=next((r.user_id for r in rows if r.user_id), None),
+                    title=next((r.title for r in rows if r.title), None),
+                    last_summary=None,
+                    last_turn_index=len(messages),
+                    updated_at=max((r.updated_at for r in rows if r.updated_at), default=None),
+                )
+            )
+            conn.execute(delete(convs).where(convs.c.id.in_(extra)))
+            merged += len(extra)
+    if groups:
+        print(f"✅ conversations: gộp {merged} bản trùng vào {len(groups)} conversation")
+
+
+def upgrade_indexes(existing_tables) -> None:
+    """
+    create_all KHÔNG thêm index / unique constraint vào bảng đã tồn tại,
+    nên với DB cũ cần tạo bổ sung những index khai báo trong models.py.
+    Unique constraint được tạo dưới dạng UNIQUE INDEX cùng tên
+    (SQLite không hỗ trợ ALTER TABLE ADD CONSTRAINT).
+    """
+    insp = inspect(engine)
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing = {i["name"] for i in insp.get_indexes(table.name)}
+        existing |= {u["name"] for u in insp.get_unique_constraints(table.name) if u.get("name")}
+
+        for idx in table.indexes:
+            if idx.name in existing:
+                continue
+            idx.create(bind=engine)
+            print(f"✅ {table.name}: tạo index {idx.name}")
+
+        for cons in list(table.constraints):
+            if not isinstance(cons, UniqueConstraint) or not cons.name:
+                continue
+            if cons.name in existing:
+                continue
+            columns = [c.name for c in cons.columns]
+            dup = _find_duplicates(table, columns)
+            if dup:
+                print(
+                    f"⚠️ {table.name}: có {dup} nhóm trùng {columns}, "
+                    f"bỏ qua {cons.name} (cần gộp dữ liệu trùng trước)."
+                )
+                continue
+            Index(cons.name, *[table.c[c] for c in columns], unique=True).create(bind=engine)
+            print(f"✅ {table.name}: tạo unique index {cons.name} {columns}")
+
+
+def upgrade() -> None:
+    existing_tables = set(inspect(engine).get_table_names())
 
-if __name__ == "__main__":
     print("Creating missing tables (if any)...")
     Base.metadata.create_all(bind=engine)
+
+    print("Adding missing columns (if any)...")
+    upgrade_columns(existing_tables)
+    backfill_genre_codes()
+
+    print("Creating missing indexes (if any)...")
+    if "conversations" in existing_tables:
+        merge_duplicate_conversations()
+    upgrade_indexes(existing_tables)
     print("✅ Done.")
+
+
+if __name__ == "__main__":
+    upgrade()
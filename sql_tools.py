@@ -1,13 +1,35 @@
 # sql_tools.py
 from __future__ import annotations
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime
 
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
 
+import catalog
+import journal
+import memory
 from db import SessionLocal
-from models import Book, UserProfile, UserFact, Conversation, Message
+from query_cache import get_cache
+from models import Book, UserProfile, UserFact, Conversation, Message, normalize_genre_code
+
+
+# --------------------------------------------------------
+# SESSION
+# --------------------------------------------------------
+# Mọi hàm bên dưới nhận thêm tham số `db` (tuỳ chọn):
+# - db=None  → tự mở SessionLocal(), tự commit + close như trước (script, test).
+# - db=<Session của request> (db.get_db) → dùng chung 1 session cho cả lượt chat,
+#   KHÔNG commit ở đây; request commit 1 lần khi xong.
+
+def _open_session(db: Optional[Session]) -> Tuple[Session, bool]:
+    """Trả (session, owned). owned=True nghĩa là hàm gọi tự mở nên phải tự commit/close."""
+    if db is not None:
+        return db, False
+    return SessionLocal(), True
 
 
 # --------------------------------------------------------
@@ -21,44 +43,81 @@ def find_books_by_filter(
     page_min: Optional[int] = None,
     page_max: Optional[int] = None,
     limit: int = 5,
+    db: Optional[Session] = None,
 ) -> List[Dict[str, Any]]:
     """
     Tool: find_books
     Mục đích: Tìm sách theo tiêu chí lọc (thể loại, giá, số trang).
     """
-    db: Session = SessionLocal()
+    # Logic giới hạn an toàn, thêm chặn trên phòng trường hợp user đưa ttin limit mơ hồ, LLM bị hallucination
+    # Nếu limit <= 0 hoặc None -> Mặc định 5
+    # Nếu limit > 10 -> Cắt xuống 10 để tránh tràn Context Window của LLM
+    if not limit or limit <= 0:
+        actual_limit = 5
+    else:
+        actual_limit = min(limit, 10)
+
+    # Bảng books hiện chưa có cột shop_id (mỗi DB là catalog của 1 shop),
+    # shop_id được giữ trong chữ ký cho tương thích với orchestrator.
+    genre_code = normalize_genre_code(genre)
+    # giá trị <= 0 cũng bị bỏ qua như None → cùng 1 key cache
+    budget_max = budget_max if budget_max is not None and budget_max > 0 else None
+    page_min = page_min if page_min is not None and page_min > 0 else None
+    page_max = page_max if page_max is not None and page_max > 0 else None
+
+    # Cache kết quả theo bộ lọc, tự hết hiệu lực khi catalog đổi version
+    return get_cache("find_books").get_or_compute(
+        (genre_code, budget_max, page_min, page_max, actual_limit),
+        catalog.catalog_version,
+        lambda: _find_books(genre_code, budget_max, page_min, page_max, actual_limit, db),
+    )
+
+
+def _find_books(
+    genre_code: Optional[str],
+    budget_max: Optional[int],
+    page_min: Optional[int],
+    page_max: Optional[int],
+    actual_limit: int,
+    db: Optional[Session],
+) -> List[Dict[str, Any]]:
+    # Catalog in-memory (CATALOG_SNAPSHOT=1): không chạm DB
+    snap = catalog.get_catalog()
+    if snap is not None:
+        return snap.find(genre_code, budget_max, page_min, page_max, actual_limit)
+
+    db, owned = _open_session(db)
     try:
-        q = db.query(Book)
-        
-        if shop_id:
-            q = q.filter(Book.shop_id == shop_id)
-
-        # 1. Filter theo thể loại 
-        if genre:
-            q = q.filter(Book.genres_primary.ilike(f"%{genre}%"))
-
-        # 2. Filter theo ngân sách (chỉ lọc nếu có giá trị hợp lệ)
-        if budget_max is not None and budget_max > 0:
-            q = q.filter(Book.price_vnd <= budget_max)
-
-        # 3. Filter theo số trang
-        if page_min is not None and page_min > 0:
-            q = q.filter(Book.pages >= page_min)
-        if page_max is not None and page_max > 0:
-            q = q.filter(Book.pages <= page_max)
-
-        # 4. Sắp xếp: Ưu tiên Rating cao, sau đó đến Giá thấp
-        q = q.order_by(Book.rating_avg.desc(), Book.price_vnd.asc())
-
-        # 5. Logic giới hạn an toàn, thêm chặn trên phòng trường hợp user đưa ttin limit mơ hồ, LLM bị hallucination
-        # Nếu limit <= 0 hoặc None -> Mặc định 5
-        # Nếu limit > 10 -> Cắt xuống 10 để tránh tràn Context Window của LLM
-        if not limit or limit <= 0:
-            actual_limit = 5
+        def _query(genre_filter):
+            q = db.query(Book)
+
+            # 1. Filter theo thể loại
+            if genre_filter is not None:
+                q = q.filter(genre_filter)
+
+            # 2. Filter theo ngân sách (chỉ lọc nếu có giá trị hợp lệ)
+            if budget_max is not None and budget_max > 0:
+                q = q.filter(Book.price_vnd <= budget_max)
+
+            # 3. Filter theo số trang
+            if page_min is not None and page_min > 0:
+                q = q.filter(Book.pages >= page_min)
+            if page_max is not None and page_max > 0:
+                q = q.filter(Book.pages <= page_max)
+
+            # 4. Sắp xếp: Ưu tiên Rating cao, sau đó đến Giá thấp
+            #    (khớp index ix_books_genre_rating_price / ix_books_rating_price)
+            q = q.order_by(Book.rating_avg.desc(), Book.price_vnd.asc())
+            return q.limit(actual_limit).all()
+
+        if genre_code:
+            # So khớp chính xác genre_code (dùng index), chỉ khi không có kết quả
+            # mới thử khớp một phần như trước (vd: "self" → "self-help")
+            books = _query(Book.genre_code == genre_code)
+            if not books:
+                books = _query(Book.genre_code.like(f"%{genre_code}%"))
         else:
-            actual_limit = min(limit, 10)
-
-        books = q.limit(actual_limit).all()
+            books = _query(None)
 
         return [
             {
@@ -75,11 +134,12 @@ def find_books_by_filter(
             for b in books
         ]
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
-def get_book_by_id(book_id: str) -> Optional[Dict[str, Any]]:
-    db = SessionLocal()
+def get_book_by_id(book_id: str, db: Optional[Session] = None) -> Optional[Dict[str, Any]]:
+    db, owned = _open_session(db)
     try:
         b = db.get(Book, book_id)
         if not b:
@@ -96,15 +156,20 @@ def get_book_by_id(book_id: str) -> Optional[Dict[str, Any]]:
             "short_summary": b.short_summary,
         }
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
 # --------------------------------------------------------
 # USER PROFILE & FACTS
 # --------------------------------------------------------
 
-def get_or_create_user_profile(shop_id: str, user_id: str) -> UserProfile:
-    db = SessionLocal()
+def get_or_create_user_profile(
+    shop_id: str,
+    user_id: str,
+    db: Optional[Session] = None,
+) -> UserProfile:
+    db, owned = _open_session(db)
     try:
         profile = (
             db.query(UserProfile)
@@ -114,11 +179,13 @@ def get_or_create_user_profile(shop_id: str, user_id: str) -> UserProfile:
         if not profile:
             profile = UserProfile(shop_id=shop_id, user_id=user_id)
             db.add(profile)
-            db.commit()
-            db.refresh(profile)
+            if owned:
+                db.commit()
+                db.refresh(profile)
         return profile
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
 def upsert_user_profile(
@@ -131,8 +198,9 @@ def upsert_user_profile(
     page_min: Optional[int] = None,
     page_max: Optional[int] = None,
     content_avoid: Optional[str] = None,
+    db: Optional[Session] = None,
 ):
-    db = SessionLocal()
+    db, owned = _open_session(db)
     try:
         profile = (
             db.query(UserProfile)
@@ -158,10 +226,12 @@ def upsert_user_profile(
             profile.content_avoid = content_avoid
 
         db.merge(profile)
-        db.commit()
+        if owned:
+            db.commit()
         print("✅ Saved user_profile", shop_id, user_id)
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
 def add_user_fact(
@@ -170,8 +240,9 @@ def add_user_fact(
     fact_type: str,
     fact_value: str,
     confidence: float = 1.0,
+    db: Optional[Session] = None,
 ):
-    db = SessionLocal()
+    db, owned = _open_session(db)
     try:
         fact = UserFact(
             shop_id=shop_id,
@@ -181,14 +252,20 @@ def add_user_fact(
             confidence=confidence,
         )
         db.add(fact)
-        db.commit()
+        if owned:
+            db.commit()
         print("✅ Added user_fact", shop_id, user_id, fact_type, fact_value)
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
-def get_user_facts(shop_id: str, user_id: str) -> List[Dict[str, Any]]:
-    db = SessionLocal()
+def get_user_facts(
+    shop_id: str,
+    user_id: str,
+    db: Optional[Session] = None,
+) -> List[Dict[str, Any]]:
+    db, owned = _open_session(db)
     try:
         facts = (
             db.query(UserFact)
@@ -204,7 +281,8 @@ def get_user_facts(shop_id: str, user_id: str) -> List[Dict[str, Any]]:
             for f in facts
         ]
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
 # --------------------------------------------------------
@@ -216,73 +294,187 @@ def start_or_get_conversation(
     user_id: Optional[str],
     session_id: str,
     title_hint: Optional[str] = None,
+    db: Optional[Session] = None,
 ) -> Conversation:
     """
     Lấy conversation theo (shop_id, session_id). Nếu chưa có thì tạo mới.
+    Conversation mới luôn được commit ngay (kể cả khi dùng session của request)
+    để có id, và để không giữ write-lock SQLite suốt thời gian chờ LLM.
+    Tạo bằng INSERT ... ON CONFLICT DO NOTHING: 2 request cùng session_id (widget retry, 2 tab)
+    chạy song song vẫn chỉ ra 1 conversation.
     """
-    db = SessionLocal()
+    db, owned = _open_session(db)
     try:
         conv = (
             db.query(Conversation)
             .filter_by(shop_id=shop_id, session_id=session_id)
             .first()
         )
+        if conv is not None:
+            _refresh_memory(conv, db)
         if not conv:
-            conv = Conversation(
-                shop_id=shop_id,
-                user_id=user_id,
-                session_id=session_id,
-                title=title_hint,
-                last_summary=None,
-                last_turn_index=0,
-            )
-            db.add(conv)
+            created = _insert_conversation(db, {
+                "shop_id": shop_id,
+                "user_id": user_id,
+                "session_id": session_id,
+                "title": title_hint,
+                "last_summary": None,
+                "last_turn_index": 0,
+                "created_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow(),
+            })
             db.commit()
-            db.refresh(conv)
+            conv = (
+                db.query(Conversation)
+                .filter_by(shop_id=shop_id, session_id=session_id)
+                .one()
+            )
+            if created and memory.CONV_MEMORY:
+                # conversation mới: bộ nhớ rỗng là đủ, khỏi load từ DB
+                memory.get_store().load(conv.id, [], None, 0)
         return conv
     finally:
-        db.close()
+        if owned:
+            db.close()
+
+
+def _insert_conversation(db: Session, values: Dict[str, Any]) -> bool:
+    """Thêm conversation nếu (shop_id, session_id) chưa có. Trả True nếu đúng là request này tạo."""
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = (
+            dialect_insert(Conversation.__table__)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["shop_id", "session_id"])
+        )
+        return db.execute(stmt).rowcount == 1
+
+    # DB khác: dựa vào unique constraint, request thua thì bỏ qua
+    try:
+        with db.begin_nested():
+            db.execute(insert(Conversation.__table__).values(**values))
+        return True
+    except IntegrityError:
+        return False
 
 
 def save_message(
     conversation_id: int,
     role: str,
     content: str,
+    db: Optional[Session] = None,
 ) -> Message:
     """
     Lưu 1 message vào bảng messages và cập nhật last_turn_index trong conversations.
+    Khi dùng session của request, message chỉ được add vào session (chưa flush),
+    tất cả được ghi trong 1 commit cuối request.
+    turn_index lúc này chỉ là số tạm để sắp thứ tự; số thật được cấp nguyên tử khi flush
+    (_allocate_turns) nên 2 request cùng conversation không bao giờ trùng turn_index.
+    MESSAGE_DURABILITY=group/async: đưa vào message journal (ghi theo lô), không chạm session `db`.
     """
-    db = SessionLocal()
+    if journal.journal_enabled():
+        return Message(**journal.get_journal().append(conversation_id, role, content))
+
+    db, owned = _open_session(db)
     try:
-        conv = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+        # db.get dùng identity map → trong cùng 1 session chỉ SELECT conversation 1 lần
+        conv = db.get(Conversation, conversation_id)
         if conv is None:
             raise ValueError(f"Conversation {conversation_id} not found")
 
-        next_turn = (conv.last_turn_index or 0) + 1
+        unsaved = db.info.setdefault(_UNSAVED_KEY, [])
+        provisional = (conv.last_turn_index or 0) + 1 + sum(
+            1 for m in unsaved if m.conversation_id == conversation_id and m in db.new
+        )
 
         msg = Message(
             conversation_id=conversation_id,
             role=role,
             content=content,
-            turn_index=next_turn,
+            turn_index=provisional,
         )
         db.add(msg)
+        unsaved.append(msg)
 
-        conv.last_turn_index = next_turn
-        conv.updated_at = datetime.utcnow()
-
-        db.commit()
-        db.refresh(msg)
+        if owned:
+            db.commit()
+            db.refresh(msg)
         return msg
     finally:
-        db.close()
+        if owned:
+            db.close()
+
+
+_UNSAVED_KEY = "unsaved_messages"
 
 
-def get_last_messages(conversation_id: int, limit: int = 5) -> List[Dict[str, Any]]:
+@event.listens_for(Session, "before_flush")
+def _allocate_turns(session: Session, flush_context, instances) -> None:
+    """
+    Cấp turn_index thật cho các message save_message chưa ghi, ngay trong transaction flush:
+    UPDATE conversations SET last_turn_index = last_turn_index + n (nguyên tử, không đọc-rồi-ghi)
+    rồi đọc lại giá trị mới. Postgres khoá đúng dòng conversation đó tới khi commit, SQLite giữ
+    write-lock — chỉ trong lúc commit, không phải suốt request.
+    """
+    unsaved = session.info.pop(_UNSAVED_KEY, None)
+    if not unsaved:
+        return
+    by_conv: Dict[int, List[Message]] = {}
+    for m in unsaved:
+        if m in session.new:
+            by_conv.setdefault(m.conversation_id, []).append(m)
+
+    conn = session.connection()
+    table = Conversation.__table__
+    now = datetime.utcnow()
+    for cid, msgs in by_conv.items():
+        conn.execute(
+            update(table)
+            .where(table.c.id == cid)
+            .values(last_turn_index=func.coalesce(table.c.last_turn_index, 0) + len(msgs), updated_at=now)
+        )
+        last = conn.execute(select(table.c.last_turn_index).where(table.c.id == cid)).scalar_one()
+        conv = session.identity_map.get(session.identity_key(Conversation, cid))
+        if conv is not None:
+            set_committed_value(conv, "last_turn_index", last)
+            set_committed_value(conv, "updated_at", now)
+
+        first = last - len(msgs) + 1
+        for i, m in enumerate(msgs):
+            m.turn_index = first + i
+            # ghi xuyên vào conversation memory khi session commit
+            memory.record_message(session, {
+                "conversation_id": cid,
+                "role": m.role,
+                "content": m.content,
+                "turn_index": m.turn_index,
+            })
+
+
+def get_last_messages(
+    conversation_id: int,
+    limit: int = 5,
+    db: Optional[Session] = None,
+) -> List[Dict[str, Any]]:
     """
     Lấy lại các message gần nhất (role + content + turn_index) theo thứ tự thời gian.
+    Khi dùng session của request, gộp cả các message đã save_message nhưng chưa commit.
+    CONV_MEMORY=1: đọc từ conversation memory (load từ DB lần đầu), không query DB.
     """
-    db = SessionLocal()
+    if memory.CONV_MEMORY and limit <= memory.CONV_MEMORY_SIZE:
+        store = memory.get_store()
+        if not store.is_loaded(conversation_id):
+            _load_memory(conversation_id, db)
+        # + message session này đã flush nhưng chưa commit (turn_index thật, cấp lúc flush)
+        by_turn = {m["turn_index"]: m for m in store.tail(conversation_id, limit)}
+        by_turn.update((m["turn_index"], m) for m in memory.pending_messages(db, conversation_id))
+        return _with_pending([by_turn[t] for t in sorted(by_turn)], db, conversation_id, limit)
+
+    db, owned = _open_session(db)
     try:
         msgs = (
             db.query(Message)
@@ -291,24 +483,104 @@ def get_last_messages(conversation_id: int, limit: int = 5) -> List[Dict[str, An
             .limit(limit)
             .all()
         )
-        msgs = list(reversed(msgs))
-        return [
+        rows = [
             {"role": m.role, "content": m.content, "turn_index": m.turn_index}
-            for m in msgs
+            for m in reversed(msgs)
         ]
+        return _with_pending(rows, db, conversation_id, limit)
     finally:
-        db.close()
+        if owned:
+            db.close()
+
+
+def _with_pending(
+    rows: List[Dict[str, Any]],
+    db: Optional[Session],
+    conversation_id: int,
+    limit: int,
+) -> List[Dict[str, Any]]:
+    """
+    Nối message chưa ghi xong SAU các message đã có trong DB (rows, theo turn_index).
+    Không gộp theo turn_index: turn tạm của message chưa flush có thể trùng turn mà request khác
+    vừa commit. Message trong journal đã có turn thật, chỉ bỏ cái vừa ghi xong (đã nằm trong rows).
+    """
+    seen = {m["turn_index"] for m in rows}
+    pending = [m for m in _journal_pending(conversation_id) if m["turn_index"] not in seen]
+    return (rows + pending + _unsaved_messages(db, conversation_id))[-limit:]
+
+
+def _unsaved_messages(db: Optional[Session], conversation_id: int) -> List[Dict[str, Any]]:
+    """Message đã save_message vào session này nhưng chưa flush (turn_index tạm), theo thứ tự lưu."""
+    if db is None:
+        return []
+    return [
+        {"role": m.role, "content": m.content, "turn_index": m.turn_index}
+        for m in db.info.get(_UNSAVED_KEY, ())
+        if m.conversation_id == conversation_id and m in db.new
+    ]
+
+
+def _journal_pending(conversation_id: int) -> List[Dict[str, Any]]:
+    if not journal.journal_enabled():
+        return []
+    return journal.get_journal().pending_messages(conversation_id)
+
+
+def _refresh_memory(conv: Conversation, db: Session) -> None:
+    """
+    Store local (mỗi worker 1 bản) chỉ thấy message ghi trong process này. Mỗi lượt chat đều bắt đầu
+    bằng start_or_get_conversation, nên so last_turn_index vừa đọc (không tốn thêm query) với turn cuối
+    trong bộ nhớ: DB đi trước → worker khác đã ghi → load lại. Trong lượt, get_last_messages tin bộ nhớ.
+    """
+    if not memory.CONV_MEMORY:
+        return
+    store = memory.get_store()
+    if store.shared or not store.is_loaded(conv.id):
+        return
+    known = [m["turn_index"] for m in store.tail(conv.id, 1)]
+    known += [m["turn_index"] for m in memory.pending_messages(db, conv.id)]
+    if (conv.last_turn_index or 0) > max(known, default=0):
+        _load_memory(conv.id, db)
+
+
+def _load_memory(conversation_id: int, db: Optional[Session] = None) -> None:
+    """Nạp CONV_MEMORY_SIZE message đã commit gần nhất + last_summary vào conversation memory."""
+    db, owned = _open_session(db)
+    try:
+        msgs = (
+            db.query(Message)
+            .filter_by(conversation_id=conversation_id)
+            .order_by(Message.turn_index.desc())
+            .limit(memory.CONV_MEMORY_SIZE)
+            .all()
+        )
+        msgs = [
+            {"role": m.role, "content": m.content, "turn_index": m.turn_index}
+            for m in reversed(msgs)
+        ]
+        conv = db.get(Conversation, conversation_id)
+        summary = conv.last_summary if conv is not None else None
+        # last_summary không lưu tóm tắt tới lượt nào: coi như phủ hết phần trước các message vừa load
+        summary_upto = msgs[0]["turn_index"] - 1 if summary and msgs else 0
+        memory.get_store().load(conversation_id, msgs, summary, summary_upto)
+    finally:
+        if owned:
+            db.close()
 
 # ========================================================
 # HIGH-LEVEL TOOLS CHO LLM / ORCHESTRATOR
 # ========================================================
 
-def tool_get_book_detail(book_id: str) -> Optional[Dict[str, Any]]:
+def tool_get_book_detail(book_id: str, db: Optional[Session] = None) -> Optional[Dict[str, Any]]:
     """
     Tool: get_book_detail
     Mục đích: Lấy thông tin chi tiết đầy đủ của 1 cuốn sách.
     """
-    db = SessionLocal()
+    snap = catalog.get_catalog()
+    if snap is not None:
+        return snap.detail(book_id)
+
+    db, owned = _open_session(db)
     try:
         b = db.get(Book, book_id)
         if not b:
@@ -329,10 +601,11 @@ def tool_get_book_detail(book_id: str) -> Optional[Dict[str, Any]]:
             "introduction": b.introduction, 
         }
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
-def tool_compare_books(book_ids: List[str]) -> List[Dict[str, Any]]:
+def tool_compare_books(book_ids: List[str], db: Optional[Session] = None) -> List[Dict[str, Any]]:
     """
     Tool: compare_books
     Mục đích: Lấy thông tin tóm tắt của nhiều sách để so sánh.
@@ -340,7 +613,11 @@ def tool_compare_books(book_ids: List[str]) -> List[Dict[str, Any]]:
     if not book_ids:
         return []
 
-    db = SessionLocal()
+    snap = catalog.get_catalog()
+    if snap is not None:
+        return snap.compare(book_ids[:5])
+
+    db, owned = _open_session(db)
     try:
         # AN TOÀN: nếu user ycau so sánh quá nhiều sách 1 lúc (10, 20 cuốn trở lên) thì cũng cắt input về ngưỡng min, có thể đưa ra note 
         # khi ng dùng ycau so sánh quá nhiều sách kiểu: để đưa ra kqua tốt nhất thì sẽ chỉ so sánh 5 cuốn đầu tiên hoặc bảo ng dùng chọn 5 cuốn để so sánh thôi
@@ -367,15 +644,20 @@ def tool_compare_books(book_ids: List[str]) -> List[Dict[str, Any]]:
             )
         return result
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
-def tool_get_user_profile(shop_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+def tool_get_user_profile(
+    shop_id: str,
+    user_id: str,
+    db: Optional[Session] = None,
+) -> Optional[Dict[str, Any]]:
     """
     Tool: get_user_profile
     Mục đích: Lấy lại profile user (ngân sách, fav_genres, tránh nội dung,...).
     """
-    db = SessionLocal()
+    db, owned = _open_session(db)
     try:
         prof = (
             db.query(UserProfile)
@@ -397,7 +679,8 @@ def tool_get_user_profile(shop_id: str, user_id: str) -> Optional[Dict[str, Any]
             "content_avoid": prof.content_avoid,
         }
     finally:
-        db.close()
+        if owned:
+            db.close()
 
 
 def tool_add_user_fact(
@@ -406,12 +689,13 @@ def tool_add_user_fact(
     fact_type: str,
     fact_value: str,
     confidence: float = 1.0,
+    db: Optional[Session] = None,
 ) -> Dict[str, Any]:
     """
     Tool: add_user_fact
     Mục đích: Ghi nhớ thông tin mới về user vào DB (Upsert).
     """
-    db = SessionLocal()
+    db, owned = _open_session(db)
     try:
         # 1. Kiểm tra xem fact này đã tồn tại chưa (tránh spam/duplicate)
         existing_fact = db.query(UserFact).filter_by(
@@ -425,7 +709,8 @@ def tool_add_user_fact(
             # Nếu đã có -> Update confidence và thời gian mới nhất
             existing_fact.confidence = confidence
             existing_fact.created_at = datetime.utcnow()
-            db.commit()
+            if owned:
+                db.commit()
             return {"status": "updated", "msg": f"Updated fact: {fact_value}"}
 
         # 2. Nếu chưa có -> Insert mới
@@ -437,11 +722,14 @@ def tool_add_user_fact(
             confidence=confidence,
         )
         db.add(fact)
-        db.commit()
+        if owned:
+            db.commit()
         return {"status": "added", "msg": f"Remembered: {fact_value}"}
         
     except Exception as e:
-        db.rollback()
+        if owned:
+            db.rollback()
         return {"status": "error", "msg": str(e)}
     finally:
-        db.close()
\ No newline at end of file
+        if owned:
+            db.close()
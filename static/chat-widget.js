@@ -4,7 +4,13 @@
     console.log("[KLTN CHAT] Widget script loaded.");
 
     // ========= CONFIG =========
-    const API_ENDPOINT = "/api/chat_rule"; // hoặc "/api/chat_llm"
+    const API_ENDPOINT = "/api/chat_rule"; // hoặc "/api/chat_llm", "/api/chat_orchestrator"
+    // Bật stream: nếu endpoint có bản *_stream thì hiện chữ dần dần theo token LLM
+    const USE_STREAM = true;
+    const STREAM_ENDPOINTS = {
+        "/api/chat_llm": "/api/chat_llm_stream",
+        "/api/chat_orchestrator": "/api/chat_orchestrator_stream",
+    };
     const SHOP_ID = "shop_books_1";
     const USER_ID = "web_demo_user";
 
@@ -100,6 +106,66 @@
             row.appendChild(bubble);
             messagesEl.appendChild(row);
             messagesEl.scrollTop = messagesEl.scrollHeight;
+            return bubble;
+        }
+
+        // Đọc text/event-stream từ fetch, gọi onEvent cho mỗi "data: {...}"
+        async function readEventStream(res, onEvent) {
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder("utf-8");
+            let buffer = "";
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let sep;
+                while ((sep = buffer.indexOf("\n\n")) !== -1) {
+                    const raw = buffer.slice(0, sep);
+                    buffer = buffer.slice(sep + 2);
+                    const dataLines = raw
+                        .split("\n")
+                        .filter((l) => l.startsWith("data:"))
+                        .map((l) => l.slice(5).trim());
+                    if (!dataLines.length) continue;
+                    let ev;
+                    try {
+                        ev = JSON.parse(dataLines.join("\n"));
+                    } catch (e) {
+                        console.warn("[KLTN CHAT] Bad SSE event:", raw);
+                        continue;
+                    }
+                    onEvent(ev);
+                }
+            }
+        }
+
+        // Render reply dần dần trong 1 bubble bot
+        async function renderStreamingReply(res) {
+            const bubble = appendMessage("bot", "…");
+            let text = "";
+            let finished = false;
+
+            await readEventStream(res, (ev) => {
+                if (ev.type === "delta") {
+                    text += ev.content || "";
+                    bubble.innerText = text;
+                    messagesEl.scrollTop = messagesEl.scrollHeight;
+                } else if (ev.type === "tool") {
+                    statusEl.textContent = "Đang tra cứu dữ liệu...";
+                } else if (ev.type === "done") {
+                    finished = true;
+                    bubble.innerText = ev.reply || text || "(Không có nội dung trả lời)";
+                } else if (ev.type === "error") {
+                    throw new Error(ev.detail || "stream error");
+                }
+            });
+
+            statusEl.textContent = "";
+            if (!finished && !text) {
+                throw new Error("Stream kết thúc khi chưa có nội dung");
+            }
         }
 
         // ==== CHỐT QUAN TRỌNG: CHẶN GỬI ĐÒN 2 ====
@@ -128,7 +194,11 @@
                     message: text,
                 });
 
-                const res = await fetch(API_ENDPOINT, {
+                const streamEndpoint = USE_STREAM
+                    ? STREAM_ENDPOINTS[API_ENDPOINT]
+                    : null;
+
+                const res = await fetch(streamEndpoint || API_ENDPOINT, {
                     method: "POST",
                     headers: {
                         "Content-Type": "application/json",
@@ -147,6 +217,11 @@
                     throw new Error("HTTP " + res.status);
                 }
 
+                if (streamEndpoint) {
+                    await renderStreamingReply(res);
+                    return;
+                }
+
                 const data = await res.json();
                 console.log("[KLTN CHAT] Response JSON:", data);
 
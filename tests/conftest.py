@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog
+import memory
+import query_cache
+from response_cache import response_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    """
+    QUERY_CACHE / CONV_MEMORY / PRE_ROUTER giữ mặc định như production. Mỗi test dùng DB ảo riêng
+    (id conversation, fingerprint catalog lặp lại giữa các DB) → bắt đầu với cache và bộ nhớ trống.
+    Test nào cần tắt cache thì tự monkeypatch.
+    """
+    memory.set_store(None)
+    query_cache.clear_all()
+    response_cache.clear()
+    catalog.invalidate_catalog()
+    catalog._version = None
+    catalog._genres = None
+    yield
+    memory.set_store(None)
+    query_cache.clear_all()
+    response_cache.clear()
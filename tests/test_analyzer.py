@@ -0,0 +1,35 @@
+import sys
+import os
+import unicodedata
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analyzer import Analyzer, fold_diacritics
+from index_format import MmapIndex, build_index_file
+
+
+def test_analyzer_pipeline():
+    an = Analyzer(fold=True, bigrams=True, stopwords=["của"])
+    assert an.analyze("Giao hàng của Shop") == ["giao", "hang", "shop", "giao_hang", "hang_shop"]
+
+    # NFD (gõ từ mobile) và NFC ra cùng token
+    nfd = unicodedata.normalize("NFD", "Đổi trả")
+    assert an.analyze(nfd) == an.analyze("Đổi trả") == ["doi", "tra", "doi_tra"]
+
+    assert fold_diacritics("đường Đà Lạt") == "duong Da Lat"
+    assert Analyzer(fold=False, bigrams=False, stopwords=()).analyze("giao hàng") == ["giao", "hàng"]
+
+
+def test_query_without_diacritics_matches(tmp_path):
+    docs = [
+        {"id": "A", "source": "FAQ:A", "title": "Giao hàng", "chunk_text": "giao hàng toàn quốc"},
+        {"id": "B", "source": "FAQ:B", "title": "Thanh toán", "chunk_text": "hàng giao khi thanh toán"},
+    ]
+    an = Analyzer(fold=True, bigrams=True, stopwords=())
+    path = str(tmp_path / "idx.bin")
+    build_index_file(path, docs, an, version=1)
+    index = MmapIndex(path, 1.2, 0.75)
+    ranked = index.search(an.analyze("giao hang"), top_k=2)
+    # cả 2 doc đều có "giao", "hàng" nhưng chỉ A có đúng cụm "giao hàng"
+    assert [index.doc(i)["id"] for i, _ in ranked] == ["A", "B"]
+    assert ranked[0][1] > ranked[1][1]
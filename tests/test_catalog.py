@@ -0,0 +1,95 @@
+import sys
+import os
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("numpy")
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from unittest.mock import patch
+
+from models import Base, Book
+from catalog import CatalogSnapshot
+from sql_tools import find_books_by_filter, tool_compare_books, tool_get_book_detail
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine, autoflush=False)()
+
+    session.add_all([
+        Book(id="B001", title="Sách 1", price_vnd=50000, pages=100, genres_primary="Fiction", rating_avg=4.5, stock=10),
+        Book(id="B002", title="Sách 2", price_vnd=150000, pages=300, genres_primary="Fiction", rating_avg=4.0, stock=5),
+        Book(id="B003", title="Sách 3", price_vnd=200000, pages=500, genres_primary="Science", rating_avg=3.5, stock=0),
+        Book(id="B004", title="Sách 4", price_vnd=300000, pages=200, genres_primary="Fiction", rating_avg=5.0, stock=2),
+        Book(id="B005", title="Sách 5", price_vnd=40000, pages=150, genres_primary="Self-help", rating_avg=4.2, stock=20),
+        Book(id="B006", title="Sách 6", price_vnd=60000, pages=100, genres_primary="Self-help", rating_avg=4.2, stock=10),
+        Book(id="B007", title="Sách 7", price_vnd=None, pages=None, genres_primary=None, rating_avg=None, stock=None),
+    ])
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"limit": 2},
+    {"genre": "Fiction"},
+    {"genre": "self help"},
+    {"genre": "self"},
+    {"genre": "Horror"},
+    {"budget_max": 100000},
+    {"page_min": 150, "page_max": 300},
+    {"genre": "fiction", "budget_max": 200000, "limit": 1},
+])
+def test_snapshot_matches_sql(db_session, kwargs, monkeypatch):
+    """Snapshot NumPy phải trả đúng như bản SQL (cùng thứ tự, cùng field)"""
+    # so 2 đường tính thật, không để lần gọi thứ 2 lấy kết quả cache của lần đầu
+    monkeypatch.setattr("query_cache.QUERY_CACHE", False)
+    with patch("sql_tools.SessionLocal", return_value=db_session):
+        expected = find_books_by_filter(shop_id="shop1", **kwargs)
+
+    snap = CatalogSnapshot.load(db_session)
+    with patch("catalog.get_catalog", return_value=snap):
+        got = find_books_by_filter(shop_id="shop1", **kwargs)
+
+    assert got == expected
+
+
+def test_snapshot_detail_and_compare(db_session):
+    with patch("sql_tools.SessionLocal", return_value=db_session):
+        detail = tool_get_book_detail("B002")
+        compare = tool_compare_books(["B004", "B001", "B999"])
+
+    snap = CatalogSnapshot.load(db_session)
+    with patch("catalog.get_catalog", return_value=snap):
+        assert tool_get_book_detail("B002") == detail
+        assert tool_get_book_detail("B999") is None
+        got = tool_compare_books(["B004", "B001", "B999"])
+
+    assert sorted(got, key=lambda b: b["book_id"]) == sorted(compare, key=lambda b: b["book_id"])
+
+
+def test_catalog_genres_follow_catalog_version(db_session, monkeypatch):
+    import catalog
+
+    version = [(7, None)]
+    monkeypatch.setattr(catalog, "_genres", None)
+    monkeypatch.setattr(catalog, "catalog_version", lambda: version[0])
+    with patch("catalog.get_catalog", return_value=None), patch("catalog.SessionLocal", return_value=db_session):
+        assert catalog.catalog_genres() == {"fiction", "science", "self-help"}
+
+        db_session.add(Book(id="B008", title="Sách 8", genres_primary="Finance"))
+        db_session.commit()
+        assert "finance" not in catalog.catalog_genres()   # catalog chưa đổi version → dùng bản cũ
+        version[0] = (8, None)
+        assert "finance" in catalog.catalog_genres()
+
+    snap = CatalogSnapshot.load(db_session)
+    with patch("catalog.get_catalog", return_value=snap):
+        assert catalog.catalog_genres() == {"fiction", "science", "self-help", "finance"}
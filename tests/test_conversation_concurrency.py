@@ -0,0 +1,168 @@
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "scripts"))
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Conversation, Message
+from sql_tools import get_last_messages, save_message, start_or_get_conversation
+import upgrade_db
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    # DB file (không phải :memory:) để mỗi thread có connection / transaction riêng như production
+    engine = create_engine(f"sqlite:///{tmp_path / 'conv.sqlite3'}", connect_args={"timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def _pragmas(dbapi_conn, _):
+        dbapi_conn.execute("PRAGMA journal_mode=WAL")
+
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def _run_threads(n, target):
+    barrier = threading.Barrier(n)
+    errors = []
+
+    def worker(i):
+        try:
+            barrier.wait()
+            target(i)
+        except Exception as e:  # pragma: no cover - chỉ để báo lỗi từ thread
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def test_start_or_get_conversation_race_creates_one_row(session_factory):
+    ids = []
+
+    def target(i):
+        db = session_factory()
+        try:
+            ids.append(start_or_get_conversation("shop_A", f"user_{i}", "sess_race", db=db).id)
+        finally:
+            db.close()
+
+    _run_threads(8, target)
+
+    db = session_factory()
+    assert db.query(Conversation).count() == 1
+    assert set(ids) == {db.query(Conversation).one().id}
+    db.close()
+
+
+def test_concurrent_saves_get_unique_turn_indexes(session_factory):
+    db = session_factory()
+    conv_id = start_or_get_conversation("shop_A", "user_1", "sess_turns", db=db).id
+    db.close()
+
+    def target(i):
+        # mỗi "request" 1 session: ghi user + assistant rồi commit 1 lần
+        db = session_factory()
+        try:
+            save_message(conv_id, "user", f"hỏi {i}", db=db)
+            save_message(conv_id, "assistant", f"đáp {i}", db=db)
+            db.commit()
+        finally:
+            db.close()
+
+    _run_threads(6, target)
+
+    db = session_factory()
+    turns = sorted(m.turn_index for m in db.query(Message).filter_by(conversation_id=conv_id))
+    assert turns == list(range(1, 13))
+    assert db.get(Conversation, conv_id).last_turn_index == 12
+    # user/assistant của cùng 1 request nằm liền nhau
+    msgs = get_last_messages(conv_id, limit=12, db=db)
+    for user_msg, reply in zip(msgs[::2], msgs[1::2]):
+        assert user_msg["content"].replace("hỏi", "đáp") == reply["content"]
+    db.close()
+
+
+def test_unsaved_message_does_not_hide_committed_turn(session_factory):
+    db = session_factory()
+    conv_id = start_or_get_conversation("shop_A", "user_1", "sess_overlap", db=db).id
+
+    # request này lưu câu hỏi (turn tạm = 1, chưa commit) ...
+    save_message(conv_id, "user", "câu của request này", db=db)
+
+    # ... trong lúc request khác commit trước, lấy đúng turn 1
+    other = session_factory()
+    save_message(conv_id, "user", "câu của request khác", db=other)
+    other.commit()
+    other.close()
+
+    contents = [m["content"] for m in get_last_messages(conv_id, limit=5, db=db)]
+    assert contents == ["câu của request khác", "câu của request này"]
+
+    db.commit()
+    turns = sorted(m.turn_index for m in db.query(Message).filter_by(conversation_id=conv_id))
+    assert turns == [1, 2]
+    db.close()
+
+
+def test_upgrade_merges_duplicate_conversations(tmp_path, monkeypatch):
+    """DB cũ đã có conversation trùng (shop_id, session_id): upgrade gộp lại rồi mới tạo unique index."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.sqlite3'}")
+    with engine.begin() as conn:
+        # bảng conversations kiểu cũ, chưa có uq_conv_shop_session
+        conn.execute(text(
+            "CREATE TABLE conversations (id INTEGER PRIMARY KEY, shop_id VARCHAR(64) NOT NULL, "
+            "user_id VARCHAR(64), session_id VARCHAR(128) NOT NULL, title TEXT, last_summary TEXT, "
+            "last_turn_index INTEGER, created_at DATETIME, updated_at DATETIME)"
+        ))
+    Base.metadata.create_all(bind=engine)
+
+    t0 = datetime(2026, 1, 1)
+    db = sessionmaker(bind=engine)()
+    first = Conversation(shop_id="shop_A", session_id="dup", user_id="u1", last_summary="cũ",
+                         last_turn_index=2, created_at=t0, updated_at=t0)
+    second = Conversation(shop_id="shop_A", session_id="dup", user_id="u1", last_turn_index=2,
+                          created_at=t0 + timedelta(seconds=1), updated_at=t0 + timedelta(minutes=5))
+    db.add_all([first, second])
+    db.flush()
+    # 2 request song song, mỗi bên ghi turn 1, 2 vào conversation riêng của mình
+    for conv, turn, minute, content in [
+        (first, 1, 0, "hỏi 1"), (second, 1, 1, "hỏi 2"), (first, 2, 2, "đáp 1"), (second, 2, 3, "đáp 2"),
+    ]:
+        db.add(Message(conversation_id=conv.id, role="user" if turn == 1 else "assistant",
+                       content=content, turn_index=turn, created_at=t0 + timedelta(minutes=minute)))
+    db.commit()
+    first_id = first.id
+    db.close()
+
+    monkeypatch.setattr(upgrade_db, "engine", engine)
+    upgrade_db.upgrade()
+
+    names = {i["name"] for i in inspect(engine).get_indexes("conversations")}
+    assert "uq_conv_shop_session" in names
+
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    conv = db.query(Conversation).one()
+    assert conv.id == first_id and conv.last_turn_index == 4 and conv.last_summary is None
+    msgs = db.query(Message).order_by(Message.turn_index).all()
+    assert [(m.turn_index, m.content) for m in msgs] == [(1, "hỏi 1"), (2, "hỏi 2"), (3, "đáp 1"), (4, "đáp 2")]
+    assert {m.conversation_id for m in msgs} == {first_id}
+
+    # ON CONFLICT của start_or_get_conversation chạy được trên DB đã upgrade
+    assert start_or_get_conversation("shop_A", "u1", "dup", db=db).id == first_id
+    assert start_or_get_conversation("shop_A", "u1", "new", db=db).id != first_id
+    db.close()
+    engine.dispose()
@@ -0,0 +1,87 @@
+import sys
+import os
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dense import DenseIndex, quantize, rrf_fuse
+
+
+def _unit(rng, n, dim):
+    v = rng.normal(size=(n, dim)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def test_dense_index_ivf_search(tmp_path):
+    rng = np.random.default_rng(1)
+    vecs = _unit(rng, 200, 32)
+    ids = [f"D{i}" for i in range(200)]
+    sources = [("FAQ:" if i % 2 else "BOOK:") + ids[i] for i in range(200)]
+
+    q, scale = quantize(vecs)
+    assert q.dtype == np.int8
+    assert np.abs(q * scale[:, None] - vecs).max() < 0.01
+
+    index = DenseIndex.build(vecs, ids, sources, n_lists=8, meta={"model": "m"})
+    index.save(str(tmp_path / "dense"))
+    loaded = DenseIndex.load(str(tmp_path / "dense"))
+    assert loaded.meta["model"] == "m"
+
+    # quét hết cụm → đúng như brute force
+    query = vecs[17]
+    exact = [ids[i] for i in np.argsort(-(vecs @ query))[:5]]
+    assert [i for i, _ in loaded.search(query, 5, nprobe=8)] == exact
+    # chỉ quét 2 cụm vẫn tìm ra chính nó
+    assert loaded.search(query, 1, nprobe=2)[0][0] == "D17"
+
+    faq = loaded.search(query, 5, source_prefix="FAQ:", nprobe=8)
+    assert len(faq) == 5 and all(int(i[1:]) % 2 for i, _ in faq)
+
+
+def test_rrf_fuse():
+    fused = rrf_fuse([["a", "b", "c"], ["c", "a", "d"]], k=60)
+    assert [doc_id for doc_id, _ in fused] == ["a", "c", "b", "d"]
+
+
+def test_query_and_documents_share_normalization(monkeypatch):
+    import dense
+
+    seen = []
+    monkeypatch.setattr(dense, "encode", lambda texts, batch_size=64: seen.extend(texts) or np.ones((len(texts), 4), np.float32))
+    dense._encode_query.cache_clear()
+    dense.encode_documents(["Sherlock  Holmes\nToàn Tập"])
+    dense.encode_query("  sherlock holmes TOÀN tập ")
+    dense._encode_query.cache_clear()
+    assert seen[0] == seen[1] == "sherlock holmes toàn tập"
+
+
+def test_dense_index_reloads_after_rebuild(tmp_path, monkeypatch):
+    import types
+    import dense
+
+    path = str(tmp_path / "dense")
+    monkeypatch.setitem(sys.modules, "sentence_transformers", types.ModuleType("sentence_transformers"))
+    monkeypatch.setattr(dense, "DENSE_RETRIEVAL", True)
+    monkeypatch.setattr(dense, "DENSE_INDEX_DIR", path)
+    monkeypatch.setattr(dense, "DENSE_RELOAD_INTERVAL", 0)
+    monkeypatch.setattr(dense, "_dense", None)
+    monkeypatch.setattr(dense, "_dense_file_id", None)
+    monkeypatch.setattr(dense, "_dense_checked", 0.0)
+    monkeypatch.setattr(dense, "_dense_failed", False)
+
+    rng = np.random.default_rng(2)
+    meta = {"model": dense.DENSE_MODEL, "text_normalization": dense.TEXT_NORMALIZATION}
+    assert dense.get_dense_index() is None   # chưa build
+
+    DenseIndex.build(_unit(rng, 10, 8), [f"A{i}" for i in range(10)], ["BOOK:"] * 10, meta=dict(meta, built_at=1)).save(path)
+    first = dense.get_dense_index()
+    assert first.meta["built_at"] == 1 and dense.get_dense_index() is first
+
+    DenseIndex.build(_unit(rng, 12, 8), [f"B{i}" for i in range(12)], ["BOOK:"] * 12, meta=dict(meta, built_at=2)).save(path)
+    second = dense.get_dense_index()
+    assert second.meta["built_at"] == 2 and len(second) == 12
+
+    # bản build với chuẩn hoá khác bị từ chối, vẫn dùng bản đang chạy
+    DenseIndex.build(_unit(rng, 5, 8), [f"C{i}" for i in range(5)], ["BOOK:"] * 5, meta={"model": dense.DENSE_MODEL}).save(path)
+    assert dense.get_dense_index() is second
@@ -0,0 +1,41 @@
+import sys
+import os
+import csv
+import importlib.util
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analyzer import DEFAULT_ANALYZER
+from index_format import build_index_file
+
+_spec = importlib.util.spec_from_file_location(
+    "generate_retriever_index",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "generate_retriever_index.py"),
+)
+gen = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(gen)
+
+
+DOCS = [
+    {"id": "F1", "source": "FAQ:F1", "title": "Giao hàng", "chunk_text": "giao hàng nhanh giao hàng tận nơi"},
+    {"id": "B1", "source": "BOOK:b1", "title": "Trinh thám", "chunk_text": "vụ án giao hàng bí ẩn"},
+    {"id": "F2", "source": "FAQ:F2", "title": "Đổi trả", "chunk_text": "đổi trả trong 7 ngày"},
+    {"id": "B2", "source": "BOOK:b2", "title": "Sách dài", "chunk_text": "giao" + " chữ" * 50},
+]
+
+
+def test_external_merge_build_matches_in_memory(tmp_path):
+    csv_path = tmp_path / "chunks.csv"
+    with open(csv_path, "w", encoding="utf-8-sig", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=["id", "source", "title", "chunk_text"])
+        w.writeheader()
+        w.writerows(DOCS)
+
+    expected = tmp_path / "expected.bin"
+    build_index_file(str(expected), DOCS, DEFAULT_ANALYZER, version=3)
+
+    # run_size nhỏ → nhiều run, phải merge
+    out = tmp_path / "out.bin"
+    info = gen.build([str(csv_path)], str(out), workers=1, run_size=4, version=3, tmp_dir=str(tmp_path))
+    assert info["n_docs"] == 4
+    assert out.read_bytes() == expected.read_bytes()
@@ -0,0 +1,132 @@
+import csv
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "scripts"))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Book
+from import_data import import_books_bulk, import_books_rowwise, validate_book_chunk
+
+FIELDS = ["id", "title", "authors", "genres_primary", "age_rating", "pages", "price_vnd",
+          "year", "introduction", "short_summary", "publisher", "rating_avg", "stocks"]
+
+
+def _write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: row.get(k, "") for k in FIELDS})
+
+
+def _book(i, **kw):
+    row = {"id": f"B{i:03d}", "title": f"Sách {i}", "genres_primary": "Fiction",
+           "pages": "200", "price_vnd": str(50000 + i), "stocks": "7", "rating_avg": "4.5"}
+    row.update(kw)
+    return row
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'books.sqlite3'}")
+    Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def test_validate_book_chunk_rejects_bad_rows():
+    records, errors = validate_book_chunk([
+        _book(1),
+        _book(2, price_vnd="abc"),
+        _book(3, stocks="-1"),
+        _book(4, title=""),
+        _book(1, price_vnd="99000"),   # trùng id trong lô: dòng sau thắng
+    ])
+    assert [r["id"] for r in records] == ["B001"]
+    assert records[0]["price_vnd"] == 99000
+    assert records[0]["stock"] == 7
+    assert records[0]["genre_code"] == "fiction"
+    assert [e[0] for e in errors] == ["B002", "B003", "B004"]
+
+
+def test_import_books_bulk_upserts_in_chunks(tmp_path, session_factory):
+    path = tmp_path / "books.csv"
+    _write_csv(path, [_book(i) for i in range(1, 11)] + [_book(11, pages="x")])
+
+    stats = import_books_bulk(str(path), chunk_size=3, session_factory=session_factory)
+    assert stats["rows"] == 10
+    assert len(stats["errors"]) == 1
+
+    db = session_factory()
+    first = db.get(Book, "B001")
+    created_at = first.created_at
+    assert db.query(Book).count() == 10
+    assert first.stock == 7
+    db.close()
+
+    # nạp lại: sách cũ được cập nhật (không trùng khoá), created_at giữ nguyên
+    _write_csv(path, [_book(1, price_vnd="120000", stocks="0"), _book(12)])
+    import_books_bulk(str(path), chunk_size=3, session_factory=session_factory)
+
+    db = session_factory()
+    first = db.get(Book, "B001")
+    assert db.query(Book).count() == 11
+    assert (first.price_vnd, first.stock) == (120000, 0)
+    assert first.created_at == created_at
+    assert first.updated_at > created_at
+    db.close()
+
+
+def test_bulk_matches_rowwise_import(tmp_path, session_factory, monkeypatch):
+    import import_data
+
+    path = tmp_path / "books.csv"
+    _write_csv(path, [_book(i) for i in range(1, 6)])
+    import_books_bulk(str(path), session_factory=session_factory)
+
+    other = tmp_path / "rowwise.sqlite3"
+    engine = create_engine(f"sqlite:///{other}")
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(import_data, "SessionLocal", sessionmaker(bind=engine))
+    import_books_rowwise(str(path))
+
+    cols = ["id", "title", "authors", "publisher", "genre_code", "pages", "price_vnd", "stock", "rating_avg"]
+    bulk_db, row_db = session_factory(), sessionmaker(bind=engine)()
+    bulk = [tuple(getattr(b, c) for c in cols) for b in bulk_db.query(Book).order_by(Book.id)]
+    rowwise = [tuple(getattr(b, c) for c in cols) for b in row_db.query(Book).order_by(Book.id)]
+    assert bulk == rowwise
+    bulk_db.close()
+    row_db.close()
+    engine.dispose()
+
+
+def test_reimport_unchanged_file_keeps_updated_at(tmp_path, session_factory):
+    path = tmp_path / "books.csv"
+    _write_csv(path, [_book(1, rating_avg="4.3"), _book(2, authors="Nam Cao")])
+    import_books_bulk(str(path), session_factory=session_factory)
+
+    db = session_factory()
+    before = {b.id: b.updated_at for b in db.query(Book)}
+    assert db.get(Book, "B001").authors is None   # ô trống → NULL, không phải ""
+    db.close()
+
+    # nạp lại y nguyên: không sách nào bị update → catalog_version không đổi
+    import_books_bulk(str(path), session_factory=session_factory)
+    db = session_factory()
+    assert {b.id: b.updated_at for b in db.query(Book)} == before
+    db.close()
+
+    # chỉ sách đổi giá mới có updated_at mới
+    _write_csv(path, [_book(1, rating_avg="4.3", price_vnd="70000"), _book(2, authors="Nam Cao")])
+    import_books_bulk(str(path), session_factory=session_factory)
+    db = session_factory()
+    after = {b.id: b.updated_at for b in db.query(Book)}
+    assert after["B001"] > before["B001"] and after["B002"] == before["B002"]
+    db.close()
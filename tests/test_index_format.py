@@ -0,0 +1,79 @@
+import math
+import sys
+import os
+from collections import Counter
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analyzer import Analyzer
+from index_format import IndexFormatError, MmapIndex, build_index_file, doc_text
+
+
+DOCS = [
+    {"id": "B1", "source": "BOOK:b1", "title": "Trinh thám", "chunk_text": "vụ án giao hàng bí ẩn"},
+    {"id": "F1", "source": "FAQ:F1", "title": "Giao hàng", "chunk_text": "giao hàng nhanh giao hàng tận nơi"},
+    {"id": "F2", "source": "FAQ:F2", "title": "Đổi trả", "chunk_text": "đổi trả trong 7 ngày"},
+    {"id": "B2", "source": "BOOK:b2", "title": "Sách dài", "chunk_text": "giao " + "chữ " * 50},
+]
+
+
+def _ids(index, ranked):
+    return [(index.doc(i)["id"], round(s, 9)) for i, s in ranked]
+
+
+def _reference_bm25(docs, an, tokens, top_k, prefix, k1=1.2, b=0.75):
+    """BM25 tính thẳng theo công thức trên toàn bộ doc, để đối chiếu với index trên file."""
+    counts = [Counter(an.analyze(doc_text(d))) for d in docs]
+    lens = [sum(c.values()) for c in counts]
+    avgdl = sum(lens) / len(docs)
+    scores = {}
+    for t in set(tokens):
+        df = sum(1 for c in counts if t in c)
+        if not df:
+            continue
+        idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        for d, c in zip(docs, counts):
+            if t not in c or (prefix and not d["source"].startswith(prefix)):
+                continue
+            norm = k1 * (1 - b + b * lens[docs.index(d)] / avgdl)
+            scores[d["id"]] = scores.get(d["id"], 0.0) + idf * c[t] * (k1 + 1) / (c[t] + norm)
+    top = sorted(scores.items(), key=lambda kv: -kv[1])[:top_k]
+    return [(doc_id, round(s, 9)) for doc_id, s in top]
+
+
+def test_mmap_index_matches_reference_bm25(tmp_path):
+    an = Analyzer(fold=True, bigrams=True, stopwords=["trong"])
+    path = str(tmp_path / "idx.bin")
+    info = build_index_file(path, DOCS, an, version=7)
+    assert info["n_docs"] == 4 and info["n_parts"] == 2
+
+    mm = MmapIndex(path, k1=1.2, b=0.75, verify=True)
+    assert mm.version == 7
+    assert mm.analyzer.analyze("Đổi trả trong") == an.analyze("Đổi trả trong")
+
+    for q in ["giao hang", "đổi trả", "chữ giao", "không có"]:
+        tokens = an.analyze(q)
+        for prefix in [None, "FAQ:", "BOOK", "BOOK:b2", "NEWS:"]:
+            assert _ids(mm, mm.search(tokens, 3, prefix)) == _reference_bm25(DOCS, an, tokens, 3, prefix)
+
+    # doc gom theo partition nhưng nội dung giữ nguyên
+    assert sorted(mm.doc(i)["id"] for i in range(mm.n_docs)) == ["B1", "B2", "F1", "F2"]
+    assert mm.doc(0) == {k: DOCS[0][k] for k in ("id", "source", "title", "chunk_text")}
+
+
+def test_mmap_index_rejects_bad_file(tmp_path):
+    path = tmp_path / "idx.bin"
+    build_index_file(str(path), DOCS, Analyzer(), version=1)
+
+    data = bytearray(path.read_bytes())
+    data[len(data) // 2] ^= 0xFF
+    path.write_bytes(bytes(data))
+    MmapIndex(str(path), 1.2, 0.75)  # không verify thì vẫn mở được
+    with pytest.raises(IndexFormatError):
+        MmapIndex(str(path), 1.2, 0.75, verify=True)
+
+    path.write_bytes(b"not an index" * 20)
+    with pytest.raises(IndexFormatError):
+        MmapIndex(str(path), 1.2, 0.75)
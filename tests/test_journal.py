@@ -0,0 +1,88 @@
+# tests/test_journal.py
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from journal import MessageJournal
+from models import Base, Conversation, Message
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autoflush=False, bind=engine)
+    db = factory()
+    db.add_all([
+        Conversation(id=1, shop_id="shop", session_id="s1", last_turn_index=4),
+        Conversation(id=2, shop_id="shop", session_id="s2", last_turn_index=0),
+    ])
+    db.commit()
+    db.close()
+    return factory
+
+
+def _rows(factory):
+    db = factory()
+    try:
+        msgs = db.query(Message).order_by(Message.conversation_id, Message.turn_index).all()
+        convs = {c.id: c.last_turn_index for c in db.query(Conversation)}
+        return [(m.conversation_id, m.turn_index, m.content) for m in msgs], convs
+    finally:
+        db.close()
+
+
+def test_async_mode_batches_writes(session_factory):
+    j = MessageJournal(session_factory, mode="async", flush_interval=60)
+    assert j.append(1, "user", "a")["turn_index"] == 5     # tiếp nối last_turn_index trong DB
+    j.append(2, "user", "b")
+    j.append(1, "assistant", "c")
+
+    assert [m["content"] for m in j.pending_messages(1)] == ["a", "c"]
+    assert _rows(session_factory)[0] == []                 # chưa ghi
+
+    assert j.flush() == 3
+    msgs, convs = _rows(session_factory)
+    assert msgs == [(1, 5, "a"), (1, 6, "c"), (2, 1, "b")]
+    assert convs == {1: 6, 2: 1}
+    assert j.pending_messages(1) == []
+    assert j.stats()["batches"] == 1
+    j.stop()
+
+
+def test_group_mode_waits_for_commit(session_factory):
+    j = MessageJournal(session_factory, mode="group", flush_interval=0.01)
+    j.append(2, "user", "xin chào")
+    assert _rows(session_factory)[0] == [(2, 1, "xin chào")]
+    j.stop()
+
+
+def test_stop_flushes_queue(session_factory):
+    j = MessageJournal(session_factory, mode="async", flush_interval=60)
+    j.append(2, "user", "x")
+    j.append(2, "assistant", "y")
+    j.stop()
+    assert [m[2] for m in _rows(session_factory)[0]] == ["x", "y"]
+
+
+def test_bad_row_does_not_block_queue(session_factory, tmp_path):
+    dead = tmp_path / "dead.jsonl"
+    j = MessageJournal(session_factory, mode="async", flush_interval=60, max_retries=2, dead_letter_path=str(dead))
+    j.append(2, "user", "trước")
+    j.append(2, "assistant", None)     # content NOT NULL → dòng này luôn lỗi
+    j.append(2, "user", "sau")
+
+    assert j.flush() == 2              # lô lỗi → ghi từng dòng, chỉ dòng hỏng ở lại
+    assert [m[2] for m in _rows(session_factory)[0]] == ["trước", "sau"]
+    assert _rows(session_factory)[1][2] == 3
+    assert [m["turn_index"] for m in j.pending_messages(2)] == [2]
+
+    j.append(2, "assistant", "mới")
+    assert j.flush() == 1              # lần thử thứ 2 của dòng hỏng → dead letter, message mới vẫn ghi
+    assert j.pending_messages(2) == []
+    assert [m[2] for m in _rows(session_factory)[0]] == ["trước", "sau", "mới"]
+    assert _rows(session_factory)[1][2] == 4
+    assert '"turn_index": 2' in dead.read_text(encoding="utf-8")
+    assert j.stats()["dead_letter"] == 1
+    j.stop()
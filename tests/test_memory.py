@@ -0,0 +1,116 @@
+# tests/test_memory.py
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import memory
+from memory import LocalMemoryStore
+from models import Base, Conversation, Message
+from sql_tools import get_last_messages, save_message, start_or_get_conversation
+
+
+@pytest.fixture
+def db_session(monkeypatch):
+    monkeypatch.setattr(memory, "CONV_MEMORY", True)
+    memory.set_store(LocalMemoryStore(size=40))
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    memory.set_store(None)
+
+
+def test_write_through_after_commit_and_rollback(db_session):
+    conv = start_or_get_conversation("shop", "u1", "s1", db=db_session)
+    save_message(conv.id, "user", "xin chào", db=db_session)
+
+    # chưa commit: memory chưa có, nhưng get_last_messages vẫn thấy message của session này
+    assert memory.get_store().tail(conv.id, 10) == []
+    assert [m["content"] for m in get_last_messages(conv.id, 5, db=db_session)] == ["xin chào"]
+
+    db_session.commit()
+    assert [m["content"] for m in memory.get_store().tail(conv.id, 10)] == ["xin chào"]
+
+    save_message(conv.id, "assistant", "bị rollback", db=db_session)
+    db_session.rollback()
+    assert [m["content"] for m in get_last_messages(conv.id, 5, db=db_session)] == ["xin chào"]
+
+    # đọc từ memory, không query bảng messages
+    db_session.query(Message).delete()
+    db_session.commit()
+    assert [m["content"] for m in get_last_messages(conv.id, 5, db=db_session)] == ["xin chào"]
+
+
+def test_cold_load_from_db_with_summary(db_session):
+    conv = Conversation(shop_id="shop", session_id="s2", last_summary="Khách thích Classic", last_turn_index=3)
+    db_session.add(conv)
+    db_session.flush()
+    for i, role in enumerate(["user", "assistant", "user"], start=1):
+        db_session.add(Message(conversation_id=conv.id, role=role, content=f"m{i}", turn_index=i))
+    db_session.commit()
+
+    assert not memory.get_store().is_loaded(conv.id)
+    assert [m["content"] for m in get_last_messages(conv.id, 2, db=db_session)] == ["m2", "m3"]
+    assert memory.with_summary("SYSTEM", conv.id) == "SYSTEM\n\nTóm tắt các lượt trước của cuộc trò chuyện:\nKhách thích Classic"
+
+
+def test_summarize_folds_old_turns(db_session, monkeypatch):
+    monkeypatch.setattr(memory, "SUMMARY_TAIL", 2)
+    monkeypatch.setattr(memory, "SUMMARY_MIN_NEW", 3)
+    saved = {}
+    monkeypatch.setattr(memory, "_save_summary", lambda cid, summary: saved.update({cid: summary}))
+
+    conv = start_or_get_conversation("shop", "u1", "s3", db=db_session)
+    for i in range(6):
+        save_message(conv.id, "user" if i % 2 == 0 else "assistant", f"m{i}", db=db_session)
+    db_session.commit()
+
+    prompts = []
+
+    async def fake_llm(messages):
+        prompts.append(messages[-1]["content"])
+        return "Khách hỏi sách trinh thám dưới 200k."
+
+    assert asyncio.run(memory.summarize_conversation(conv.id, fake_llm))
+    assert "m3" in prompts[0] and "m4" not in prompts[0]   # 2 message cuối giữ nguyên văn
+    assert saved[conv.id] == "Khách hỏi sách trinh thám dưới 200k."
+    assert memory.get_store().get_summary(conv.id) == ("Khách hỏi sách trinh thám dưới 200k.", 4)
+
+    # chưa đủ message mới ngoài tail → không gọi LLM nữa
+    assert not asyncio.run(memory.summarize_conversation(conv.id, fake_llm))
+
+
+def test_local_store_reloads_turns_written_by_other_worker(db_session):
+    """Store local mặc định + 2 worker: đầu lượt sau, worker này phải thấy message worker kia đã commit."""
+    worker_a, worker_b = memory.get_store(), LocalMemoryStore(size=40)
+    conv = start_or_get_conversation("shop", "u1", "s4", db=db_session)
+    save_message(conv.id, "user", "hỏi ở worker A", db=db_session)
+    db_session.commit()
+    assert [m["content"] for m in get_last_messages(conv.id, 5, db=db_session)] == ["hỏi ở worker A"]
+
+    # lượt kế tiếp được worker B xử lý (ghi vào store của B)
+    memory.set_store(worker_b)
+    start_or_get_conversation("shop", "u1", "s4", db=db_session)
+    get_last_messages(conv.id, 5, db=db_session)
+    save_message(conv.id, "assistant", "trả lời ở worker B", db=db_session)
+    db_session.commit()
+
+    # lượt sau quay lại worker A: đầu lượt so last_turn_index, load lại
+    memory.set_store(worker_a)
+    start_or_get_conversation("shop", "u1", "s4", db=db_session)
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(db_session.get_bind(), "before_cursor_execute", listener)
+    try:
+        assert [m["content"] for m in get_last_messages(conv.id, 5, db=db_session)] == [
+            "hỏi ở worker A",
+            "trả lời ở worker B",
+        ]
+    finally:
+        event.remove(db_session.get_bind(), "before_cursor_execute", listener)
+    assert statements == []   # dựng history chỉ đọc bộ nhớ
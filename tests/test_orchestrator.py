@@ -0,0 +1,238 @@
+# tests/test_orchestrator.py
+import asyncio
+import threading
+import time
+
+import main
+
+
+def test_parse_tool_calls():
+    single = '{"tool": "find_books", "params": {"genre": "Classic"}}'
+    assert main._parse_tool_calls(single) == [{"tool": "find_books", "params": {"genre": "Classic"}}]
+
+    multi = '```json\n{"tool_calls": [{"tool": "get_book_detail", "params": {"book_id": "CL002"}},' \
+            ' {"tool": "get_book_detail", "params": {"book_id": "CL008"}}]}\n```'
+    assert [c["params"]["book_id"] for c in main._parse_tool_calls(multi)] == ["CL002", "CL008"]
+
+    assert main._parse_tool_calls("Chào bạn, mình giúp gì được?") == []
+
+
+def test_read_only_tools_run_concurrently(monkeypatch):
+    seen = []
+
+    def fake_tool(shop_id, user_id, tool_spec, db=None):
+        seen.append((tool_spec["params"]["book_id"], db, threading.get_ident()))
+        time.sleep(0.2)
+        return {"tool": tool_spec["tool"], "params": tool_spec["params"], "result": {"book_id": tool_spec["params"]["book_id"]}}
+
+    monkeypatch.setattr(main, "_run_tool_for_orchestrator", fake_tool)
+    specs = [{"tool": "get_book_detail", "params": {"book_id": f"B{i}"}} for i in range(3)]
+
+    started = time.perf_counter()
+    payloads = asyncio.run(main._run_tool_calls("shop", "u1", specs, db="request-session"))
+    elapsed = time.perf_counter() - started
+
+    assert [p["result"]["book_id"] for p in payloads] == ["B0", "B1", "B2"]   # giữ thứ tự
+    assert elapsed < 0.5
+    assert all(db is None for _, db, _ in seen)   # mỗi tool tự mở session
+
+
+def test_write_tools_run_sequentially_and_errors_are_reported(monkeypatch):
+    def fake_tool(shop_id, user_id, tool_spec, db=None):
+        if tool_spec["tool"] == "bad":
+            raise ValueError("Unknown tool: bad")
+        return {"tool": tool_spec["tool"], "params": {}, "result": db}
+
+    monkeypatch.setattr(main, "_run_tool_for_orchestrator", fake_tool)
+    specs = [{"tool": "add_user_fact"}, {"tool": "get_user_profile"}, {"tool": "bad"}]
+    payloads = asyncio.run(main._run_tool_calls("shop", "u1", specs, db="request-session"))
+
+    assert [p["result"] for p in payloads[:2]] == ["request-session", "request-session"]
+    assert payloads[2]["error"] == "Unknown tool: bad"
+
+
+# ---------------- _orchestrator_decide trên DB ảo ----------------
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from models import Base
+
+FAQ_PAYLOAD_RESULT = [{"id": "FAQ_1", "source": "FAQ:ship", "title": "Phí ship", "chunk_text": "30k", "score": 1.0}]
+
+
+class _FakeIndex:
+    version = (1, 0)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autoflush=False, bind=engine)()
+    monkeypatch.setattr(main, "get_index", lambda: _FakeIndex())
+    calls = []
+
+    def fake_tool(shop_id, user_id, tool_spec, db=None):
+        calls.append(tool_spec)
+        return {"tool": tool_spec["tool"], "params": tool_spec["params"], "result": FAQ_PAYLOAD_RESULT}
+
+    monkeypatch.setattr(main, "_run_tool_for_orchestrator", fake_tool)
+    session.info["tool_calls"] = calls
+    yield session
+    session.close()
+
+
+def _request(session_id, message):
+    return main.ChatRequest(user_id="u1", session_id=session_id, message=message)
+
+
+def test_only_first_turn_is_cacheable(db, monkeypatch):
+    monkeypatch.setattr(main, "RESPONSE_CACHE", True)
+
+    first = asyncio.run(main._orchestrator_decide(_request("s1", "phí ship bao nhiêu"), db))
+    assert first["route"] == "rules" and first["citations"] == ["FAQ_1"]
+    assert first["cacheable"]
+
+    # lượt sau trong cùng conversation: prompt phase 2 có history riêng → không lưu cache
+    second = asyncio.run(main._orchestrator_decide(_request("s1", "phí ship bao nhiêu"), db))
+    assert second["citations"] == ["FAQ_1"]
+    assert not second["cacheable"]
+
+
+def test_repeated_tool_call_runs_once(db, monkeypatch):
+    monkeypatch.setattr(main, "RESPONSE_CACHE", True)
+    call = '{"tool": "search_docs", "params": {"query": "chào shop", "top_k": 3}}'
+
+    async def fake_llm(messages, phase="final"):
+        return call   # LLM cứ gọi lại đúng tool đó
+
+    monkeypatch.setattr(main, "call_llm", fake_llm)
+    decision = asyncio.run(main._orchestrator_decide(_request("s2", "chào shop"), db))
+
+    assert len(db.info["tool_calls"]) == 1
+    assert decision["steps"] == 1
+    assert decision["citations"] == ["FAQ_1"]
+    assert decision["messages_final"] is not None   # dừng vòng, sang phase 2
+    tool_msgs = [m for m in main.get_last_messages(decision["conv"].id, 10, db=db) if m["role"] == "tool"]
+    assert len(tool_msgs) == 1
+
+
+@pytest.fixture
+def chat_app(tmp_path, monkeypatch):
+    """App thật trên DB file tạm (tool tự mở session từ factory này), LLM giả ghi lại prompt."""
+    import catalog
+    import sql_tools
+    from fastapi.testclient import TestClient
+
+    from db import get_db
+    from models import Book
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'chat.sqlite3'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autoflush=False, bind=engine)
+    seed = factory()
+    seed.add_all([
+        Book(id="CL001", title="Bố già", genres_primary="Classic", price_vnd=150000, rating_avg=4.8, stock=3),
+        Book(id="CL002", title="Ông già và biển cả", genres_primary="Classic", price_vnd=90000, rating_avg=4.5, stock=5),
+        Book(id="F001", title="Rừng Na Uy", genres_primary="Fiction", price_vnd=120000, rating_avg=4.2, stock=2),
+    ])
+    seed.commit()
+    seed.close()
+
+    def override_db():
+        db = factory()
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    monkeypatch.setattr(sql_tools, "SessionLocal", factory)
+    monkeypatch.setattr(catalog, "SessionLocal", factory)
+    monkeypatch.setitem(main.app.dependency_overrides, get_db, override_db)
+
+    prompts = []
+
+    async def fake_llm(messages, phase="final"):
+        prompts.append((phase, messages))
+        if phase == "decision":
+            return "Cuốn [CL002.price_vnd] rẻ hơn nè."
+        return "Bạn thử [CL001.price_vnd] hoặc [CL002.price_vnd] nhé."
+
+    async def fake_stream(messages):
+        prompts.append(("final", messages))
+        for part in ["Bạn thử ", "[CL001.price_vnd] ", "nhé."]:
+            yield part
+
+    monkeypatch.setattr(main, "call_llm", fake_llm)
+    monkeypatch.setattr(main, "call_llm_stream", fake_stream)
+    yield TestClient(main.app), factory, prompts
+    engine.dispose()
+
+
+def test_chat_flow_with_production_defaults(chat_app):
+    """/api/chat_orchestrator với QUERY_CACHE, CONV_MEMORY, PRE_ROUTER bật như production."""
+    import memory
+    import query_cache
+    import sql_tools
+
+    assert query_cache.QUERY_CACHE and memory.CONV_MEMORY and main.PRE_ROUTER
+    client, factory, prompts = chat_app
+
+    def chat(session_id, message):
+        resp = client.post("/api/chat_orchestrator", json={"user_id": "u1", "session_id": session_id, "message": message})
+        assert resp.status_code == 200
+        return resp.json()
+
+    # lượt 1: pre-router → find_books (qua query cache) → LLM phase 2
+    first = chat("flow", "Tìm sách kinh điển dưới 200k")
+    assert [b["book_id"] for b in first["used_books"]] == ["CL001", "CL002"]
+    assert [phase for phase, _ in prompts] == ["final"]
+
+    # lượt 2 dựa vào ngữ cảnh → LLM phase 1, history lấy từ conversation memory
+    second = chat("flow", "còn cuốn nào rẻ hơn không?")
+    assert second["reply"] == "Cuốn [CL002.price_vnd] rẻ hơn nè."
+    phase, messages = prompts[-1]
+    assert phase == "decision"
+    contents = [m["content"] for m in messages]
+    assert contents[1] == "Tìm sách kinh điển dưới 200k"
+    assert contents[-1] == "còn cuốn nào rẻ hơn không?"
+    assert "Bạn thử [CL001.price_vnd] hoặc [CL002.price_vnd] nhé." in contents
+
+    with factory() as db:
+        conv_id = sql_tools.start_or_get_conversation("shop_books_1", "u1", "flow", db=db).id
+    assert [m["turn_index"] for m in memory.get_store().tail(conv_id, 10)] == [1, 2, 3, 4, 5]
+
+    # session khác hỏi lại cùng bộ lọc → find_books lấy từ cache
+    hits = query_cache.get_cache("find_books").stats()["hits"]
+    chat("other", "Tìm sách kinh điển dưới 200k")
+    assert query_cache.get_cache("find_books").stats()["hits"] == hits + 1
+
+
+def test_stream_done_event_carries_citations(chat_app, monkeypatch):
+    import json
+
+    client, _, _ = chat_app
+    monkeypatch.setattr(main, "RESPONSE_CACHE", True)   # citations FAQ đi kèm response cache
+    monkeypatch.setattr(main, "get_index", lambda: _FakeIndex())
+    monkeypatch.setattr(main, "_run_tool_for_orchestrator", lambda shop_id, user_id, tool_spec, db=None: {
+        "tool": tool_spec["tool"], "params": tool_spec["params"], "result": FAQ_PAYLOAD_RESULT,
+    })
+
+    def stream(session_id, message):
+        resp = client.post("/api/chat_orchestrator_stream", json={"user_id": "u1", "session_id": session_id, "message": message})
+        return [json.loads(line[len("data:"):]) for line in resp.text.splitlines() if line.startswith("data:")]
+
+    plain = client.post("/api/chat_orchestrator", json={"user_id": "u1", "session_id": "plain", "message": "phí ship bao nhiêu"}).json()
+    assert plain["citations"] == ["FAQ_1"]
+
+    # phase 2 stream từ LLM
+    done = stream("stream", "phí ship giao hàng tính sao")[-1]
+    assert done == {"type": "done", "reply": "Bạn thử [CL001.price_vnd] nhé.", "used_books": [], "citations": ["FAQ_1"]}
+
+    # câu trả lời lấy từ response cache
+    done = stream("cached", "phí ship bao nhiêu")[-1]
+    assert done["reply"] == plain["reply"] and done["citations"] == ["FAQ_1"]
@@ -0,0 +1,51 @@
+import sys
+import os
+from unittest.mock import patch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_cache import QueryCache, _MISSING
+
+
+def test_lru_ttl_and_version():
+    cache = QueryCache("t", maxsize=2, ttl=60)
+    cache.put("a", [1], version=1)
+    cache.put("b", [2], version=1)
+    assert cache.get("a", 1) == [1]          # a mới được dùng → b bị đẩy ra trước
+    cache.put("c", [3], version=1)
+    assert cache.get("b", 1) is _MISSING
+    assert cache.evictions == 1
+
+    # version đổi → miss (stale), entry bị bỏ
+    assert cache.get("a", 2) is _MISSING
+    assert cache.stats()["stale"] == 1 and cache.stats()["size"] == 1
+
+    # trả bản copy, sửa kết quả không làm hỏng cache
+    got = cache.get("c", 1)
+    got.append(99)
+    assert cache.get("c", 1) == [3]
+
+    expired = QueryCache("t2", ttl=-1)
+    expired.put("x", 1)
+    assert expired.get("x") is _MISSING
+
+
+def test_get_or_compute_counts():
+    cache = QueryCache("t3")
+    calls = []
+    version = [1]
+
+    def compute():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    with patch("query_cache.QUERY_CACHE", True):
+        assert cache.get_or_compute("k", lambda: version[0], compute) == {"n": 1}
+        assert cache.get_or_compute("k", lambda: version[0], compute) == {"n": 1}
+        version[0] = 2
+        assert cache.get_or_compute("k", lambda: version[0], compute) == {"n": 2}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+    with patch("query_cache.QUERY_CACHE", False):
+        cache.get_or_compute("k", lambda: 1 / 0, compute)  # tắt cache → không lấy version
+    assert len(calls) == 3
@@ -0,0 +1,40 @@
+# tests/test_response_cache.py
+import response_cache as rc
+from response_cache import ResponseCache, cacheable_turn, is_stateless
+
+
+def test_is_stateless():
+    assert is_stateless("Bao lâu thì nhận được hàng?")
+    assert not is_stateless("Cuốn đó giá bao nhiêu?")
+    assert not is_stateless("Đơn hàng của mình đang ở đâu?")
+
+
+def test_hit_after_normalization_and_shop_scoping(monkeypatch):
+    monkeypatch.setattr(rc, "RESPONSE_CACHE_SEMANTIC", False)
+    cache = ResponseCache(ttl=60)
+    assert cache.store("shop_1", "Phí ship bao nhiêu?", "30k", citations=["faq_ship"], version=1)
+
+    hit = cache.lookup("shop_1", "phi ship   bao nhieu", version=1)
+    assert hit == {"reply": "30k", "used_books": [], "citations": ["faq_ship"]}
+    assert cache.lookup("shop_2", "Phí ship bao nhiêu?", version=1) is None
+
+
+def test_version_and_ttl_invalidation(monkeypatch):
+    monkeypatch.setattr(rc, "RESPONSE_CACHE_SEMANTIC", False)
+    cache = ResponseCache(ttl=60)
+    cache.store("shop_1", "Phí ship bao nhiêu?", "30k", version=1)
+    assert cache.lookup("shop_1", "Phí ship bao nhiêu?", version=2) is None
+
+    expired = ResponseCache(ttl=-1)
+    expired.store("shop_1", "Phí ship bao nhiêu?", "30k", version=1)
+    assert expired.lookup("shop_1", "Phí ship bao nhiêu?", version=1) is None
+
+
+def test_cacheable_turn():
+    faq = {"tool": "search_docs", "result": [{"id": "faq_1", "source": "FAQ:ship"}]}
+    book = {"tool": "search_docs", "result": [{"id": "b_1", "source": "BOOK:1"}]}
+    assert cacheable_turn([faq]) == ["faq_1"]
+    assert cacheable_turn([book]) is None
+    assert cacheable_turn([{"tool": "find_books_by_filter", "result": []}]) is None
+    # cùng FAQ xuất hiện ở nhiều lần gọi search_docs → 1 citation
+    assert cacheable_turn([faq, faq]) == ["faq_1"]
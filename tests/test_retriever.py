@@ -0,0 +1,152 @@
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analyzer import DEFAULT_ANALYZER
+from index_format import MmapIndex, build_index_file
+from retriever import search_docs
+
+
+DOCS = [
+    {"id": "D1", "source": "FAQ:D1", "title": "Giao hàng", "chunk_text": "giao hàng nhanh giao hàng tận nơi"},
+    {"id": "D2", "source": "FAQ:D2", "title": "Đổi trả", "chunk_text": "đổi trả trong 7 ngày"},
+    {"id": "D3", "source": "BOOK:D3", "title": "Sách dài", "chunk_text": "giao " + "chữ " * 50},
+]
+
+
+def _mmap_index(tmp_path, docs=DOCS):
+    path = str(tmp_path / "idx.bin")
+    build_index_file(path, docs, DEFAULT_ANALYZER, version=1)
+    return MmapIndex(path, 1.2, 0.75)
+
+
+def _search(index, query, top_k, source_prefix=None):
+    ranked = index.search(DEFAULT_ANALYZER.analyze(query), top_k, source_prefix)
+    return [(index.doc(i)["id"], score) for i, score in ranked]
+
+
+def test_bm25_ranking(tmp_path):
+    """tf cao + doc ngắn phải xếp trên doc dài chỉ nhắc 1 lần"""
+    index = _mmap_index(tmp_path)
+    ranked = _search(index, "giao", top_k=3)
+    assert [doc_id for doc_id, _ in ranked] == ["D1", "D3"]
+    assert ranked[0][1] > ranked[1][1]
+
+    # top_k cắt đúng số lượng
+    assert len(_search(index, "giao đổi", top_k=1)) == 1
+
+    # term không có trong index
+    assert _search(index, "khônghề", top_k=3) == []
+
+
+def test_search_docs_shape():
+    """Output giữ nguyên format cũ: id, source, title, chunk_text, score"""
+    results = search_docs("bao lâu nhận được hàng", top_k=3)
+    assert len(results) == 3
+    assert results[0]["id"] == "FAQ_1"
+    assert set(results[0].keys()) == {"id", "source", "title", "chunk_text", "score"}
+    assert results[0]["score"] >= results[1]["score"] >= results[2]["score"]
+
+    assert search_docs("", top_k=3) == []
+
+
+def test_source_prefix_partition(tmp_path):
+    """source_prefix chỉ chấm trong partition tương ứng, vẫn trả đủ top_k"""
+    index = _mmap_index(tmp_path)
+    assert [doc_id for doc_id, _ in _search(index, "giao", 3, source_prefix="FAQ:")] == ["D1"]
+    assert [doc_id for doc_id, _ in _search(index, "giao", 3, source_prefix="BOOK")] == ["D3"]
+    # prefix chi tiết hơn tên partition → lọc theo source từng doc
+    assert _search(index, "giao", 3, source_prefix="FAQ:D2") == []
+    assert _search(index, "giao", 3, source_prefix="NEWS:") == []
+
+    results = search_docs("sách giao hàng", top_k=5, source_prefix="FAQ:")
+    assert len(results) == 5
+    assert all(r["source"].startswith("FAQ:") for r in results)
+
+
+def test_live_index_add_delete_merge(tmp_path):
+    from analyzer import Analyzer
+    from index_format import MmapIndex, build_index_file
+    from retriever import LiveIndex
+
+    an = Analyzer(fold=True, bigrams=True, stopwords=())
+    path = str(tmp_path / "idx.bin")
+    log = str(tmp_path / "delta.jsonl")
+    build_index_file(path, DOCS, an, version=1)
+    live = LiveIndex(MmapIndex(path, 1.2, 0.75), log_path=log)
+
+    def hits(index, q, prefix=None):
+        return [(d["id"], round(s, 9)) for d, s in index.search_hits(an.analyze(q), 5, prefix)]
+
+    new_doc = {"id": "D4", "source": "BOOK:D4", "title": "Sách mới", "chunk_text": "giao hàng hoả tốc"}
+    assert live.add_docs([new_doc]) == 1
+    assert [i for i, _ in hits(live, "hoả tốc")] == ["D4"]
+    assert [i for i, _ in hits(live, "giao", "BOOK:")] == ["D4", "D3"]
+
+    # chỉ thêm (không xoá) → điểm giống hệt index build lại từ đầu
+    fresh_path = str(tmp_path / "fresh.bin")
+    build_index_file(fresh_path, DOCS + [new_doc], an, version=1)
+    fresh = LiveIndex(MmapIndex(fresh_path, 1.2, 0.75))
+    assert hits(live, "giao hàng") == hits(fresh, "giao hàng")
+
+    # thay thế theo id + xoá theo source
+    live.add_docs([dict(new_doc, chunk_text="đóng gói cẩn thận")])
+    assert hits(live, "hoả tốc") == []
+    assert live.delete_docs(sources=["FAQ:D1"]) == 1
+    assert "D1" not in [i for i, _ in hits(live, "giao")]
+    version_before = live.version
+
+    # delta log → replay khi mở lại
+    reopened = LiveIndex(MmapIndex(path, 1.2, 0.75), log_path=log)
+    assert hits(reopened, "giao") == hits(live, "giao")
+
+    info = live.merge()
+    assert info["n_docs"] == 3  # D2, D3, D4 (D1 đã xoá)
+    assert live.version != version_before
+    assert live.stats()["delta_docs"] == 0 and live.stats()["tombstones"] == 0
+    assert [i for i, _ in hits(live, "đóng gói")] == ["D4"]
+    assert open(log).read() == ""
+    assert live.merge() is None
+
+
+def test_live_index_shared_between_workers(tmp_path):
+    """2 LiveIndex trên cùng .bin + delta log = 2 worker uvicorn."""
+    from analyzer import Analyzer
+    from index_format import MmapIndex, build_index_file
+    from retriever import LiveIndex
+
+    an = Analyzer(fold=True, bigrams=True, stopwords=())
+    path = str(tmp_path / "idx.bin")
+    log = str(tmp_path / "delta.jsonl")
+    build_index_file(path, DOCS, an, version=1)
+    a = LiveIndex(MmapIndex(path, 1.2, 0.75), log_path=log)
+    b = LiveIndex(MmapIndex(path, 1.2, 0.75), log_path=log)
+
+    def ids(index, q):
+        return [d["id"] for d, _ in index.search_hits(an.analyze(q), 5)]
+
+    # worker a thêm doc → worker b thấy sau khi sync
+    a.add_docs([{"id": "D4", "source": "BOOK:D4", "title": "Mới", "chunk_text": "giao hàng hoả tốc"}])
+    b.sync()
+    assert ids(b, "hoả tốc") == ["D4"]
+
+    # b xoá, a merge: a đọc nốt log trước khi ghi .bin mới → không mất thao tác của b
+    b.delete_docs(ids=["D1"])
+    info = a.merge()
+    assert info["n_docs"] == 3
+    assert open(log).read() == ""
+
+    # b mở lại .bin mới, delta của b (đã nằm trong .bin) bị bỏ
+    b.sync()
+    assert b.stats()["main_version"] == info["version"]
+    assert b.stats()["delta_docs"] == 0 and b.stats()["tombstones"] == 0
+    assert ids(b, "hoả tốc") == ["D4"]
+    assert "D1" not in ids(b, "giao")
+
+    # ghi sau merge: log đọc từ đầu, không lặp lại thao tác cũ
+    b.add_docs([{"id": "D5", "source": "BOOK:D5", "title": "Mới 2", "chunk_text": "bọc chống sốc"}])
+    a.sync()
+    assert ids(a, "chống sốc") == ["D5"]
+    assert a.stats()["delta_docs"] == 1
+    assert b.merge() is not None and a.merge() is None
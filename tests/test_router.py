@@ -0,0 +1,82 @@
+# tests/test_router.py
+from router import NaiveBayesIntent, PreRouter, classifier_router, detect_genre, parse_money, rule_router
+
+
+def _router():
+    r = PreRouter(min_confidence=0.85)
+    r.register("rules", rule_router)
+    return r
+
+
+def test_parse_money():
+    assert parse_money("sách dưới 200k") == 200_000
+    assert parse_money("tầm 150.000đ thôi") == 150_000
+    assert parse_money("khoảng 1.5 triệu") == 1_500_000
+    assert parse_money("sách 300 trang") is None
+
+
+def test_rules_route_book_search_and_faq():
+    r = _router()
+    res = r.route("Tìm sách kinh điển dưới 200k")
+    assert res["path"] == "rules"
+    assert res["tool_spec"] == {
+        "tool": "find_books",
+        "params": {"genre": "Classic", "budget_max": 200_000, "limit": 3},
+    }
+
+    res = r.route("Phí ship bao nhiêu vậy shop?")
+    assert res["tool_spec"]["tool"] == "search_docs"
+    assert res["tool_spec"]["params"]["source_prefix"] == "FAQ"
+
+
+def test_low_confidence_falls_back_to_llm():
+    r = _router()
+    assert r.route("chào shop nha") is None
+    assert r.route("So sánh giúp mình 2 cuốn classic rẻ nhất") is None
+    assert r.route("Cuốn đó có bản dưới 100k không?") is None      # phụ thuộc ngữ cảnh
+    assert r.route("gợi ý sách 1 triệu") is None                   # chỉ có giá, không rõ là ngân sách
+
+
+def test_classifier_router_fills_params_by_rules():
+    clf = NaiveBayesIntent().fit([
+        ("tìm sách trinh thám", "find_books"),
+        ("có truyện kinh điển nào hay", "find_books"),
+        ("giao hàng mất mấy ngày", "search_docs"),
+        ("đổi trả thế nào", "search_docs"),
+        ("chào bạn", "llm"),
+    ])
+    label, prob = clf.predict("bao nhiêu ngày thì giao hàng")
+    assert label == "search_docs" and 0.5 < prob <= 1.0
+
+    r = PreRouter(min_confidence=0.5)
+    r.register("classifier", classifier_router(clf))
+    res = r.route("có truyện kinh điển dưới 150k không")
+    assert res["path"] == "classifier"
+    assert res["tool_spec"]["params"]["genre"] == "Classic"
+    assert res["tool_spec"]["params"]["budget_max"] == 150_000
+
+
+def test_stats_count_paths():
+    r = _router()
+    r.record("rules")
+    r.record("llm")
+    stats = r.stats()
+    assert stats["paths"] == {"rules": 1, "llm": 1}
+    assert stats["llm_skipped_rate"] == 0.5
+
+
+def test_genre_not_in_catalog_falls_back_to_llm():
+    assert detect_genre("sách tài chính cá nhân") == "Finance"
+    assert detect_genre("sách nonfiction hay") == "Nonfiction"
+
+    codes = {"classic", "fiction", "finance", "nonfiction"}
+    r = PreRouter(min_confidence=0.85, genre_codes=lambda: codes)
+    r.register("rules", rule_router)
+    res = r.route("Tìm sách tài chính cá nhân dưới 200k")
+    assert res["tool_spec"]["params"]["genre"] == "Finance"
+
+    # catalog không có thể loại này → không đoán bừa, để LLM quyết định
+    codes.discard("finance")
+    assert r.route("Tìm sách tài chính cá nhân dưới 200k") is None
+    assert r.route("Tìm sách kinh điển dưới 200k")["tool_spec"]["params"]["genre"] == "Classic"
+    assert r.route("Phí ship bao nhiêu vậy shop?")["tool_spec"]["tool"] == "search_docs"
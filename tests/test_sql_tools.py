@@ -10,7 +10,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from models import Base, Book, UserProfile, UserFact
+from models import Base, Book, UserProfile, UserFact, Message
 
 # Import các hàm cần test
 from sql_tools import (
@@ -18,7 +18,10 @@ from sql_tools import (
     tool_get_book_detail,
     tool_compare_books,
     tool_add_user_fact,
-    tool_get_user_profile
+    tool_get_user_profile,
+    start_or_get_conversation,
+    save_message,
+    get_last_messages,
 )
 
 # --- CẤU HÌNH DB ẢO CHO TEST (IN-MEMORY SQLITE) ---
@@ -49,7 +52,8 @@ def mock_session_local(db_session):
     Đây là phép thuật: Đánh tráo (Mock) cái SessionLocal trong file sql_tools.py
     thành cái db_session ảo của chúng ta.
     """
-    with patch("sql_tools.SessionLocal") as mock:
+    # catalog_version (key của query cache) cũng đọc từ DB ảo → cache bật như production
+    with patch("sql_tools.SessionLocal") as mock, patch("catalog.SessionLocal", return_value=db_session):
         mock.return_value = db_session
         yield mock
 
@@ -100,6 +104,23 @@ def test_find_books_by_filter(mock_session_local, seed_data):
     results = find_books_by_filter(shop_id="shop1", limit=100)
     assert len(results) == 6
 
+def test_find_books_genre_code(mock_session_local, seed_data):
+    """Test lọc thể loại theo genre_code đã chuẩn hoá"""
+
+    # Không phân biệt hoa thường / khoảng trắng
+    results = find_books_by_filter(shop_id="shop1", genre="  fiction ")
+    assert {b["book_id"] for b in results} == {"B001", "B002", "B004"}
+
+    # Sắp xếp: rating cao trước
+    assert results[0]["book_id"] == "B004"
+
+    # Không khớp chính xác → khớp một phần
+    results = find_books_by_filter(shop_id="shop1", genre="hist")
+    assert {b["book_id"] for b in results} == {"B005", "B006"}
+
+    # Thể loại không tồn tại
+    assert find_books_by_filter(shop_id="shop1", genre="Horror") == []
+
 def test_get_book_detail(mock_session_local, seed_data):
     """Test lấy chi tiết sách"""
     
@@ -160,4 +181,30 @@ def test_user_memory(mock_session_local, seed_data, db_session):
     # Verify DB chỉ có 1 dòng nhưng confidence thay đổi
     facts = db_session.query(UserFact).filter_by(fact_value="Horror").all()
     assert len(facts) == 1
-    assert float(facts[0].confidence) == 0.99
\ No newline at end of file
+    assert float(facts[0].confidence) == 0.99
+
+
+def test_conversation_unit_of_work(db_session):
+    """Test dùng chung 1 session cho cả lượt chat: ghi dồn tới 1 commit cuối"""
+
+    conv = start_or_get_conversation("shop1", "user1", "sess1", db=db_session)
+    assert conv.id is not None
+
+    # Lấy lại conversation cũ, không tạo mới
+    again = start_or_get_conversation("shop1", "user1", "sess1", db=db_session)
+    assert again.id == conv.id
+
+    save_message(conv.id, "user", "Xin chào", db=db_session)
+    save_message(conv.id, "assistant", "Chào bạn", db=db_session)
+
+    # Chưa commit nhưng history của session vẫn thấy 2 message theo đúng thứ tự
+    history = get_last_messages(conv.id, limit=5, db=db_session)
+    assert [m["turn_index"] for m in history] == [1, 2]
+    assert history[-1]["content"] == "Chào bạn"
+
+    # limit áp dụng cả cho message chưa commit
+    assert len(get_last_messages(conv.id, limit=1, db=db_session)) == 1
+
+    db_session.commit()
+    assert db_session.query(Message).filter_by(conversation_id=conv.id).count() == 2
+    assert conv.last_turn_index == 2
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "scripts"))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Book
+from sync_price_stock import sync_price_stock, validate_rows
+
+OLD = datetime.utcnow() - timedelta(days=1)
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'books.sqlite3'}")
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = factory()
+    for book_id, price, stock in [("B1", 100000, 5), ("B2", 80000, 0), ("B3", 50000, 9)]:
+        db.add(Book(id=book_id, title=f"Sách {book_id}", price_vnd=price, stock=stock,
+                    created_at=OLD, updated_at=OLD))
+    db.commit()
+    db.close()
+    yield factory
+    engine.dispose()
+
+
+def test_validate_rows():
+    valid, fail = validate_rows([
+        {"book_id": "B1", "price_vnd": "120000", "stock": "3"},
+        {"book_id": "B2", "price_vnd": "0", "stock": "3"},
+        {"book_id": "B3", "price_vnd": "90000", "stock": "-1"},
+        {"book_id": "B4", "price_vnd": "abc", "stock": "1"},
+        {"book_id": "B1", "price_vnd": "130000", "stock": "3"},
+    ])
+    assert valid == [{"book_id": "B1", "price_vnd": 120000, "stock": 3}]
+    assert [f["book_id"] for f in fail] == ["B2", "B3", "B4", "B1"]
+
+
+def test_sync_updates_only_changed_rows_and_writes_reports(tmp_path, session_factory):
+    csv_path = tmp_path / "price_stock.csv"
+    csv_path.write_text(
+        "book_id,price_vnd,stock\n"
+        "B1,120000,4\n"      # đổi
+        "B2,80000,0\n"       # không đổi
+        "B9,10000,1\n"       # không có trong DB
+        "B3,-5,2\n",         # lỗi
+        encoding="utf-8",
+    )
+    out_dir = tmp_path / "out"
+
+    result = sync_price_stock(str(csv_path), str(out_dir), session_factory=session_factory)
+
+    assert [r["book_id"] for r in result["success"]] == ["B1", "B2"]
+    assert {f["book_id"] for f in result["fail"]} == {"B3", "B9"}
+    assert (out_dir / "missing_books.log").read_text(encoding="utf-8") == "B9\n"
+    assert json.loads((out_dir / "update_result.json").read_text(encoding="utf-8")) == result
+
+    db = session_factory()
+    b1, b2, b3 = db.get(Book, "B1"), db.get(Book, "B2"), db.get(Book, "B3")
+    assert (b1.price_vnd, b1.stock) == (120000, 4)
+    assert b1.updated_at > OLD           # catalog fingerprint đổi
+    assert b2.updated_at == OLD          # không đổi giá / tồn → không chạm
+    assert (b3.price_vnd, b3.stock, b3.updated_at) == (50000, 9, OLD)
+    assert b1.title == "Sách B1"
+    db.close()
+
+
+def test_sync_rejects_file_without_required_columns(tmp_path, session_factory):
+    csv_path = tmp_path / "price_stock.csv"
+    csv_path.write_text("book_id,price\nB1,1000\n", encoding="utf-8")
+    assert sync_price_stock(str(csv_path), str(tmp_path), session_factory=session_factory) is None
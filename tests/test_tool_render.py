@@ -0,0 +1,90 @@
+# tests/test_tool_render.py
+from tool_render import count_tokens, fit_messages, render_tool_result, truncate_tokens
+
+
+def _detail(intro_words: int):
+    return {
+        "tool": "get_book_detail",
+        "params": {"book_id": "CL002"},
+        "result": {
+            "book_id": "CL002",
+            "title": "Hoàng tử bé",
+            "price_vnd": 50000,
+            "publisher": None,
+            "short_summary": "Câu chuyện giản dị về tình bạn.",
+            "introduction": "giới thiệu " * intro_words,
+        },
+    }
+
+
+def test_truncate_tokens():
+    text = "một hai ba bốn năm sáu bảy tám chín mười " * 20
+    cut = truncate_tokens(text, 30)
+    assert count_tokens(cut) <= 30 and cut.endswith("…")
+    assert truncate_tokens("ngắn thôi", 30) == "ngắn thôi"
+
+
+def test_render_projects_fields_and_respects_budget():
+    out = render_tool_result(_detail(2000), budget=200)
+    assert out.startswith("[tool get_book_detail] book_id=CL002")
+    assert "price_vnd: 50000" in out
+    assert "publisher" not in out            # field rỗng bị bỏ
+    assert "Câu chuyện giản dị về tình bạn." in out   # text ngắn giữ nguyên
+    assert count_tokens(out) <= 200
+
+
+def test_render_list_as_table():
+    payload = {
+        "tool": "search_docs",
+        "params": {"query": "phí ship"},
+        "result": [
+            {"id": "FAQ_1", "source": "FAQ:ship", "title": "Phí ship", "chunk_text": "30k | toàn quốc", "score": 1.2},
+        ],
+    }
+    out = render_tool_result(payload)
+    assert out.splitlines()[1:] == ["id | title | chunk_text", "FAQ_1 | Phí ship | 30k / toàn quốc"]
+    assert "lỗi: boom" in render_tool_result({"tool": "find_books", "params": {}, "error": "boom"})
+
+
+def test_fit_messages_drops_oldest_history_first():
+    long = "chữ " * 200
+    messages = [
+        {"role": "system", "content": "system"},
+        {"role": "user", "content": long},
+        {"role": "assistant", "content": long},
+        {"role": "tool", "content": "[tool find_books]\nCL002"},
+        {"role": "user", "content": "còn cuốn nào rẻ hơn?"},
+    ]
+    fitted = fit_messages(messages, budget=count_tokens(long) + 50)
+    # tool của lượt trước bị bỏ trước, rồi tới history cũ nhất
+    assert [m["role"] for m in fitted] == ["system", "assistant", "user"]
+    assert fit_messages(messages, budget=10_000) == messages
+
+
+def test_fit_messages_keeps_latest_question_under_tight_budget():
+    payload = "[tool find_books] genre=Fiction\n" + "CL002 | Sherlock Holmes | " + "chữ " * 600
+    messages = [{"role": "system", "content": "system"}]
+    for i in range(4):
+        messages += [
+            {"role": "user", "content": f"câu hỏi {i}"},
+            {"role": "tool", "content": payload},
+            {"role": "assistant", "content": f"trả lời {i}"},
+        ]
+    messages += [
+        {"role": "user", "content": "còn cuốn nào rẻ hơn không?"},
+        {"role": "tool", "content": payload},
+    ]
+
+    fitted = fit_messages(messages, budget=count_tokens(payload) + 40)
+    assert fitted[0]["content"] == "system"
+    assert fitted[-2] == {"role": "user", "content": "còn cuốn nào rẻ hơn không?"}
+    # tool của lượt hiện tại còn nguyên, tool của các lượt trước bị bỏ hết
+    assert fitted[-1]["content"] == payload
+    assert sum(m["role"] == "tool" for m in fitted) == 1
+
+    # ngân sách còn chặt hơn: kết quả tool hiện tại bị cắt bớt chứ câu hỏi vẫn giữ
+    tight = fit_messages(messages, budget=200)
+    assert [m["role"] for m in tight] == ["system", "user", "tool"]
+    assert tight[1]["content"] == "còn cuốn nào rẻ hơn không?"
+    assert tight[2]["content"].startswith("[tool find_books]") and tight[2]["content"].endswith("…")
+    assert sum(count_tokens(m["content"]) for m in tight) <= 200
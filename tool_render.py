@@ -0,0 +1,209 @@
+# tool_render.py
+"""
+Render kết quả tool thành text gọn cho message role=tool (thay cho json.dumps cả payload).
+
+- Chỉ giữ các field câu trả lời cần (TOOL_FIELDS), bỏ field rỗng.
+- Danh sách sách / doc → dạng bảng "a | b | c" (tên cột ghi 1 lần), 1 object → "key: value".
+- Field text dài (summary, introduction, chunk_text) bị cắt để cả kết quả nằm trong
+  ngân sách token của tool (TOOL_TOKEN_BUDGETS, mặc định TOOL_TOKEN_BUDGET).
+- fit_messages: bỏ bớt history cũ để cả prompt <= PROMPT_TOKEN_BUDGET token.
+
+Đếm token: tokenizer của model (PROMPT_TOKENIZER = tên/đường dẫn HF tokenizer, cần transformers),
+không có thì ước lượng theo số byte UTF-8 của từng từ.
+
+Tắt bằng TOOL_RENDER=0 (quay lại JSON đầy đủ).
+"""
+import json
+import math
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+TOOL_RENDER = os.getenv("TOOL_RENDER", "1") == "1"
+TOOL_TOKEN_BUDGET = int(os.getenv("TOOL_TOKEN_BUDGET", "600"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "")
+
+# Ngân sách riêng theo tool (ghi đè TOOL_TOKEN_BUDGET), vd: TOOL_TOKEN_BUDGETS="get_book_detail=900,search_docs=700"
+TOOL_TOKEN_BUDGETS: Dict[str, int] = {
+    name.strip(): int(n)
+    for name, _, n in (
+        item.partition("=") for item in os.getenv("TOOL_TOKEN_BUDGETS", "").split(",") if "=" in item
+    )
+}
+
+# Field đưa vào prompt, theo thứ tự cột
+TOOL_FIELDS: Dict[str, List[str]] = {
+    "find_books": ["book_id", "title", "authors", "genres", "pages", "price_vnd", "stock", "rating_avg", "summary"],
+    "compare_books": ["book_id", "title", "authors", "genres_primary", "pages", "price_vnd", "rating_avg"],
+    "get_book_detail": [
+        "book_id", "title", "authors", "genres_primary", "pages", "price_vnd", "stock", "rating_avg",
+        "publisher", "year", "short_summary", "introduction",
+    ],
+    "search_docs": ["id", "title", "chunk_text"],
+    "get_user_profile": [
+        "budget_min", "budget_max", "fav_genres", "fav_authors", "page_min", "page_max", "content_avoid",
+    ],
+    "add_user_fact": ["status", "msg"],
+}
+
+# Field text dài, bị cắt khi vượt ngân sách
+LONG_FIELDS = {"summary", "short_summary", "introduction", "chunk_text"}
+
+
+# ---------------- ĐẾM TOKEN ----------------
+
+_tokenizer = None
+_tokenizer_failed = False
+_tokenizer_lock = threading.Lock()
+_WORD_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _get_tokenizer():
+    global _tokenizer, _tokenizer_failed
+    if not PROMPT_TOKENIZER or _tokenizer_failed:
+        return None
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None and not _tokenizer_failed:
+                try:
+                    from transformers import AutoTokenizer
+                    _tokenizer = AutoTokenizer.from_pretrained(PROMPT_TOKENIZER)
+                except Exception as e:
+                    _tokenizer_failed = True
+                    print("⚠️ Không load được tokenizer, đếm token ước lượng:", e)
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    tok = _get_tokenizer()
+    if tok is not None:
+        return len(tok.encode(text, add_special_tokens=False))
+    # ước lượng: ~4 byte UTF-8 / token (tiếng Việt có dấu tốn nhiều byte hơn → nhiều token hơn)
+    return sum(math.ceil(len(w.encode("utf-8")) / 4) for w in _WORD_RE.findall(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cắt text theo từ để còn <= max_tokens token (thêm "…" nếu bị cắt)."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:  # số từ lớn nhất còn vừa ngân sách (tính cả "…")
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid]) + "…") <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo]) + "…" if lo else ""
+
+
+# ---------------- RENDER ----------------
+
+def _fmt(value: Any) -> str:
+    if isinstance(value, float):
+        return f"{value:g}"
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    # bảng dùng "|" làm cột, mỗi dòng 1 bản ghi
+    return " ".join(str(value).replace("|", "/").split())
+
+
+def _rows(name: str, result: Any) -> List[Dict[str, str]]:
+    items = result if isinstance(result, list) else [result]
+    fields = TOOL_FIELDS.get(name)
+    rows = []
+    for item in items:
+        if not isinstance(item, dict):
+            rows.append({"value": _fmt(item)})
+            continue
+        keys = fields if fields is not None else list(item)
+        rows.append({k: _fmt(item[k]) for k in keys if item.get(k) not in (None, "", [])})
+    return rows
+
+
+def _layout(rows: List[Dict[str, str]], as_table: bool) -> List[str]:
+    if not as_table:
+        return [f"{k}: {v}" for row in rows for k, v in row.items()]
+    columns = list(dict.fromkeys(k for row in rows for k in row))
+    lines = [" | ".join(columns)]
+    lines += [" | ".join(row.get(c, "") for c in columns) for row in rows]
+    return lines
+
+
+def render_tool_result(payload: Dict[str, Any], budget: Optional[int] = None) -> str:
+    """Payload {"tool", "params", "result"[, "error"]} → text gọn <= budget token (trừ field ngắn)."""
+    if not TOOL_RENDER:
+        return json.dumps(payload, ensure_ascii=False)
+
+    name = payload.get("tool") or ""
+    params = {k: v for k, v in (payload.get("params") or {}).items() if v not in (None, "", [])}
+    header = f"[tool {name}]" + "".join(f" {k}={_fmt(v)}" for k, v in params.items())
+    if payload.get("error"):
+        return f"{header}\nlỗi: {payload['error']}"
+    result = payload.get("result")
+    if result in (None, [], {}):
+        return f"{header}\n(không có kết quả)"
+
+    if budget is None:
+        budget = TOOL_TOKEN_BUDGETS.get(name, TOOL_TOKEN_BUDGET)
+    rows = _rows(name, result)
+    as_table = isinstance(result, list)
+
+    # Field ngắn giữ nguyên; phần ngân sách còn lại chia đều cho các field text dài,
+    # text ngắn hơn phần của nó thì phần dư chuyển cho các text sau
+    long_cells = [(row, k, row[k]) for row in rows for k in row if k in LONG_FIELDS]
+    if long_cells:
+        for row, k, _ in long_cells:
+            row[k] = ""
+        remaining = budget - count_tokens("\n".join([header] + _layout(rows, as_table)))
+        long_cells.sort(key=lambda c: count_tokens(c[2]))
+        for i, (row, k, text) in enumerate(long_cells):
+            share = max(remaining // (len(long_cells) - i), 0)
+            row[k] = truncate_tokens(text, share)
+            remaining -= count_tokens(row[k])
+            if not row[k]:
+                del row[k]
+
+    return "\n".join([header] + _layout(rows, as_table))
+
+
+# ---------------- NGÂN SÁCH CẢ PROMPT ----------------
+
+def fit_messages(messages: List[Dict[str, str]], budget: int = PROMPT_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """
+    Thu prompt về <= budget token. Luôn giữ system và câu hỏi user mới nhất, bỏ dần theo thứ tự:
+    1. kết quả tool của các lượt trước (cũ nhất trước);
+    2. user/assistant của các lượt trước (cũ nhất trước);
+    3. cuối cùng mới cắt bớt kết quả tool của lượt hiện tại (sau câu hỏi mới nhất), chia đều phần còn lại.
+    """
+    sizes = [count_tokens(m["content"]) for m in messages]
+    total = sum(sizes)
+    if total <= budget:
+        return messages
+
+    users = [i for i, m in enumerate(messages) if m["role"] == "user"]
+    last_user = users[-1] if users else len(messages) - 1
+    earlier = [i for i in range(last_user) if messages[i]["role"] != "system"]
+    earlier.sort(key=lambda i: (messages[i]["role"] != "tool", i))
+
+    fitted: List[Optional[Dict[str, str]]] = list(messages)
+    for i in earlier:
+        if total <= budget:
+            break
+        fitted[i] = None
+        total -= sizes[i]
+
+    current = [i for i in range(last_user + 1, len(messages)) if messages[i]["role"] != "system"]
+    if total > budget and current:
+        remaining = budget - (total - sum(sizes[i] for i in current))
+        current.sort(key=lambda i: sizes[i])
+        for n, i in enumerate(current):
+            share = max(remaining // (len(current) - n), 0)
+            text = truncate_tokens(messages[i]["content"], share)
+            remaining -= count_tokens(text)
+            fitted[i] = dict(messages[i], content=text) if text else None
+    return [m for m in fitted if m is not None]